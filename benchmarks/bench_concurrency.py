@@ -0,0 +1,142 @@
+"""Load test of I/O-bound routes under the sync, gthread and gevent worker classes.
+
+Starts the Bitbucket stub with added latency, then for each worker class
+starts gunicorn (with gunicorn.conf.py) on main:app pointed at the stub and
+hammers the routes from concurrent clients for a fixed duration. The
+routes also read the database configured by the DB_* settings, and /repos
+only calls Bitbucket for the repositories found in bb_commits, so pass the
+same --repos the data was synced or generated with.
+
+Usage: python benchmarks/bench_concurrency.py [--modes sync,gthread,gevent] [--clients 50] [--duration 20] [--latency 0.2] [--routes /repos]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bitbucket_stub import start_stub  # noqa: E402
+
+
+def start_gunicorn(mode, port, workers, concurrency, base_url):
+    env = dict(
+        os.environ,
+        GUNICORN_WORKER_CLASS=mode,
+        GUNICORN_THREADS=str(concurrency),
+        GUNICORN_WORKER_CONNECTIONS=str(concurrency),
+        WEB_CONCURRENCY=str(workers),
+        BITBUCKET_API_BASE_URL=base_url,
+        # Enough connections for every concurrent request of a worker
+        DB_POOL_SIZE=str(min(concurrency, 20)),
+        DB_POOL_MAX_OVERFLOW=str(max(concurrency - 20, 0)),
+    )
+    process = subprocess.Popen(
+        ["gunicorn", "--bind", f"127.0.0.1:{port}", "main:app"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"gunicorn ({mode}) exited with {process.returncode}")
+        try:
+            requests.get(f"{url}/metrics", timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"gunicorn ({mode}) did not start")
+
+
+def load(url, routes, clients, duration):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client(n):
+        nonlocal errors
+        session = requests.Session()
+        i = n
+        while time.monotonic() < stop_at:
+            route = routes[i % len(routes)]
+            i += 1
+            started_at = time.perf_counter()
+            try:
+                ok = session.get(url + route, timeout=60).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = (time.perf_counter() - started_at) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors += 1
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(client, range(clients)))
+
+    latencies.sort()
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "rps": count / duration,
+        "p50_ms": statistics.median(latencies) if latencies else 0,
+        "p99_ms": latencies[min(count - 1, int(count * 0.99))] if latencies else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", default="sync,gthread,gevent", help="Comma separated worker classes")
+    parser.add_argument("--routes", default="/repos", help="Comma separated routes to request")
+    parser.add_argument("--repos", default="stub/repo-1", help="Repositories served by the stub")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--concurrency", type=int, default=50, help="Threads or greenlets per worker")
+    parser.add_argument("--clients", type=int, default=50, help="Concurrent clients")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of load per mode")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds added to every stub response")
+    parser.add_argument("--port", type=int, default=8123)
+    args = parser.parse_args()
+
+    server, base_url = start_stub(repos=args.repos.split(","), commits=10, latency=args.latency)
+    routes = args.routes.split(",")
+
+    results = []
+    for mode in args.modes.split(","):
+        process, url = start_gunicorn(mode, args.port, args.workers, args.concurrency, base_url)
+        try:
+            print(f"Loading {mode}...")
+            # Warm up every worker (engine, pandas import) outside of the measurement
+            load(url, routes, args.clients, 2)
+            results.append(dict(load(url, routes, args.clients, args.duration), mode=mode))
+        finally:
+            process.terminate()
+            process.wait()
+
+    server.shutdown()
+
+    header = f"{'mode':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['mode']:<10}{r['requests']:>10}{r['errors']:>8}{r['rps']:>10.1f}"
+            f"{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Throughput benchmark for diff_parser on large synthetic diffs.
+
+Usage: python benchmarks/bench_diff_parser.py [--files 500] [--hunks 20] [--lines 30] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diff_parser import iter_diff_files  # noqa: E402
+
+
+def generate_diff(files, hunks, lines):
+    parts = []
+    for f in range(files):
+        path = f"src/module_{f}/file_{f}.py"
+        parts.append(f"diff --git a/{path} b/{path}\n")
+        parts.append("index 1111111..2222222 100644\n")
+        parts.append(f"--- a/{path}\n+++ b/{path}\n")
+        for h in range(hunks):
+            start = h * (lines * 2) + 1
+            parts.append(f"@@ -{start},{lines + 2} +{start},{lines + 2} @@ def func_{h}():\n")
+            parts.append("     context line\n")
+            for i in range(lines // 2):
+                parts.append(f"-    removed = value_{i} + {h}\n")
+            for i in range(lines // 2):
+                parts.append(f"+    added = value_{i} * {h}\n")
+            for i in range(lines - 2 * (lines // 2)):
+                parts.append("     more context\n")
+            parts.append("     context line\n")
+    return "".join(parts)
+
+
+def run(diff, include_content, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        files = 0
+        for diff_file in iter_diff_files(diff, include_content=include_content):
+            files += 1
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return files, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--hunks", type=int, default=20)
+    parser.add_argument("--lines", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    diff = generate_diff(args.files, args.hunks, args.lines)
+    size_mb = len(diff) / (1024 * 1024)
+    print(f"Diff size: {size_mb:.1f} MB, files: {args.files}")
+
+    for include_content in (True, False):
+        files, elapsed = run(diff, include_content, args.repeat)
+        mode = "content" if include_content else "stats"
+        print(
+            f"{mode:>8}: {files} files in {elapsed:.3f}s "
+            f"({size_mb / elapsed:.1f} MB/s, {files / elapsed:.0f} files/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Partition pruning of the date-filtered read endpoints.
+
+Requests the date-filtered routes through the Flask test client against the
+database configured by the DB_* settings, usually filled by
+generate_dataset.py --init-schema --partitioned. The statements they run on
+bb_commits are captured and re-run under EXPLAIN (ANALYZE, FORMAT JSON) to
+report how many partitions each one scanned out of all of them, with its
+planning and execution time. Run it on an unpartitioned copy of the same
+data for the baseline.
+
+Usage: python benchmarks/bench_partitions.py [--days 30] [--requests 20] [--tz America/Sao_Paulo]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import timedelta
+from urllib.parse import quote, urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import event, text  # noqa: E402
+from query_profiler import EXPLAINABLE_PATTERN  # noqa: E402
+
+# Route name -> URL template, {range} holds since and until
+ROUTES = {
+    "author_commits": "/authors/{author_id}/commits?{range}",
+    "author_commits_by_date": "/authors/{author_id}/{date}/commits",
+    "author_commit_count": "/authors/{author_id}/commit_count?{range}&tz={tz}",
+    "all_commits": "/all_commits?{range}",
+    # Not date-filtered, scans every partition
+    "author_commits_unbounded": "/authors/{author_id}/commits",
+}
+
+
+def sample(engine):
+    # The most active author and the last day with commits
+    sql = """
+        SELECT author_id, MAX(created_at_ts) AS last_at
+        FROM bb_commits
+        GROUP BY author_id
+        ORDER BY COUNT(*) DESC
+        LIMIT 1;
+    """
+    with engine.begin() as conn:
+        row = conn.execute(text(sql)).first()
+    if row is None:
+        raise SystemExit("bb_commits is empty, run generate_dataset.py first")
+    return row.author_id, row.last_at
+
+
+def commit_partitions(engine):
+    sql = """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass('bb_commits');
+    """
+    with engine.begin() as conn:
+        return {row[0] for row in conn.execute(text(sql))}
+
+
+def scanned_relations(plan, relations):
+    # Walks the plan tree, partitions removed at plan time never appear in it
+    if "Relation Name" in plan:
+        relations.add(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        scanned_relations(child, relations)
+    return relations
+
+
+def explain(engine, statement, parameters):
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0][0]
+        connection.rollback()
+    finally:
+        connection.close()
+    return plan
+
+
+def run_route(client, engine, captured, url, requests_per_route, partitions):
+    latencies = []
+    for _ in range(requests_per_route):
+        captured.clear()
+        started_at = time.perf_counter()
+        response = client.get(url)
+        latencies.append((time.perf_counter() - started_at) * 1000)
+        if response.status_code >= 400:
+            raise SystemExit(f"{url} returned {response.status_code}: {response.get_data(as_text=True)}")
+
+    results = []
+    for statement, parameters in list(captured):
+        plan = explain(engine, statement, parameters)
+        scanned = scanned_relations(plan["Plan"], set())
+        results.append(
+            {
+                "scanned": len(scanned & partitions) if partitions else None,
+                "planning_ms": plan["Planning Time"],
+                "execution_ms": plan["Execution Time"],
+            }
+        )
+
+    return statistics.median(latencies), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, default=30, help="Width of the since/until window")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per route")
+    parser.add_argument("--tz", default="America/Sao_Paulo", help="Time zone of commit_count, not UTC to skip the rollup")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="Comma separated route names")
+    args = parser.parse_args()
+
+    import main as app_main
+
+    engine = app_main.init_db_engine()
+    client = app_main.app.test_client()
+
+    author_id, last_at = sample(engine)
+    partitions = commit_partitions(engine)
+    until = last_at.date() + timedelta(days=1)
+    since = until - timedelta(days=args.days)
+    values = {
+        "author_id": quote(author_id, safe=""),
+        "date": last_at.date().isoformat(),
+        "range": urlencode({"since": since.isoformat(), "until": until.isoformat()}),
+        "tz": quote(args.tz, safe=""),
+    }
+    print(f"bb_commits partitions: {len(partitions) or 'none, not partitioned'}")
+    print(f"Author {author_id}, window {since} to {until}")
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and EXPLAINABLE_PATTERN.match(statement) and "bb_commits" in statement:
+            captured.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+
+    header = f"{'route':<28}{'p50 ms':>10}{'stmt':>6}{'partitions':>12}{'plan ms':>10}{'exec ms':>10}"
+    lines = []
+    for name in args.routes.split(","):
+        url = ROUTES[name].format(**values)
+        print(f"Requesting {name}...")
+        # Warm up the engine and the imports outside of the measurement
+        client.get(url)
+        latency, results = run_route(client, engine, captured, url, args.requests, partitions)
+        if not results:
+            lines.append(f"{name:<28}{latency:>10.1f}  no statement on bb_commits")
+        for i, result in enumerate(results):
+            # One line per statement of the route, the route and its latency on the first
+            route = f"{name:<28}{latency:>10.1f}" if i == 0 else f"{'':<38}"
+            scanned = f"{result['scanned']}/{len(partitions)}" if partitions else "-"
+            lines.append(
+                f"{route}{i + 1:>6}{scanned:>12}{result['planning_ms']:>10.2f}{result['execution_ms']:>10.2f}"
+            )
+
+    event.remove(engine, "before_cursor_execute", capture)
+
+    print(header)
+    print("-" * len(header))
+    for line in lines:
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""Latency and memory benchmark of the read endpoints.
+
+Drives the read routes through the Flask test client (or a running server
+with --url) against the database configured by the DB_* settings, usually
+filled by generate_dataset.py. Authors are sampled from the data: the most
+active ones and a random tail, since both hit very different row counts.
+Reports p50/p99 latency per route and the memory each route needed.
+
+Usage: python benchmarks/bench_read_routes.py [--requests 50] [--routes authors,author_commits] [--url http://localhost:5000] [--pid 1234]
+"""
+import argparse
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from urllib.parse import quote
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import settings  # noqa: E402
+from db_utils import connect_db  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+# Route name -> URL template; {author_id} and {author} are filled from sampled authors
+ROUTES = {
+    "authors": "/authors",
+    "repos": "/repos",
+    "author_repos": "/authors/{author_id}/repos",
+    "author_commits": "/authors/{author_id}/commits",
+    "author_commits_by_date": "/authors/{author_id}/{date}/commits",
+    "author_commit_count": "/authors/{author_id}/commit_count",
+    "heatmap": "/heatmap",
+    "author_heatmap": "/heatmap?author_id={author_id}",
+    "author_pullrequests": "/authors/{author}/pullrequests",
+    "author_mtr": "/{author}/mtr",
+    "team_mtr": "/mtr",
+    "pullrequests": "/pullrequests",
+    "count_pullrequests": "/count_pullrequests",
+    "last_pullrequest": "/last_pullrequest",
+    "all_commits": "/all_commits",
+}
+
+# Routes returning whole tables are only requested a few times
+UNBOUNDED_ROUTES = {"all_commits", "pullrequests"}
+
+
+def sample_authors(engine, top, tail, seed):
+    sql = """
+        SELECT author_id, author, COUNT(*) AS commits, MAX(LEFT(created_at, 10)) AS last_day
+        FROM bb_commits
+        GROUP BY author_id, author
+        ORDER BY commits DESC;
+    """
+    with engine.begin() as conn:
+        rows = [dict(row._mapping) for row in conn.execute(text(sql))]
+    if not rows:
+        raise SystemExit("bb_commits is empty, run generate_dataset.py first")
+
+    rng = random.Random(seed)
+    rest = rows[top:]
+    return rows[:top] + rng.sample(rest, min(tail, len(rest)))
+
+
+def build_urls(template, authors):
+    if "{" not in template:
+        return [template]
+    return [
+        template.format(
+            author_id=quote(a["author_id"] or a["author"], safe=""),
+            author=quote(a["author"], safe=""),
+            date=a["last_day"],
+        )
+        for a in authors
+    ]
+
+
+def server_peak_rss_mb(pid):
+    # VmHWM is the peak resident set size of the process
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+class TestClientTarget:
+    def __init__(self):
+        from main import app
+
+        self.client = app.test_client()
+
+    def get(self, url):
+        response = self.client.get(url)
+        size = len(response.get_data())
+        return response.status_code, size
+
+    def peak_memory_mb(self, url):
+        tracemalloc.start()
+        self.get(url)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak / (1024 * 1024)
+
+    def peak_rss_mb(self):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ServerTarget:
+    def __init__(self, base_url, pid):
+        import requests
+
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.pid = pid
+
+    def get(self, url):
+        response = self.session.get(self.base_url + url)
+        return response.status_code, len(response.content)
+
+    def peak_memory_mb(self, url):
+        return None
+
+    def peak_rss_mb(self):
+        return server_peak_rss_mb(self.pid) if self.pid else None
+
+
+def run_route(target, name, urls, requests_per_route):
+    count = min(requests_per_route, 3) if name in UNBOUNDED_ROUTES else requests_per_route
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    rss_before = target.peak_rss_mb()
+
+    for i in range(count):
+        url = urls[i % len(urls)]
+        started_at = time.perf_counter()
+        status, size = target.get(url)
+        latencies.append((time.perf_counter() - started_at) * 1000)
+        response_bytes += size
+        if status >= 400:
+            errors += 1
+
+    # One extra traced request, tracing slows the timed ones down too much
+    python_peak = target.peak_memory_mb(urls[0])
+    rss_after = target.peak_rss_mb()
+
+    latencies.sort()
+    return {
+        "route": name,
+        "requests": count,
+        "errors": errors,
+        "p50_ms": statistics.median(latencies),
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "max_ms": latencies[-1],
+        "avg_kb": response_bytes / count / 1024,
+        "python_peak_mb": python_peak,
+        "peak_rss_mb": rss_after,
+        "rss_growth_mb": rss_after - rss_before if rss_after is not None and rss_before is not None else None,
+    }
+
+
+def format_mb(value):
+    return f"{value:>10.1f}" if value is not None else f"{'-':>10}"
+
+
+def print_report(results):
+    header = (
+        f"{'route':<24}{'reqs':>6}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+        f"{'avg KB':>10}{'py peak':>10}{'peak RSS':>10}{'RSS +':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['route']:<24}{r['requests']:>6}{r['errors']:>8}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+            f"{r['max_ms']:>10.1f}{r['avg_kb']:>10.1f}{format_mb(r['python_peak_mb'])}"
+            f"{format_mb(r['peak_rss_mb'])}{format_mb(r['rss_growth_mb'])}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50, help="Requests per route")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="Comma separated route names")
+    parser.add_argument("--top-authors", type=int, default=5, help="Most active authors to request")
+    parser.add_argument("--tail-authors", type=int, default=20, help="Random other authors to request")
+    parser.add_argument("--url", help="Benchmark a running server instead of the test client")
+    parser.add_argument("--pid", type=int, help="Server process id, to report its peak RSS with --url")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    engine = connect_db(
+        settings.DB_HOST,
+        settings.DB_PORT,
+        settings.DB_USER,
+        settings.DB_PSWD,
+        settings.DB_NAME,
+        settings.DB_SSLMODE,
+    )
+    authors = sample_authors(engine, args.top_authors, args.tail_authors, args.seed)
+    engine.dispose()
+
+    target = ServerTarget(args.url, args.pid) if args.url else TestClientTarget()
+
+    results = []
+    for name in args.routes.split(","):
+        urls = build_urls(ROUTES[name], authors)
+        print(f"Requesting {name}...")
+        # Warm up connections and imports outside of the measurement
+        target.get(urls[0])
+        results.append(run_route(target, name, urls, args.requests))
+
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
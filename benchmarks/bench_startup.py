@@ -0,0 +1,90 @@
+"""Cold import time of the app, as paid by every gunicorn worker and CLI command.
+
+Imports main in fresh interpreters, reports the median wall time and the
+slowest modules from -X importtime, and exits non-zero when the median is
+over the budget or when a module that should stay lazy (pandas) was
+imported at startup.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--budget-ms 1000] [--module main]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only imported by the code paths that need them
+LAZY_MODULES = ("pandas", "numpy")
+
+CHECK_LAZY = "import sys; print(','.join(m for m in {lazy!r} if m in sys.modules))"
+
+
+def run_import(module, importtime=False):
+    args = [sys.executable]
+    if importtime:
+        args += ["-X", "importtime"]
+    args += ["-c", f"import {module}; " + CHECK_LAZY.format(lazy=LAZY_MODULES)]
+
+    started_at = time.perf_counter()
+    completed = subprocess.run(args, cwd=ROOT, capture_output=True, text=True)
+    elapsed = (time.perf_counter() - started_at) * 1000
+    if completed.returncode != 0:
+        raise SystemExit(f"import {module} failed:\n{completed.stderr}")
+
+    loaded = [m for m in completed.stdout.strip().split(",") if m]
+    return elapsed, loaded, completed.stderr
+
+
+def slowest_modules(importtime_output, limit):
+    # Lines look like "import time:   self [us] | cumulative | imported package"
+    modules = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Only the imports made directly by the top level ones (indented by 3),
+        # the deeper ones are part of their cumulative time
+        if len(name) - len(name.lstrip()) == 3:
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return sorted(modules, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=1000)
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    args = parser.parse_args()
+
+    # The first run warms the bytecode cache and is not counted
+    run_import(args.module)
+    timings = []
+    for _ in range(args.runs):
+        elapsed, loaded, _ = run_import(args.module)
+        timings.append(elapsed)
+
+    _, _, importtime_output = run_import(args.module, importtime=True)
+
+    median = statistics.median(timings)
+    print(f"import {args.module}: median {median:.0f} ms, min {min(timings):.0f} ms, max {max(timings):.0f} ms")
+    print("Slowest imports (cumulative ms):")
+    for cumulative, name in slowest_modules(importtime_output, args.top):
+        print(f"  {cumulative:>8.1f}  {name}")
+
+    failures = []
+    if median > args.budget_ms:
+        failures.append(f"median import time {median:.0f} ms is over the {args.budget_ms:.0f} ms budget")
+    if loaded:
+        failures.append(f"imported at startup: {', '.join(loaded)}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""End-to-end sync throughput benchmark against a local Bitbucket stub server.
+
+Runs sync_commits, sync_pullrequests, sync_diffs and sync_mtr against
+synthetic repositories served by bitbucket_stub.py and writes into the
+database configured by the DB_* settings. Use a scratch database: with
+--reset the bb_* tables are emptied first. The diffs and diffstat stages
+process the same commits, compare them in separate --reset runs.
+
+Usage: python benchmarks/bench_sync.py --init-schema --reset [--repos ws/a,ws/b] [--commits 2000] [--latency 0.05] [--error-rate 0.01]
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import settings  # noqa: E402
+from bitbucket_stub import add_arguments, start_stub, stub_options  # noqa: E402
+from db_utils import connect_db  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from sync import SyncProgress, sync_commits, sync_diffs, sync_mtr, sync_pullrequests  # noqa: E402
+
+SCHEMA_FILE = os.path.join(ROOT, "postgresql-db_v1.3.sql")
+# Monthly partitioning of bb_commits and bb_mtr, applied on top with --partitioned
+PARTITION_SCHEMA_FILE = os.path.join(ROOT, "postgresql-db_v1.4.sql")
+BENCHMARK_TABLES = (
+    "bb_commit_churn",
+    "bb_commit_branches",
+    "bb_pullrequest_states",
+    "bb_mtr_rollup",
+    "bb_commit_daily",
+    "bb_mtr",
+    "bb_pullrequests",
+    "bb_commits",
+    "bb_sync_history",
+    "bb_sync_checkpoints",
+)
+
+
+def init_schema(engine, partitioned=False):
+    # Autocommit, as the partitioning migration manages its own transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        with open(SCHEMA_FILE) as file:
+            conn.exec_driver_sql(file.read())
+
+        # The migration only applies to tables not partitioned yet
+        sql = "SELECT COUNT(*) FROM pg_partitioned_table WHERE partrelid = to_regclass('bb_commits')"
+        if partitioned and not conn.exec_driver_sql(sql).scalar():
+            with open(PARTITION_SCHEMA_FILE) as file:
+                conn.exec_driver_sql(file.read())
+
+
+def reset_tables(engine):
+    with engine.begin() as conn:
+        conn.execute(text(f"TRUNCATE {', '.join(BENCHMARK_TABLES)}"))
+
+
+def run_stage(name, server, run):
+    state = server.state
+    with state.lock:
+        state.calls.clear()
+        state.bytes_sent = 0
+
+    progress = SyncProgress()
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    error = None
+    try:
+        run(progress)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - started_at
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    with state.lock:
+        calls = sum(state.calls.values())
+        failed_calls = sum(count for key, count in state.calls.items() if not key.endswith(":200"))
+        bytes_sent = state.bytes_sent
+
+    return {
+        "stage": name,
+        "seconds": elapsed,
+        "pages": progress.pages_fetched,
+        "records": progress.records_written,
+        "records_per_second": progress.records_written / elapsed if elapsed else 0,
+        "api_calls": calls,
+        "api_errors": failed_calls,
+        "api_mb": bytes_sent / (1024 * 1024),
+        "peak_mb": peak / (1024 * 1024),
+        "errors": len(progress.errors) + (1 if error else 0),
+        "error": error or (progress.errors[0] if progress.errors else None),
+    }
+
+
+def print_report(results):
+    header = (
+        f"{'stage':<14}{'seconds':>9}{'records':>9}{'rec/s':>10}"
+        f"{'api calls':>11}{'api err':>9}{'api MB':>9}{'peak MB':>9}{'errors':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['stage']:<14}{r['seconds']:>9.2f}{r['records']:>9}{r['records_per_second']:>10.1f}"
+            f"{r['api_calls']:>11}{r['api_errors']:>9}{r['api_mb']:>9.2f}{r['peak_mb']:>9.1f}{r['errors']:>8}"
+        )
+    for r in results:
+        if r["error"]:
+            print(f"{r['stage']}: {r['error']}")
+
+    # ru_maxrss is in kilobytes on Linux
+    print(f"Process max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--page-size", type=int, default=50, help="Page length for commits and PRs")
+    parser.add_argument("--chunk-size", type=int, default=settings.DB_CHUNK_SIZE)
+    parser.add_argument("--repo-workers", type=int, default=4)
+    parser.add_argument("--init-schema", action="store_true", help="Apply the schema file first")
+    parser.add_argument(
+        "--partitioned", action="store_true", help="With --init-schema, also partition the tables by month"
+    )
+    parser.add_argument("--reset", action="store_true", help="Empty the bb_* tables first")
+    parser.add_argument(
+        "--stages", default="commits,pullrequests,diffs,mtr", help="Comma separated stages to run"
+    )
+    args = parser.parse_args()
+
+    options = stub_options(args)
+    server, base_url = start_stub(**options)
+    print(f"Stub server: {base_url}, repos: {', '.join(options['repos'])}")
+
+    engine = connect_db(
+        settings.DB_HOST,
+        settings.DB_PORT,
+        settings.DB_USER,
+        settings.DB_PSWD,
+        settings.DB_NAME,
+        settings.DB_SSLMODE,
+    )
+    if args.init_schema:
+        init_schema(engine, args.partitioned)
+    if args.reset:
+        reset_tables(engine)
+
+    config = {
+        "BITBUCKET_USERNAME": "benchmark",
+        "BITBUCKET_APP_PASSWORD": "benchmark",
+        "BITBUCKET_API_BASE_URL": base_url,
+        "BITBUCKET_REPOS": options["repos"],
+        "DB_CHUNK_SIZE": args.chunk_size,
+        "SYNC_REPO_WORKERS": args.repo_workers,
+    }
+    repos = options["repos"]
+
+    stages = {
+        "commits": lambda p: sync_commits(engine, config, repos, args.page_size, p),
+        "pullrequests": lambda p: sync_pullrequests(engine, config, repos, args.page_size, p),
+        "diffs": lambda p: sync_diffs(engine, config, progress=p, mode="diff"),
+        "diffstat": lambda p: sync_diffs(engine, config, progress=p, mode="diffstat"),
+        "mtr": lambda p: sync_mtr(engine, config, repos, page_size=100, progress=p),
+    }
+
+    results = []
+    for name in args.stages.split(","):
+        print(f"Running {name}...")
+        results.append(run_stage(name, server, stages[name]))
+
+    server.shutdown()
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
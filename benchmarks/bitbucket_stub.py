@@ -0,0 +1,328 @@
+"""Local stub of the Bitbucket 2.0 repositories API, serving synthetic data.
+
+Serves the endpoints the Bitbucket client uses (commits, branch commits,
+branches, pull requests, diffs, diffstats and the repository itself) in the same
+response shape, with configurable sizes, page lengths, latency and
+injected 429 responses.
+
+Usage: python benchmarks/bitbucket_stub.py [--port 8765] [--repos ws/repo1,ws/repo2] [--commits 1000] ...
+Then point BITBUCKET_API_BASE_URL at http://localhost:8765/2.0/repositories.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+BASE_PATH = "/2.0/repositories"
+BASE_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+PR_STATES = ("OPEN", "MERGED", "DECLINED", "SUPERSEDED")
+
+
+class StubRepository:
+    """Deterministic synthetic commits, branches and pull requests of one repository."""
+
+    def __init__(self, full_name, commits, pullrequests, branches, authors, seed):
+        self.full_name = full_name
+        self.uuid = "{%08x-0000-4000-8000-%012x}" % (seed, seed)
+        rng = random.Random(seed)
+
+        # Skewed activity: a few authors make most of the commits
+        people = [
+            {
+                "display_name": f"Author {i}",
+                "nickname": f"author{i}",
+                "uuid": "{%08x-%04x-4000-8000-000000000000}" % (seed, i),
+                "email": f"author{i}@example.com",
+            }
+            for i in range(authors)
+        ]
+        weights = [1 / (i + 1) for i in range(authors)]
+
+        repository = {
+            "type": "repository",
+            "name": full_name.split("/")[1],
+            "full_name": full_name,
+            "uuid": self.uuid,
+        }
+
+        self.commits = []
+        for i in range(commits):
+            person = rng.choices(people, weights)[0]
+            author = {"raw": f"{person['display_name']} <{person['email']}>"}
+            if rng.random() < 0.9:
+                author["user"] = {k: person[k] for k in ("display_name", "nickname", "uuid")}
+            task = rng.randint(1, max(commits // 5, 1))
+            message = f"TASK-{task}/change {i}" if rng.random() < 0.95 else f"change {i}"
+            self.commits.append(
+                {
+                    "type": "commit",
+                    "hash": "%040x" % rng.getrandbits(160),
+                    "date": (BASE_DATE - timedelta(minutes=17 * i)).isoformat(),
+                    "message": message + "\n",
+                    "author": author,
+                    "repository": repository,
+                }
+            )
+
+        self.branches = ["master"] + [f"feature/TASK-{i}" for i in range(1, branches)]
+
+        self.pullrequests = []
+        for i in range(pullrequests):
+            person = rng.choices(people, weights)[0]
+            created_on = BASE_DATE - timedelta(hours=5 * i)
+            updated_on = created_on + timedelta(hours=rng.randint(1, 96))
+            self.pullrequests.append(
+                {
+                    "type": "pullrequest",
+                    "id": i + 1,
+                    "title": f"TASK-{i} Pull request {i}",
+                    "description": f"Description of pull request {i}",
+                    "state": rng.choice(PR_STATES),
+                    "author": {k: person[k] for k in ("display_name", "nickname", "uuid")},
+                    "source": {"branch": {"name": f"feature/TASK-{i}"}, "repository": repository},
+                    "created_on": created_on.isoformat(),
+                    "updated_on": updated_on.isoformat(),
+                }
+            )
+
+    def branch_commits(self, branch):
+        if branch == "master":
+            return self.commits
+        index = self.branches.index(branch)
+        return self.commits[index :: len(self.branches)]
+
+    def branch_values(self):
+        return [
+            {
+                "type": "branch",
+                "name": name,
+                "target": {
+                    "hash": self.branch_commits(name)[0]["hash"] if self.commits else None,
+                    "repository": {"name": self.full_name.split("/")[1], "full_name": self.full_name},
+                },
+            }
+            for name in self.branches
+        ]
+
+
+def diff_paths(commit_hash, files):
+    rng = random.Random(commit_hash)
+    return [f"src/module_{rng.randint(0, 50)}/file_{f}.py" for f in range(files)]
+
+
+def generate_diff(commit_hash, files, lines):
+    rng = random.Random(commit_hash)
+    parts = []
+    for path in diff_paths(commit_hash, files):
+        parts.append(f"diff --git a/{path} b/{path}\nindex 1111111..2222222 100644\n")
+        parts.append(f"--- a/{path}\n+++ b/{path}\n")
+        parts.append(f"@@ -1,{lines} +1,{lines} @@\n")
+        for i in range(lines):
+            parts.append(f"-    value_{i} = {rng.random()}\n+    value_{i} = {rng.random()}\n")
+    return "".join(parts)
+
+
+class StubState:
+    def __init__(self, repos, diff_files, diff_lines, latency, error_rate, seed):
+        self.repos = repos
+        self.diff_files = diff_files
+        self.diff_lines = diff_lines
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+
+def paginate(values, query, url):
+    page = int(query.get("page", ["1"])[0])
+    pagelen = int(query.get("pagelen", ["10"])[0])
+    start = (page - 1) * pagelen
+    body = {
+        "pagelen": pagelen,
+        "page": page,
+        "size": len(values),
+        "values": values[start : start + pagelen],
+    }
+    if start + pagelen < len(values):
+        # Like Bitbucket, the next url keeps the other parameters (state, sort)
+        next_query = dict(query, page=[str(page + 1)], pagelen=[str(pagelen)])
+        body["next"] = f"{url.split('?')[0]}?{urlencode(next_query, doseq=True)}"
+    return body
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server_version = "BitbucketStub/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def absolute_url(self):
+        # Bitbucket links the next page with an absolute url
+        return f"http://{self.headers['Host']}{self.path}"
+
+    def send_body(self, status, body, content_type="application/json", endpoint="other"):
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        state = self.server.state
+        with state.lock:
+            state.calls[f"{endpoint}:{status}"] += 1
+            state.bytes_sent += len(data)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if state.latency:
+            time.sleep(state.latency)
+
+        if not url.path.startswith(BASE_PATH + "/"):
+            return self.send_body(404, {"type": "error", "error": {"message": "Not found"}})
+
+        parts = url.path[len(BASE_PATH) + 1 :].rstrip("/").split("/")
+        full_name = "/".join(parts[:2])
+        repo = state.repos.get(full_name)
+        rest = parts[2:]
+        endpoint = rest[0] if rest else "repository"
+
+        with state.lock:
+            throttled = state.rng.random() < state.error_rate
+        if throttled:
+            return self.send_body(
+                429, {"type": "error", "error": {"message": "Rate limit exceeded"}}, endpoint=endpoint
+            )
+
+        if repo is None:
+            return self.send_body(
+                404, {"type": "error", "error": {"message": "Repository not found"}}, endpoint=endpoint
+            )
+
+        if not rest:
+            body = {"type": "repository", "full_name": repo.full_name, "uuid": repo.uuid}
+            return self.send_body(200, body, endpoint=endpoint)
+
+        if rest[0] == "commits" and len(rest) == 1:
+            return self.send_body(200, paginate(repo.commits, query, self.absolute_url()), endpoint="commits")
+
+        if rest[0] == "commits":
+            branch = "/".join(rest[1:])
+            if branch not in repo.branches:
+                return self.send_body(404, {"type": "error"}, endpoint="commits")
+            values = repo.branch_commits(branch)
+            return self.send_body(200, paginate(values, query, self.absolute_url()), endpoint="commits")
+
+        if rest[:2] == ["refs", "branches"]:
+            return self.send_body(200, paginate(repo.branch_values(), query, self.absolute_url()), endpoint="branches")
+
+        if rest[0] == "pullrequests":
+            states = query.get("state", ["OPEN"])
+            values = [pr for pr in repo.pullrequests if pr["state"] in states]
+            if query.get("sort", [""])[0] == "-updated_on":
+                values = sorted(values, key=lambda pr: pr["updated_on"], reverse=True)
+            return self.send_body(200, paginate(values, query, self.absolute_url()), endpoint="pullrequests")
+
+        if rest[0] == "diff" and len(rest) == 2:
+            diff = generate_diff(rest[1], state.diff_files, state.diff_lines)
+            return self.send_body(200, diff, content_type="text/plain", endpoint="diff")
+
+        if rest[0] == "diffstat" and len(rest) == 2:
+            # Same files and line counts as the diff endpoint
+            values = [
+                {
+                    "type": "diffstat",
+                    "status": "modified",
+                    "lines_added": state.diff_lines,
+                    "lines_removed": state.diff_lines,
+                    "old": {"path": path, "type": "commit_file"},
+                    "new": {"path": path, "type": "commit_file"},
+                }
+                for path in diff_paths(rest[1], state.diff_files)
+            ]
+            return self.send_body(200, paginate(values, query, self.absolute_url()), endpoint="diffstat")
+
+        return self.send_body(404, {"type": "error", "error": {"message": "Not found"}})
+
+
+def start_stub(
+    repos=("stub/repo-1",),
+    commits=1000,
+    pullrequests=200,
+    branches=5,
+    authors=50,
+    diff_files=5,
+    diff_lines=20,
+    latency=0.0,
+    error_rate=0.0,
+    port=0,
+    seed=1,
+):
+    """Start the stub server on a background thread; returns the server and its API base url."""
+    stub_repos = {
+        name: StubRepository(name, commits, pullrequests, branches, authors, seed + i)
+        for i, name in enumerate(repos)
+    }
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(stub_repos, diff_files, diff_lines, latency, error_rate, seed)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}{BASE_PATH}"
+    return server, base_url
+
+
+def add_arguments(parser):
+    parser.add_argument("--repos", default="stub/repo-1", help="Comma separated workspace/repo names")
+    parser.add_argument("--commits", type=int, default=1000, help="Commits per repo")
+    parser.add_argument("--pullrequests", type=int, default=200, help="Pull requests per repo")
+    parser.add_argument("--branches", type=int, default=5, help="Branches per repo")
+    parser.add_argument("--authors", type=int, default=50, help="Distinct authors per repo")
+    parser.add_argument("--diff-files", type=int, default=5, help="Files per diff")
+    parser.add_argument("--diff-lines", type=int, default=20, help="Changed lines per diff file")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of responses that are 429")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def stub_options(args):
+    return {
+        "repos": args.repos.split(","),
+        "commits": args.commits,
+        "pullrequests": args.pullrequests,
+        "branches": args.branches,
+        "authors": args.authors,
+        "diff_files": args.diff_files,
+        "diff_lines": args.diff_lines,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "seed": args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url = start_stub(port=args.port, **stub_options(args))
+    print(f"Serving {args.repos} at {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
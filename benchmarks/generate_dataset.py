@@ -0,0 +1,178 @@
+"""Fill bb_commits, bb_pullrequests and bb_mtr with a large synthetic dataset.
+
+Activity is skewed (a Zipf-like distribution over authors and repos) and
+a share of the commits carry a diff, some of them large. Rows are loaded
+with COPY in batches, then the MTR and daily commit rollups are rebuilt.
+Use a scratch database: with --reset the bb_* tables are emptied first.
+
+Usage: python benchmarks/generate_dataset.py --init-schema [--partitioned] --reset [--commits 1000000] [--authors 2000] [--repos 50]
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import settings  # noqa: E402
+from bench_sync import init_schema, reset_tables  # noqa: E402
+from db_utils import connect_db, ensure_month_partitions, rebuild_commit_daily, rebuild_mtr_rollup  # noqa: E402
+
+END_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+PR_STATES = ("OPEN", "MERGED", "DECLINED", "SUPERSEDED")
+PR_STATE_WEIGHTS = (0.1, 0.75, 0.12, 0.03)
+
+
+def zipf_weights(n, s=1.1):
+    return [1 / (i + 1) ** s for i in range(n)]
+
+
+def generate_diff(rng, mean_kb):
+    # Log-normal sizes: most diffs are small, a few are very large
+    target = int(rng.lognormvariate(0, 1.2) * mean_kb * 1024 / 1.8)
+    parts = []
+    size = 0
+    f = 0
+    while size < target or f == 0:
+        path = f"src/pkg_{rng.randint(0, 200)}/module_{f}.py"
+        header = f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n@@ -1,10 +1,10 @@\n"
+        lines = "".join(f"-old line {i}\n+new line {i}\n" for i in range(10))
+        parts.append(header + lines)
+        size += len(header) + len(lines)
+        f += 1
+    return "".join(parts)
+
+
+def copy_rows(engine, table, columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows(rows)
+    buffer.seek(0)
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def generate(engine, args):
+    rng = random.Random(args.seed)
+    authors = [(f"author{i}", f"{i:08x}-0000-4000-8000-{args.seed:012x}") for i in range(args.authors)]
+    author_weights = list(zipf_weights(args.authors))
+    repos = [f"workspace/repo-{i}" for i in range(args.repos)]
+    repo_weights = list(zipf_weights(args.repos, 0.8))
+    span_seconds = args.days * 86400
+
+    commit_columns = ("id", "author", "author_id", "msg", "created_at", "repo", "diff", "created_at_ts")
+    mtr_columns = ("id", "repository", "author", "commit_message", "created_at", "commit_id", "created_at_ts")
+
+    started_at = time.perf_counter()
+    written = 0
+    while written < args.commits:
+        batch = min(args.batch_size, args.commits - written)
+        batch_authors = rng.choices(authors, author_weights, k=batch)
+        batch_repos = rng.choices(repos, repo_weights, k=batch)
+
+        commits = []
+        mtr = []
+        timestamps = []
+        for i in range(batch):
+            n = written + i
+            author, author_id = batch_authors[i]
+            repo = batch_repos[i]
+            created_at_ts = END_DATE - timedelta(seconds=rng.randrange(span_seconds))
+            created_at = created_at_ts.isoformat()
+            timestamps.append(created_at_ts)
+            task = rng.randint(1, max(args.commits // 20, 1))
+            msg = f"TASK-{task}/change {n}" if rng.random() < 0.95 else f"change {n}"
+            diff = generate_diff(rng, args.diff_kb) if rng.random() < args.diff_ratio else None
+            commit_id = "%040x" % rng.getrandbits(160)
+
+            commits.append((commit_id, author, author_id, msg, created_at, repo, diff, created_at))
+            if rng.random() < args.mtr_ratio:
+                mtr.append((n, repo.split("/")[1], author, msg, created_at, commit_id, created_at))
+
+        # COPY routes rows to the monthly partitions, when the tables are partitioned
+        ensure_month_partitions(engine, "bb_commits", timestamps)
+        ensure_month_partitions(engine, "bb_mtr", timestamps)
+        copy_rows(engine, "bb_commits", commit_columns, commits)
+        if mtr:
+            copy_rows(engine, "bb_mtr", mtr_columns, mtr)
+
+        written += batch
+        rate = written / (time.perf_counter() - started_at)
+        print(f"Commits: {written}/{args.commits} ({rate:.0f}/s)")
+
+    pr_columns = ("id", "title", "description", "state", "author", "author_id", "repo", "created_at", "updated_at")
+    pullrequests = []
+    for n in range(args.pullrequests):
+        author, author_id = rng.choices(authors, author_weights)[0]
+        created_at = END_DATE - timedelta(seconds=rng.randrange(span_seconds))
+        updated_at = created_at + timedelta(hours=rng.expovariate(1 / 30))
+        pullrequests.append(
+            (
+                n + 1,
+                f"TASK-{n} Pull request {n}",
+                f"Description of pull request {n}",
+                rng.choices(PR_STATES, PR_STATE_WEIGHTS)[0],
+                author,
+                author_id,
+                rng.choices(repos, repo_weights)[0],
+                created_at.isoformat(),
+                updated_at.isoformat(),
+            )
+        )
+    copy_rows(engine, "bb_pullrequests", pr_columns, pullrequests)
+    print(f"Pull requests: {args.pullrequests}")
+
+    rebuild_mtr_rollup(engine)
+    rebuild_commit_daily(engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--commits", type=int, default=1_000_000)
+    parser.add_argument("--authors", type=int, default=2000)
+    parser.add_argument("--repos", type=int, default=50)
+    parser.add_argument("--pullrequests", type=int, default=100_000)
+    parser.add_argument("--days", type=int, default=3 * 365, help="History covered by the commits")
+    parser.add_argument("--diff-ratio", type=float, default=0.2, help="Share of commits with a diff")
+    parser.add_argument("--diff-kb", type=float, default=8, help="Mean diff size in KB")
+    parser.add_argument("--mtr-ratio", type=float, default=0.5, help="Share of commits also in bb_mtr")
+    parser.add_argument("--batch-size", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--init-schema", action="store_true", help="Apply the schema file first")
+    parser.add_argument(
+        "--partitioned", action="store_true", help="With --init-schema, also partition the tables by month"
+    )
+    parser.add_argument("--reset", action="store_true", help="Empty the bb_* tables first")
+    args = parser.parse_args()
+
+    engine = connect_db(
+        settings.DB_HOST,
+        settings.DB_PORT,
+        settings.DB_USER,
+        settings.DB_PSWD,
+        settings.DB_NAME,
+        settings.DB_SSLMODE,
+    )
+    if args.init_schema:
+        init_schema(engine, args.partitioned)
+    if args.reset:
+        reset_tables(engine)
+
+    generate(engine, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,134 +1,233 @@
 import re
 import requests
-import json
-from db_utils import (
-    append_mtr,
-    connect_db,
-    query_sync_history,
-)
-from flask import Flask, jsonify
-from urllib.parse import urlparse, parse_qs
+import threading
+import time
+from metrics import observe_bitbucket_call
 import os
-import pandas as pd
 
 
 
 
+DEFAULT_API_BASE_URL = "https://api.bitbucket.org/2.0/repositories"
+
+# Keep-alive connections to the API are reused by every client of the process.
+# Credentials are passed per request, so the session holds no per-user state.
+HTTP_POOL_SIZE = 32
+_session = None
+_session_lock = threading.Lock()
+
+
+def http_session():
+    """Return the requests session shared by the threads (or greenlets) of this process."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=4, pool_maxsize=HTTP_POOL_SIZE
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+def _reset_session():
+    # Sockets of the parent process must not be shared with a forked child
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_session)
+
+
 class Bitbucket:
-    def __init__(self, username, app_password, workspace, repo):
-        self.api_base_url = "https://api.bitbucket.org/2.0/repositories"
+    def __init__(self, username, app_password, workspace, repo, api_base_url=None):
+        self.api_base_url = api_base_url or DEFAULT_API_BASE_URL
         self.username = username
         self.app_password = app_password
         self.workspace = workspace
         self.repo = repo
 
-    def list_commits(self, page=1, page_size=10):
-        """List commits for a given repository."""
-        print(
-            f"Fetching, repo: {self.workspace}/{self.repo}, page: {page}, size: {page_size}..."
-        )
-
-        # Construct the API url
-        url = f"{self.api_base_url}/{self.workspace}/{self.repo}/commits/?page={page}&pagelen={page_size}"
+    def _get(self, url, endpoint):
+        """GET an API url, recording the call in the metrics under the given endpoint type."""
         auth = (
             self.username,
             self.app_password,
         )
-        response = requests.get(url, auth=auth)
-
+        started_at = time.perf_counter()
+        response = http_session().get(url, auth=auth)
+        observe_bitbucket_call(endpoint, response, time.perf_counter() - started_at)
+        return response
+
+    def _get_page(self, url, endpoint):
+        """GET a page of a paginated endpoint.
+
+        Returns its values and the url of the next page (None on the last
+        one), or (None, None) when the page could not be fetched.
+        """
+        response = self._get(url, endpoint)
         if response.status_code != 200:
-            return None
+            return None, None
 
         response = response.json()
-        commits = response["values"]
+        return response["values"], response.get("next")
+
+    def commits_url(self, page=1, page_size=10):
+        return f"{self.api_base_url}/{self.workspace}/{self.repo}/commits/?page={page}&pagelen={page_size}"
+
+    def list_commits(self, page=1, page_size=10):
+        """List commits for a given repository."""
+        commits, _ = self.list_commits_page(self.commits_url(page, page_size))
+        return commits
+
+    def list_commits_page(self, url):
+        """List the commits of a page url, with the url of the next page.
+
+        Syncs follow the next urls Bitbucket returns, so an interrupted one
+        can resume from the url it stored whatever the page size.
+        """
+        print(f"Fetching, repo: {self.workspace}/{self.repo}, url: {url}...")
+
+        commits, next_url = self._get_page(url, "commits")
+        if commits is None:
+            return None, None
 
         print(f"Records: {len(commits)}")
 
         commits_with_details = []
         for commit in commits:
-            commit_hash = commit["hash"]
-            author = commit["author"]
+            commits_with_details.append(self.commit_record(commit))
 
-            commit_msg = commit["message"]
+        return commits_with_details, next_url
+        # return self.__transform_commits(commits_with_details)
 
-            if "user" in author:
-                author_nickname = author["user"]["nickname"]
-                author_id = author["user"]["uuid"].replace("{", "").replace("}", "")
-            else:
-                author_nickname = self.__extract_email(author["raw"])
-                author_id = author_nickname
+    def commit_record(self, commit, repository=None):
+        """Convert a Bitbucket commit object into a bb_commits record.
 
-            repo_full_name = commit["repository"]["full_name"]
-            repo_id = commit["repository"]["uuid"].replace("{", "").replace("}", "")
+        Webhook payloads do not embed the repository in each commit, so it
+        can be given separately.
+        """
+        commit_hash = commit["hash"]
+        author = commit["author"]
 
-            commit_details = {
-                "id": commit_hash,
-                "author": author_nickname,
-                "author_id": author_id,
-                "msg": commit_msg,
-                "created_at": commit["date"],
-                "repo": repo_full_name,
-            }
+        commit_msg = commit["message"]
 
-            commits_with_details.append(commit_details)
+        if "user" in author:
+            author_nickname = author["user"]["nickname"]
+            author_id = author["user"]["uuid"].replace("{", "").replace("}", "")
+        else:
+            author_nickname = self.__extract_email(author["raw"])
+            author_id = author_nickname
+
+        repository = repository or commit["repository"]
+        repo_full_name = repository["full_name"]
+
+        commit_details = {
+            "id": commit_hash,
+            "author": author_nickname,
+            "author_id": author_id,
+            "msg": commit_msg,
+            "created_at": commit["date"],
+            "repo": repo_full_name,
+        }
 
-        return commits_with_details
-        # return self.__transform_commits(commits_with_details)
+        return commit_details
 
     def get_diff_for_commit(self, commit_hash):
         url = f"{self.api_base_url}/{self.workspace}/{self.repo}/diff/{commit_hash}"
-        auth = (
-            self.username,
-            self.app_password,
-        )
-
-        response = requests.get(url, auth=auth)
+        response = self._get(url, "diff")
         if response.status_code == 200:
             return response.text
         else:
             return None
 
-    def list_pullrequests(self, page=1, page_size=10):
-        """List pull requests for a given repository."""
-        print(
-            f"Fetching, repo: {self.workspace}/{self.repo}, page: {page}, size: {page_size}..."
-        )
+    def list_diffstat(self, commit_hash, page_size=500):
+        """List the files changed by a commit with their lines added and removed.
+
+        Walks every page of the diffstat endpoint, which is much smaller than
+        the raw diff. Files have the same keys as diff_parser.iter_diff_files
+        without content, or None is returned when a page could not be fetched.
+        """
+        url = f"{self.api_base_url}/{self.workspace}/{self.repo}/diffstat/{commit_hash}?pagelen={page_size}"
+        files = []
+        while url:
+            response = self._get(url, "diffstat")
+            if response.status_code != 200:
+                return None
+
+            response = response.json()
+            for value in response["values"]:
+                old_path = (value.get("old") or {}).get("path")
+                new_path = (value.get("new") or {}).get("path")
+                files.append(
+                    {
+                        "file_name": new_path or old_path,
+                        "old_path": old_path,
+                        "new_path": new_path,
+                        "status": value.get("status", "modified"),
+                        # Bitbucket reports binary files as changed without lines
+                        "binary": False,
+                        "added": value.get("lines_added") or 0,
+                        "removed": value.get("lines_removed") or 0,
+                    }
+                )
+            url = response.get("next")
 
-        # Construct the API url
+        return files
+
+    def pullrequests_url(self, page=1, page_size=10, states=None, sort=None):
         url = f"{self.api_base_url}/{self.workspace}/{self.repo}/pullrequests/?page={page}&pagelen={page_size}"
-        auth = (
-            self.username,
-            self.app_password,
-        )
-        response = requests.get(url, auth=auth)
+        for state in states or []:
+            url += f"&state={state}"
+        if sort is not None:
+            url += f"&sort={sort}"
+        return url
+
+    def list_pullrequests(self, page=1, page_size=10, states=None, sort=None):
+        """List pull requests for a given repository.
+
+        Bitbucket only returns OPEN pull requests unless states are given,
+        sort is a field such as "-updated_on" (most recently updated first).
+        """
+        url = self.pullrequests_url(page, page_size, states, sort)
+        pullrequests, _ = self.list_pullrequests_page(url)
+        return pullrequests
 
-        if response.status_code != 200:
-            return None
+    def list_pullrequests_page(self, url):
+        """List the pull requests of a page url, with the url of the next page."""
+        print(f"Fetching, repo: {self.workspace}/{self.repo}, url: {url}...")
 
-        response = response.json()
-        records = response["values"]
+        records, next_url = self._get_page(url, "pullrequests")
+        if records is None:
+            return None, None
 
         print(f"Records: {len(records)}")
 
         pullrequests = []
         for record in records:
-            repo = record["source"]["repository"]["full_name"]
-            author_id = record["author"]["uuid"].replace("{", "").replace("}", "")
-            pullrequest = {
-                "id": record["id"],
-                "title": record["title"],
-                "description": record["description"],
-                "state": record["state"],
-                "author": record["author"]["nickname"],
-                "author_id": author_id,
-                "repo": repo,
-                "created_at": record["created_on"],
-                "updated_at": record["updated_on"],
-            }
-            pullrequests.append(pullrequest)
+            pullrequests.append(self.pullrequest_record(record))
 
         # return data
-        return pullrequests
+        return pullrequests, next_url
+
+    def pullrequest_record(self, record):
+        """Convert a Bitbucket pull request object into a bb_pullrequests record."""
+        repo = record["source"]["repository"]["full_name"]
+        author_id = record["author"]["uuid"].replace("{", "").replace("}", "")
+        pullrequest = {
+            "id": record["id"],
+            "title": record["title"],
+            "description": record["description"],
+            "state": record["state"],
+            "author": record["author"]["nickname"],
+            "author_id": author_id,
+            "repo": repo,
+            "created_at": record["created_on"],
+            "updated_at": record["updated_on"],
+        }
+        return pullrequest
 
     def __extract_email(self, txt):
         # Define a regular expression pattern for matching strings between angle brackets
@@ -144,271 +243,52 @@ class Bitbucket:
 
         return email_address
 
+    def branches_url(self, page=1, page_size=10):
+        return f"{self.api_base_url}/{self.workspace}/{self.repo}/refs/branches?page={page}&pagelen={page_size}"
+
     def list_branches(self, page=1, page_size=10):
         """List branches for a given repository."""
-        print(
-            f"Fetching, repo: {self.workspace}/{self.repo}, page: {page}, size: {page_size}..."
-        )
-
-        # Construct the API url
-        url = f"{self.api_base_url}/{self.workspace}/{self.repo}/refs/branches"
-        auth = (
-            self.username,
-            self.app_password,
-        )
-        response = requests.get(url, auth=auth)
+        records, _ = self.list_branches_page(self.branches_url(page, page_size))
+        return records
 
-        if response.status_code != 200:
-            return None
+    def list_branches_page(self, url):
+        """List the branches of a page url, with the url of the next page."""
+        print(f"Fetching, repo: {self.workspace}/{self.repo}, url: {url}...")
 
-        response = response.json()
-        records = response["values"]
+        records, next_url = self._get_page(url, "branches")
 
         #print(f"Records: {response}")
-        return records
+        return records, next_url
 
-    def sync_mtr(self, page=1, page_size=1000):
-        bitbucket_repos_list = os.environ.get("BITBUCKET_REPOS")
-        workspaces = []
-        repos = []
-        if bitbucket_repos_list:
-            repos = bitbucket_repos_list.split(',')
-            for repo_string in repos:
-                # Dividir cada string do repositório em workspace e repo
-                parts = repo_string.split('/')
-                workspace, repo = parts
-                # print(workspace)
-                print(f"Fetching, repo: {workspace}/{repo}, page: {page}, size: {page_size}...")
-
-                
-
-                # Construct the API url
-                branches_url = f"{self.api_base_url}/{workspace}/{repo}/refs/branches?page={page}&pagelen={page_size}"
-                #print(branches_url)
-                auth = (
-                    self.username,
-                    self.app_password,
-                )
-                response = requests.get(branches_url, auth=auth)
-
-                if response.status_code != 200:
-                    return None
-
-                response = response.json()
-                branch_name = response["values"]
-
-                data = json.dumps(branch_name)
-
-                data2 = json.loads(data)
-
-                branch_names = [{"branch": item["name"]} for item in data2]
-                repository_name = [{"repository": item["target"]["repository"]["name"]} for item in data2]
-
-                urls = [f"{self.api_base_url}/{workspace}/{repo}/commits/{item['branch']}?page={page}&pagelen={page_size}" for item in branch_names]
-                #print(urls)
-                #['https://api.bitbucket.org/2.0/repositories/backend-test1/xtvt-teste/commits/feature/teste?page=1&pagelen=100', 
-                #'https://api.bitbucket.org/2.0/repositories/backend-test1/xtvt-teste/commits/master?page=1&pagelen=100', 
-                #'https://api.bitbucket.org/2.0/repositories/backend-test1/xtvt-teste/commits/feature/teste2?page=1&pagelen=100']
-                
-                ### O ENDPOINT ABAIXO NÃO RETORNA TODOS OS AUTORES!!!
-                #urls = [f"{self.api_base_url}/{self.workspace}/{self.repo}/refs?q=name=%22{item['branch']}%22" for item in branch_names]
-
-                        
-                
-                result = []
-                result_branches = []
-
-
-
-                #Exibir as URLs resultantes
-                for url in urls:
-                    auth = (
-                    self.username,
-                    self.app_password,
-                    )
-                    response1 = requests.get(url, auth=auth)
-                    # print(urls)
-
-                    if response1.status_code != 200:
-                        print("ERRO")
-                        return None
-                    else:
-                        content = response1.json()
-                        result.append(content)
-                        # parts = url.split("/commits/")
-                        # branch_name = parts[1]
-                        # special = branch_name.split("?", 1)
-                        # branch_final = special[0]
-                        # result_branches.append(branch_final)
-            
-
-                result_dict = result
-                #print(result_dict)
-                    
-                #print(result_dict_2)
-
-                author_name_list = []
-                commit_date_list = []
-                commit_id_list = []
-                message_list = []
-                repository_list = []
-
-
-                # Conjunto para manter registro dos commit_ids
-                seen_commit_ids = set()
-
-                for i in result_dict:    
-                    values_list = [i['values'] for i in result_dict]
-                    author_file_path = 'author_names.txt'
-                    commit_date_file_path = 'commit_dates.txt'
-                    commit_id_file_path = 'commit_ids.txt'
-                    message_file_path = 'messages.txt'
-                    repository_file_path = 'repository.txt'
-                    #print(i['values'])
-                    #print(values_list)
-                    for d in values_list:
-                        # print(d)
-                        # caminho_arquivo = 'author_data.txt'
-
-                        # Abre o arquivo no modo de escrita
-                        # with open(caminho_arquivo, 'w') as arquivo_txt:
-                        #     # Itera sobre cada author_data em d
-                        for author_data in d:
-                            # Escreve a author_data no arquivo, seguido por uma nova linha
-                            # arquivo_txt.write(f"{author_data}\n")
-                            commit_id = author_data["hash"]
-                            if "author" in author_data and "user" in author_data["author"]:
-                                if commit_id not in seen_commit_ids:
-                                    author_name = author_data["author"]["user"]["display_name"]
-                                    commit_date = author_data["date"]
-                                    commit_id = author_data["hash"]
-                                    message = author_data["message"].strip()
-                                    repository = author_data["repository"]["name"]
-                                    if message:
-                                        message = message.replace('\n', '')
-                                        message_list.append(message)
-                                        author_name_list.append(author_name)
-                                        commit_date_list.append(commit_date)
-                                        commit_id_list.append(commit_id)
-                                        repository_list.append(repository)
-                                        with open(message_file_path, 'a', encoding='utf-8') as file:
-                                            file.write(message + '\n')
-                                        with open(author_file_path, 'a') as file:
-                                            file.write(author_name + '\n')
-
-                                        with open(commit_date_file_path, 'a') as file:
-                                            file.write(commit_date + '\n')
-
-                                        with open(commit_id_file_path, 'a') as file:
-                                            file.write(commit_id + '\n')
-
-                                        with open(repository_file_path, 'a') as file:
-                                            file.write(repository + '\n')
-                                    else:
-                                        print("Empty message encountered.")       
-
-                                    seen_commit_ids.add(commit_id)
-                                    
-
-                            else:
-                                if commit_id not in seen_commit_ids:
-                                    author_name = author_data["author"]["raw"]
-                                    commit_date = author_data["date"]
-                                    commit_id = author_data["hash"]
-                                    message = author_data["message"].strip()
-                                    repository = author_data["repository"]["name"]
-                                    if message:
-                                        message = message.replace('\n', '')
-                                        message_list.append(message)
-                                        author_name_list.append(author_name)
-                                        commit_date_list.append(commit_date)
-                                        commit_id_list.append(commit_id)
-                                        repository_list.append(repository)
-                                        with open(message_file_path, 'a', encoding='utf-8') as file:
-                                            file.write(message + '\n')
-
-                                        with open(author_file_path, 'a') as file:
-                                            file.write(author_name + '\n')
-
-                                        with open(commit_date_file_path, 'a') as file:
-                                            file.write(commit_date + '\n')
-
-                                        with open(commit_id_file_path, 'a') as file:
-                                            file.write(commit_id + '\n')
-
-                                        with open(repository_file_path, 'a') as file:
-                                            file.write(repository + '\n')
-                    
-                                    else:
-                                        print("Empty message encountered.")        
-
-                                    seen_commit_ids.add(commit_id)
-                                        
-                        
-                # Carregar dados dos arquivos TXT para listas
-                with open(author_file_path, 'r') as file:
-                    author_name_list = file.read().splitlines()   
-                    # author_name_list = list(enumerate(file.read().splitlines(), start=1))
-
-                with open(commit_date_file_path, 'r') as file:
-                    commit_date_list = file.read().splitlines()
-                    # commit_date_list = list(enumerate(file.read().splitlines(), start=1))
-
-                with open(commit_id_file_path, 'r') as file:
-                    commit_id_list = file.read().splitlines()
-                    
-            ####PARA ADICIONAR ÍNDICE NOS ARQUIVOS TXT, SE NECESSÁRIO
-            # # # # # # processed_lines = []
-
-            # # # # # # with open(message_file_path, 'r') as file:
-            # # # # # #     for line in file:
-            # # # # # #         processed_lines.append([line.strip()])
-
-            # # # # # # df = pd.DataFrame(processed_lines, columns=['Coluna'])
-            # # # # # # df.to_csv(message_file_path, index=True)
-            # # # # # #     #print(df)
-                with open(message_file_path, 'r') as file:
-                    message_list = file.read().splitlines()
-                    #message_list = list(enumerate(file.read().splitlines(), start=1))
-
-                with open(repository_file_path, 'r') as file:
-                    repository_list = file.read().splitlines()
-                    # repository_list = list(enumerate(file.read().splitlines(), start=1))
-
-                                
-            print(len(author_name_list))
-            print(len(commit_date_list))
-            print(len(commit_id_list))
-            print(len(message_list))
-            print(len(repository_list))
-
-
-        result_all = {
-        "commit_message": message_list,
-        "author": author_name_list,
-        "repository": repository_list,
-        "created_at": commit_date_list,
-        "commit_id": commit_id_list
+    def branch_commits_url(self, branch, page=1, page_size=10):
+        return f"{self.api_base_url}/{self.workspace}/{self.repo}/commits/{branch}?page={page}&pagelen={page_size}"
+
+    def list_branch_commits(self, branch, page=1, page_size=10):
+        """List the commits reachable from a branch, as Bitbucket commit objects."""
+        commits, _ = self.list_branch_commits_page(self.branch_commits_url(branch, page, page_size))
+        return commits
+
+    def list_branch_commits_page(self, url):
+        """List the commits of a page url of a branch, with the url of the next page."""
+        return self._get_page(url, "commits")
 
+    def mtr_record(self, commit):
+        """Convert a Bitbucket commit object into a bb_mtr record, None when its message is empty."""
+        message = commit["message"].strip().replace("\n", "")
+        if not message:
+            print("Empty message encountered.")
+            return None
+
+        author = commit["author"]
+        if "user" in author:
+            author_name = author["user"]["display_name"]
+        else:
+            author_name = author["raw"]
+
+        return {
+            "commit_message": message,
+            "author": author_name,
+            "repository": commit["repository"]["name"],
+            "created_at": commit["date"],
+            "commit_id": commit["hash"],
         }
-        
-
-
-        # Limpar o conteúdo de cada arquivo
-        with open(author_file_path, 'w') as file:
-            file.truncate(0)
-        with open(commit_date_file_path, 'w') as file:
-            file.truncate(0)
-            
-        with open(commit_id_file_path, 'w') as file:
-            file.truncate(0)
-            
-        with open(message_file_path, 'w') as file:
-            file.truncate(0)
-
-        with open(repository_file_path, 'w') as file:
-            file.truncate(0)
-                
-                
-
-        return result_all
\ No newline at end of file
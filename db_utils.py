@@ -1,29 +1,243 @@
+import contextvars
+import functools
+import json
 import logging
-import pandas as pd
+import threading
+import weakref
+from contextlib import contextmanager
 import sqlalchemy as db
 from sqlalchemy import text
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
-from datetime import datetime
-from generic_utils import date_to_iso_seconds
+from datetime import date, datetime, timedelta, timezone
+from generic_utils import LazyModule, date_to_iso_seconds, mtr_task_name, parse_timezone
+from metrics import instrument_engine
+from query_profiler import profile_engine
 
-logger = logging.getLogger()
+# pandas (and numpy) is imported by the first query, not when workers boot
+pd = LazyModule("pandas")
 
+logger = logging.getLogger()
 
-def connect_db(db_host, db_port, db_user, db_pswd, db_name):
-    db_uri = f"postgresql+psycopg2://{db_user}:{db_pswd}@{db_host}/{db_name}?sslmode=require"
-    engine = db.create_engine(db_uri, echo=False)
+# Keeps the bb_commits rows on the :branch parameter, or all of them when it is NULL
+BRANCH_FILTER = """(CAST(:branch AS TEXT) IS NULL OR EXISTS (
+                SELECT 1
+                FROM bb_commit_branches
+                WHERE bb_commit_branches.repo = bb_commits.repo
+                    AND bb_commit_branches.branch = :branch
+                    AND bb_commit_branches.commit_id = bb_commits.id
+            ))"""
+
+# Keeps the bb_commits rows created in [:since, :until), either bound may be NULL.
+# created_at_ts is indexed, created_at is only the ISO string.
+TIME_RANGE_FILTER = """(CAST(:since AS TIMESTAMPTZ) IS NULL OR created_at_ts >= :since)
+            AND (CAST(:until AS TIMESTAMPTZ) IS NULL OR created_at_ts < :until)"""
+
+
+def connect_db(
+    db_host,
+    db_port,
+    db_user,
+    db_pswd,
+    db_name,
+    db_sslmode="require",
+    pool_size=5,
+    max_overflow=10,
+    pool_timeout=30,
+):
+    db_address = f"{db_host}:{db_port}" if db_port else db_host
+    db_uri = f"postgresql+psycopg2://{db_user}:{db_pswd}@{db_address}/{db_name}?sslmode={db_sslmode}"
+    # Each thread or greenlet checks out its own connection for the duration of a
+    # transaction; pool_size + max_overflow bounds the connections of the process
+    engine = db.create_engine(
+        db_uri,
+        echo=False,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_pre_ping=True,
+    )
+    instrument_engine(engine)
+    profile_engine(engine)
     return engine
 
 
+@contextmanager
+def transaction(bind):
+    """Begin a transaction on an engine, or join the one a connection is already in.
+
+    Lets a caller write several batches (and their sync checkpoint) atomically
+    by passing its connection instead of the engine.
+    """
+    if isinstance(bind, db.engine.Connection):
+        yield bind
+    else:
+        with bind.begin() as conn:
+            yield conn
+
+
+# Primary engine -> engine of its read replica, see attach_read_engine
+_read_engines = weakref.WeakKeyDictionary()
+# True while the query_* functions must read from the primary
+_read_primary = contextvars.ContextVar("read_primary", default=False)
+
+
+def attach_read_engine(engine, read_engine):
+    """Send the reads made through engine (the query_* functions) to read_engine, e.g. a replica."""
+    _read_engines[engine] = read_engine
+
+
+def set_read_from_primary(value):
+    """Make the query_* functions of the current request (context) read from the primary.
+
+    Replicas lag behind, this lets a client that just synced read its own
+    writes. Returns a token for reset_read_from_primary.
+    """
+    return _read_primary.set(value)
+
+
+def reset_read_from_primary(token):
+    _read_primary.reset(token)
+
+
+def read_bind(bind):
+    # Connections are kept as given, their transaction may hold writes of the caller
+    if _read_primary.get() or not isinstance(bind, db.engine.Engine):
+        return bind
+    return _read_engines.get(bind, bind)
+
+
+def read_query(func):
+    """Run a query function on the read engine attached to its engine argument, if any.
+
+    Queries backing the syncs and the job queue are not decorated, they must
+    see the writes made just before them.
+    """
+
+    @functools.wraps(func)
+    def wrapper(engine, *args, **kwargs):
+        return func(read_bind(engine), *args, **kwargs)
+
+    return wrapper
+
+
+# Partitioned tables -> names of their partitions, looked up once per process.
+# postgresql-db_v1.4.sql partitions bb_commits and bb_mtr by month on created_at_ts.
+_partitions = None
+_partitions_lock = threading.Lock()
+
+
+def _load_partitions(bind, refresh=False):
+    global _partitions
+    with _partitions_lock:
+        if _partitions is None or refresh:
+            sql = """
+                SELECT parent.relname AS parent, child.relname AS child
+                FROM pg_partitioned_table
+                JOIN pg_class AS parent ON parent.oid = pg_partitioned_table.partrelid
+                LEFT JOIN pg_inherits ON pg_inherits.inhparent = parent.oid
+                LEFT JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid;
+            """
+            partitions = {}
+            with transaction(bind) as conn:
+                rows = conn.execute(text(sql)).fetchall()
+            for parent, child in rows:
+                partitions.setdefault(parent, set())
+                if child is not None:
+                    partitions[parent].add(child)
+            _partitions = partitions
+        return _partitions
+
+
+def is_partitioned(conn, table_name):
+    return table_name in _load_partitions(conn)
+
+
+def month_partition_name(table_name, day):
+    # Same naming as bb_create_month_partition
+    return f"{table_name}_y{day.year:04d}m{day.month:02d}"
+
+
+def ensure_month_partitions(engine, table_name, timestamps):
+    """Create the monthly partitions the timestamps fall in, when table_name is partitioned.
+
+    Runs in a transaction of its own, so a partition is never rolled back with
+    the batch that needed it while this process remembers it as created.
+    """
+    engine = engine.engine
+    partitions = _load_partitions(engine)
+    if table_name not in partitions:
+        return 0
+
+    # Partitions are UTC months, like CAST(created_at_ts AT TIME ZONE 'UTC' AS DATE)
+    months = set()
+    for timestamp in timestamps:
+        timestamp = timestamp.astimezone(timezone.utc)
+        months.add(date(timestamp.year, timestamp.month, 1))
+
+    def missing_months():
+        return sorted(
+            month for month in months if month_partition_name(table_name, month) not in partitions[table_name]
+        )
+
+    missing = missing_months()
+    if len(missing) == 0:
+        return 0
+
+    # Another process (usually create_upcoming_partitions) may have created them
+    partitions = _load_partitions(engine, refresh=True)
+    missing = missing_months()
+    if len(missing) == 0:
+        return 0
+
+    with engine.begin() as conn:
+        for month in missing:
+            conn.execute(
+                text("SELECT bb_create_month_partition(:table_name, :month)"),
+                {"table_name": table_name, "month": month},
+            )
+
+    with _partitions_lock:
+        partitions[table_name].update(month_partition_name(table_name, month) for month in missing)
+
+    print(f"Created {len(missing)} partitions of {table_name}")
+    return len(missing)
+
+
+def create_upcoming_partitions(engine, months_ahead):
+    """Create the partitions of this month and the next months_ahead ones, of every partitioned table.
+
+    Creating a partition locks its parent table until the transaction ends,
+    run ahead of time it does not queue behind (and block) the readers of the
+    ingest path. Returns the number of partitions created.
+    """
+    today = datetime.now(timezone.utc)
+    months = []
+    for i in range(months_ahead + 1):
+        year, month = divmod(today.month - 1 + i, 12)
+        months.append(datetime(today.year + year, month + 1, 1, tzinfo=timezone.utc))
+
+    count = 0
+    for table_name in ("bb_commits", "bb_mtr"):
+        count += ensure_month_partitions(engine, table_name, months)
+
+    return count
+
+
+# Primary key of bb_pullrequests, Bitbucket numbers pull requests per repository
+PULLREQUEST_KEY = ["repo", "id"]
+
+
 def handle_conflict(table, conn, keys, data_iter):
     insert_stmt = insert(table.table).values(list(data_iter))
-    do_nothing_stmt = insert_stmt.on_conflict_do_nothing(index_elements=["id"])
-    conn.execute(do_nothing_stmt)
+    do_nothing_stmt = insert_stmt.on_conflict_do_nothing(index_elements=PULLREQUEST_KEY)
+    result = conn.execute(do_nothing_stmt)
+    return result.rowcount
 
 
 def append_records(engine, df, chunk_size, table_name):
-    df.to_sql(
+    # Returns the number of rows actually inserted
+    return df.to_sql(
         con=engine,
         name=table_name,
         if_exists="append",
@@ -33,16 +247,324 @@ def append_records(engine, df, chunk_size, table_name):
     )
 
 
+def handle_upsert(table, conn, keys, data_iter):
+    # Overwrite existing rows, but only with a more recent version of them
+    insert_stmt = insert(table.table).values(list(data_iter))
+    update_columns = {
+        column.name: insert_stmt.excluded[column.name]
+        for column in table.table.columns
+        if column.name not in PULLREQUEST_KEY
+    }
+    upsert_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=PULLREQUEST_KEY,
+        set_=update_columns,
+        where=table.table.c.updated_at < insert_stmt.excluded.updated_at,
+    )
+    result = conn.execute(upsert_stmt)
+    return result.rowcount
+
+
+def upsert_records(engine, df, chunk_size, table_name):
+    # Returns the number of rows inserted or updated
+    return df.to_sql(
+        con=engine,
+        name=table_name,
+        if_exists="append",
+        index=False,
+        chunksize=chunk_size,
+        method=handle_upsert,
+    )
+
+
 def append_commits(engine, df, chunk_size):
     table_name = "bb_commits"
-    append_records(engine, df, chunk_size, table_name)
+    # created_at_ts is the partition key, rows are routed before the trigger could set it
+    df = df.assign(created_at_ts=pd.to_datetime(df["created_at"], utc=True, format="ISO8601"))
+    ensure_month_partitions(engine, table_name, df["created_at_ts"])
+
+    # Returns the number of rows actually inserted
+    return df.to_sql(
+        con=engine,
+        name=table_name,
+        if_exists="append",
+        index=False,
+        chunksize=chunk_size,
+        method=handle_commit_conflict,
+    )
+
+
+def handle_commit_conflict(table, conn, keys, data_iter):
+    insert_stmt = insert(table.table).values(list(data_iter))
+    # Unique constraints of a partitioned table include its partition key
+    index_elements = ["id", "created_at_ts"] if is_partitioned(conn, "bb_commits") else ["id"]
+    do_nothing_stmt = insert_stmt.on_conflict_do_nothing(
+        index_elements=index_elements
+    ).returning(
+        table.table.c.author,
+        table.table.c.author_id,
+        table.table.c.repo,
+        table.table.c.created_at,
+    )
+    result = conn.execute(do_nothing_stmt)
+    records = result.fetchall()
+
+    # Only commits that were not in bb_commits yet are added to the daily rollup
+    update_commit_daily(conn, records)
+
+    return len(records)
+
+
+def update_commit_daily(conn, records):
+    sql = """
+        INSERT INTO bb_commit_daily(author_id, day, repo, author, commit_count)
+        VALUES(:author_id, :day, :repo, :author, :commit_count)
+        ON CONFLICT (author_id, day, repo) DO
+        UPDATE SET
+            author = EXCLUDED.author,
+            commit_count = bb_commit_daily.commit_count + EXCLUDED.commit_count;
+    """
+
+    rollup = {}
+    for author, author_id, repo, created_at in records:
+        # Days are UTC, like CAST(created_at_ts AT TIME ZONE 'UTC' AS DATE)
+        created_at = datetime.fromisoformat(created_at)
+        if created_at.tzinfo is not None:
+            created_at = created_at.astimezone(timezone.utc)
+
+        key = (author_id or author, created_at.date(), repo)
+        entry = rollup.get(key)
+        if entry is None:
+            entry = {
+                "author_id": key[0],
+                "day": key[1],
+                "repo": repo,
+                "author": author,
+                "commit_count": 0,
+            }
+            rollup[key] = entry
+        entry["commit_count"] += 1
+
+    if len(rollup) == 0:
+        return
+
+    conn.execute(text(sql), list(rollup.values()))
+
+
+def update_commit_daily_lines(conn, commit_ids):
+    # Recompute the line totals of the days these commits belong to from bb_commit_churn,
+    # which is upserted, so adding deltas would count re-parsed commits twice
+    sql = """
+        WITH groups AS (
+            SELECT DISTINCT author_id, repo, CAST(created_at AT TIME ZONE 'UTC' AS DATE) AS day
+            FROM bb_commit_churn
+            WHERE commit_id = ANY(:commit_ids)
+        ),
+        totals AS (
+            SELECT
+                groups.author_id,
+                groups.repo,
+                groups.day,
+                SUM(churn.lines_added) AS lines_added,
+                SUM(churn.lines_removed) AS lines_removed
+            FROM groups
+            JOIN bb_commit_churn AS churn
+                ON churn.author_id = groups.author_id
+                AND churn.repo = groups.repo
+                AND churn.created_at >= CAST(groups.day AS TIMESTAMP) AT TIME ZONE 'UTC'
+                AND churn.created_at < CAST(groups.day + 1 AS TIMESTAMP) AT TIME ZONE 'UTC'
+            GROUP BY groups.author_id, groups.repo, groups.day
+        )
+        UPDATE bb_commit_daily
+        SET lines_added = totals.lines_added, lines_removed = totals.lines_removed
+        FROM totals
+        WHERE bb_commit_daily.author_id = totals.author_id
+            AND bb_commit_daily.repo = totals.repo
+            AND bb_commit_daily.day = totals.day;
+    """
+
+    if len(commit_ids) == 0:
+        return
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(commit_ids=list(commit_ids))
+    conn.execute(stmt)
+
+
+def rebuild_commit_daily(engine):
+    # Recompute the whole daily rollup from bb_commits and bb_commit_churn (used to backfill)
+    sql = """
+        INSERT INTO bb_commit_daily(
+            author_id, day, repo, author, commit_count, lines_added, lines_removed
+        )
+        SELECT
+            COALESCE(commits.author_id, commits.author),
+            CAST(commits.created_at_ts AT TIME ZONE 'UTC' AS DATE),
+            commits.repo,
+            MAX(commits.author),
+            COUNT(*),
+            COALESCE(SUM(churn.lines_added), 0),
+            COALESCE(SUM(churn.lines_removed), 0)
+        FROM bb_commits AS commits
+        LEFT JOIN (
+            SELECT commit_id, SUM(lines_added) AS lines_added, SUM(lines_removed) AS lines_removed
+            FROM bb_commit_churn
+            GROUP BY commit_id
+        ) AS churn ON churn.commit_id = commits.id
+        WHERE commits.created_at_ts IS NOT NULL
+        GROUP BY 1, 2, 3;
+    """
+
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM bb_commit_daily;"))
+        result = conn.execute(text(sql))
+
+    print(f"Rebuilt daily commit rollup: {result.rowcount} rows")
+    return result.rowcount
+
+
+@read_query
+def query_commit_daily(engine, group_by, author_id=None, repo=None, since=None, until=None):
+    # Commits and lines per UTC day, for one author, one repo or everyone
+    group_columns = {
+        "day": "day",
+        "author": "day, author_id, author",
+        "repo": "day, repo",
+    }
+    if group_by not in group_columns:
+        raise ValueError(f"Cannot group daily commits by {group_by}")
+
+    sql = f"""
+        SELECT
+            {group_columns[group_by]},
+            SUM(commit_count) AS commit_count,
+            SUM(lines_added) AS lines_added,
+            SUM(lines_removed) AS lines_removed
+        FROM bb_commit_daily
+        WHERE (CAST(:author_id AS TEXT) IS NULL OR author_id = :author_id OR author = :author_id)
+            AND (CAST(:repo AS TEXT) IS NULL OR repo = :repo)
+            AND (CAST(:since AS DATE) IS NULL OR day >= :since)
+            AND (CAST(:until AS DATE) IS NULL OR day < :until)
+        GROUP BY {group_columns[group_by]}
+        ORDER BY {group_columns[group_by]};
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(author_id=author_id, repo=repo, since=since, until=until)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records, columns=list(result.keys()))
+
+    return df
 
 
 def append_pullrequests(engine, df, chunk_size):
     table_name = "bb_pullrequests"
-    append_records(engine, df, chunk_size, table_name)
+    return append_records(engine, df, chunk_size, table_name)
+
+
+def upsert_pullrequests(engine, df, chunk_size):
+    table_name = "bb_pullrequests"
+    return upsert_records(engine, df, chunk_size, table_name)
 
 
+def append_pullrequest_states(engine, records):
+    # Only record a row when the pull request is new or its state changed since the last one
+    sql = """
+        INSERT INTO bb_pullrequest_states(
+            repo, pullrequest_id, state, changed_at, author, author_id, pr_created_at
+        )
+        SELECT
+            :repo, :id, :state, CAST(:updated_at AS TIMESTAMPTZ),
+            :author, :author_id, CAST(:created_at AS TIMESTAMPTZ)
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM (
+                SELECT state
+                FROM bb_pullrequest_states
+                WHERE repo = :repo AND pullrequest_id = :id
+                ORDER BY changed_at DESC
+                LIMIT 1
+            ) AS last_state
+            WHERE last_state.state = :state
+        )
+        ON CONFLICT DO NOTHING;
+    """
+
+    if len(records) == 0:
+        return
+
+    records = [
+        {
+            "repo": record["repo"],
+            "id": str(record["id"]),
+            "state": record["state"],
+            "updated_at": record["updated_at"],
+            "author": record["author"],
+            "author_id": record["author_id"],
+            "created_at": record["created_at"],
+        }
+        for record in records
+    ]
+
+    with transaction(engine) as conn:
+        conn.execute(text(sql), records)
+
+
+def append_commit_branches(engine, records):
+    # Records are {"commit_id", "repo", "branch"}. A single statement over
+    # arrays, so the rowcount is the exact number of new mappings.
+    sql = """
+        INSERT INTO bb_commit_branches(repo, branch, commit_id)
+        SELECT * FROM UNNEST(
+            CAST(:repos AS TEXT[]), CAST(:branches AS TEXT[]), CAST(:commit_ids AS TEXT[])
+        )
+        ON CONFLICT DO NOTHING;
+    """
+
+    if len(records) == 0:
+        return 0
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(
+        repos=[record["repo"] for record in records],
+        branches=[record["branch"] for record in records],
+        commit_ids=[record["commit_id"] for record in records],
+    )
+    with transaction(engine) as conn:
+        result = conn.execute(stmt)
+
+    return result.rowcount
+
+
+@read_query
+def query_commit_branches(engine, commit_id):
+    sql = """
+        SELECT repo, branch, first_seen_at
+        FROM bb_commit_branches
+        WHERE commit_id = :commit_id
+        ORDER BY repo, branch;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(commit_id=commit_id)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+@read_query
 def query_authors(engine):
     sql = """
         SELECT author_id, author, count(*) as commits
@@ -70,6 +592,7 @@ def query_authors(engine):
     return df
 
 
+@read_query
 def query_author_repos(engine, author_id):
     sql = """
         SELECT repo, count(*) as commits
@@ -91,6 +614,7 @@ def query_author_repos(engine, author_id):
 
     return df
 
+@read_query
 def query_repos(engine):
     sql = """
         SELECT repo, count(*) as commits
@@ -110,21 +634,26 @@ def query_repos(engine):
 
     return df
 
-def query_author_commits(engine, author_id):
-    sql = """
+@read_query
+def query_author_commits(engine, author_id, branch=None, since=None, until=None):
+    # Only the commits known to be on the branch when one is given
+    sql = f"""
         SELECT 
             author,
             author_id,
-            branch,
+            COALESCE(CAST(:branch AS TEXT), branch) AS branch,
             created_at,
             id,
             repo 
         FROM bb_commits
-        WHERE author_id = :author_id OR author= :author_id;
+        WHERE (author_id = :author_id OR author= :author_id)
+            AND {TIME_RANGE_FILTER}
+            AND {BRANCH_FILTER}
+        ORDER BY created_at_ts;
     """
 
     stmt = text(sql)
-    stmt = stmt.bindparams(author_id=author_id)
+    stmt = stmt.bindparams(author_id=author_id, branch=branch, since=since, until=until)
     with engine.begin() as conn:
         result = conn.execute(stmt)
 
@@ -132,17 +661,16 @@ def query_author_commits(engine, author_id):
     for record in result:
         records.append(record)
 
-    df = pd.DataFrame(records)
-
-    # Sort by date (chronologically)
-    df.sort_values(by="created_at", inplace=True, ascending=True)
+    # Keep the columns when no commit matches, e.g. on an unknown branch
+    df = pd.DataFrame(records, columns=list(result.keys()))
 
     return df
 
 
+@read_query
 def query_author_pullrequests(engine, author):
     sql = """
-        SELECT * 
+        SELECT id, title, description, state, author, author_id, repo, created_at, updated_at, branch
         FROM bb_pullrequests
         WHERE author = :author;
     """
@@ -161,8 +689,9 @@ def query_author_pullrequests(engine, author):
     return df
 
 
-def query_unprocessed_commits(engine):
-    # Get all commits that have not been processed yet
+def query_unprocessed_commits(engine, repo=None, diffstat=False):
+    # Get all commits that have not been processed yet, optionally for one repo.
+    # With diffstat, commits whose churn came from the diffstat endpoint are done too.
     sql = """
         SELECT
             id,
@@ -170,11 +699,15 @@ def query_unprocessed_commits(engine):
         FROM
             bb_commits
         WHERE
-            diff IS NULL;
+            diff IS NULL
+            AND (NOT :diffstat OR diffstat_synced_at IS NULL)
+            AND (CAST(:repo AS VARCHAR) IS NULL OR repo = :repo);
     """
 
+    stmt = text(sql)
+    stmt = stmt.bindparams(repo=repo, diffstat=diffstat)
     with engine.begin() as conn:
-        result = conn.execute(text(sql))
+        result = conn.execute(stmt)
 
     records = []
     for record in result:
@@ -194,7 +727,7 @@ def update_commit_diff(engine, commit_id, diff):
 
     stmt = text(sql)
     stmt = stmt.bindparams(commit_id=commit_id, diff=diff)
-    with engine.begin() as conn:
+    with transaction(engine) as conn:
         result = conn.execute(stmt)
 
     if result.rowcount > 0:
@@ -204,11 +737,111 @@ def update_commit_diff(engine, commit_id, diff):
     return False
 
 
+def append_commit_churn(engine, commit_id, files):
+    return append_churn(engine, [(commit_id, files)])
+
+
+def update_commit_diffstat(engine, commit_id, files):
+    # Record the churn without the diff text, and mark the commit so it is not fetched again
+    sql = """
+        UPDATE bb_commits
+        SET diffstat_synced_at = NOW()
+        WHERE id = :commit_id;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(commit_id=commit_id)
+    with transaction(engine) as conn:
+        count = append_churn(conn, [(commit_id, files)])
+        conn.execute(stmt)
+
+    return count
+
+
+def append_churn(engine, parsed_commits):
+    # Author, repo and date are copied from the commit so churn queries never touch bb_commits
+    sql = """
+        INSERT INTO bb_commit_churn(
+            commit_id, path, repo, author, author_id, created_at,
+            lines_added, lines_removed, is_binary
+        )
+        SELECT
+            id, :path, repo, author, author_id, CAST(created_at AS TIMESTAMPTZ),
+            :lines_added, :lines_removed, :is_binary
+        FROM bb_commits
+        WHERE id = :commit_id
+        ON CONFLICT (commit_id, path) DO
+        UPDATE SET
+            lines_added = EXCLUDED.lines_added,
+            lines_removed = EXCLUDED.lines_removed,
+            is_binary = EXCLUDED.is_binary;
+    """
+
+    records = []
+    for commit_id, files in parsed_commits:
+        for diff_file in files:
+            if diff_file["file_name"] is None:
+                continue
+            records.append(
+                {
+                    "commit_id": commit_id,
+                    "path": diff_file["file_name"],
+                    "lines_added": diff_file["added"],
+                    "lines_removed": diff_file["removed"],
+                    "is_binary": diff_file["binary"],
+                }
+            )
+
+    if len(records) == 0:
+        return 0
+
+    with transaction(engine) as conn:
+        conn.execute(text(sql), records)
+        update_commit_daily_lines(conn, {record["commit_id"] for record in records})
+
+    return len(records)
+
+
+def query_commit_diffs_after(engine, after_id, limit, missing_churn=True):
+    # Keyset pagination over commits that have a diff, ordered by id
+    sql = """
+        SELECT
+            c.id,
+            c.diff
+        FROM
+            bb_commits c
+        WHERE
+            c.diff IS NOT NULL
+            AND c.id > :after_id
+            AND (
+                NOT :missing_churn
+                OR NOT EXISTS (SELECT 1 FROM bb_commit_churn cc WHERE cc.commit_id = c.id)
+            )
+        ORDER BY c.id
+        LIMIT :limit;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(after_id=after_id, limit=limit, missing_churn=missing_churn)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+@read_query
 def query_commit(engine, commit_id):
     # Get commit details
     sql = """
         SELECT
-            diff
+            diff,
+            repo
         FROM
             bb_commits
         WHERE
@@ -229,7 +862,8 @@ def query_commit(engine, commit_id):
     return df
 
 
-def insert_sync_history(engine, table_name, repo):
+def insert_sync_history(engine, table_name, repo, updated_at=None):
+    # updated_at defaults to now, but can be a watermark taken from the synced records
     sql = """
         INSERT INTO bb_sync_history(tbl, repo, updated_at)
         VALUES(:table_name, :repo, :updated_at)
@@ -238,12 +872,15 @@ def insert_sync_history(engine, table_name, repo):
     """
     print(f"Inserting sync history for {repo}...")
 
-    now = datetime.now()
-    dt = date_to_iso_seconds(now)
+    if updated_at is None:
+        now = datetime.now()
+        dt = date_to_iso_seconds(now)
+    else:
+        dt = updated_at
 
     stmt = text(sql)
     stmt = stmt.bindparams(table_name=table_name, repo=repo, updated_at=dt)
-    with engine.begin() as conn:
+    with transaction(engine) as conn:
         result = conn.execute(stmt)
 
     if result.rowcount > 0:
@@ -275,19 +912,90 @@ def query_sync_history(engine, table_name, repo):
     return df
 
 
-def query_diffs_by_author(engine, author):
-    # Get commit details for a specific author
+def save_sync_checkpoint(engine, table_name, repo, branch="", next_page=None, last_id=None, watermark=None):
+    # Pass the connection that wrote the batch, so the checkpoint never runs ahead of the data
+    sql = """
+        INSERT INTO bb_sync_checkpoints(tbl, repo, branch, next_page, last_id, watermark, updated_at)
+        VALUES(:table_name, :repo, :branch, :next_page, :last_id, :watermark, NOW())
+        ON CONFLICT (tbl, repo, branch) DO
+        UPDATE SET
+            next_page = EXCLUDED.next_page,
+            last_id = EXCLUDED.last_id,
+            watermark = EXCLUDED.watermark,
+            updated_at = EXCLUDED.updated_at;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(
+        table_name=table_name,
+        repo=repo,
+        branch=branch,
+        next_page=None if next_page is None else str(next_page),
+        last_id=last_id,
+        watermark=watermark,
+    )
+    with transaction(engine) as conn:
+        conn.execute(stmt)
+
+
+def query_sync_checkpoints(engine, table_name, repo):
+    # Checkpoints left by an interrupted sync of the repo, one per branch ("" when not per branch)
+    sql = """
+        SELECT
+            branch,
+            next_page,
+            last_id,
+            watermark,
+            updated_at
+        FROM bb_sync_checkpoints
+        WHERE tbl = :table_name AND repo = :repo;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(table_name=table_name, repo=repo)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records, columns=list(result.keys()))
+
+    return df
+
+
+def delete_sync_checkpoints(engine, table_name, repo):
+    # Called when the sync of the repo completed, the next one starts from the beginning
+    sql = """
+        DELETE FROM bb_sync_checkpoints
+        WHERE tbl = :table_name AND repo = :repo;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(table_name=table_name, repo=repo)
+    with transaction(engine) as conn:
+        conn.execute(stmt)
+
+
+@read_query
+def query_diffs_by_author(engine, author, limit=None, offset=0):
+    # Get the synced diffs of a specific author, most recent first
     sql = """
         SELECT
+            id,
             diff
         FROM
             bb_commits
         WHERE
-            author = :author;
+            author = :author
+            AND diff IS NOT NULL
+        ORDER BY created_at DESC, id
+        LIMIT :limit OFFSET :offset;
     """
 
     stmt = text(sql)
-    stmt = stmt.bindparams(author=author)
+    stmt = stmt.bindparams(author=author, limit=limit, offset=offset)
     with engine.begin() as conn:
         result = conn.execute(stmt)
 
@@ -300,17 +1008,20 @@ def query_diffs_by_author(engine, author):
     return df
 
 
-def query_all_commits(engine):
+@read_query
+def query_all_commits(engine, since=None, until=None):
     # Get all commit details
-    sql = """
+    sql = f"""
         SELECT
             id,
             created_at
         FROM
-            bb_commits;
+            bb_commits
+        WHERE {TIME_RANGE_FILTER};
     """
 
     stmt = text(sql)
+    stmt = stmt.bindparams(since=since, until=until)
     with engine.begin() as conn:
         result = conn.execute(stmt)
 
@@ -318,52 +1029,64 @@ def query_all_commits(engine):
     for record in result:
         records.append(record)
 
-    df = pd.DataFrame(records)
+    df = pd.DataFrame(records, columns=list(result.keys()))
 
     return df
 
 
-def query_all_repo_commits(engine, repo_name):
-    sql = """
+@read_query
+def query_all_repo_commits(engine, repo_name, since=None, until=None):
+    # repo_name is the full "workspace/slug" name, or only the slug
+    sql = f"""
         SELECT
             id,
             created_at
         FROM
             bb_commits
         WHERE
-            repo = :repo_name;
+            (repo = :repo_name OR SPLIT_PART(repo, '/', 2) = :repo_name)
+            AND {TIME_RANGE_FILTER};
     """
 
     stmt = text(sql)
-    stmt = stmt.bindparams(repo_name=repo_name)
+    stmt = stmt.bindparams(repo_name=repo_name, since=since, until=until)
     with engine.begin() as conn:
         result = conn.execute(stmt)
 
     records = []
     for record in result:
-        records.append({"commit_id": record.id, "diff": record.diff})
+        records.append(record)
 
-    df = pd.DataFrame(records)
+    df = pd.DataFrame(records, columns=list(result.keys()))
 
     return df
 
-def query_commits_by_day_and_author(engine, author_id, date):
+@read_query
+def query_commits_by_day_and_author(engine, author_id, date, branch=None, tz="UTC"):
+    # The day is the range between two midnights in tz, so the index can be used
+    day = datetime.fromisoformat(date).date()
+    zone = parse_timezone(tz)
+    since = datetime.combine(day, datetime.min.time(), zone)
+    until = datetime.combine(day + timedelta(days=1), datetime.min.time(), zone)
+
     # Obtém os commits do banco de dados
-    sql = """
+    sql = f"""
         SELECT 
             author,
             author_id,
-            branch,
+            COALESCE(CAST(:branch AS TEXT), branch) AS branch,
             created_at,
             id,
             repo 
         FROM bb_commits
         WHERE (author_id = :author_id OR author = :author_id)
-            AND DATE(created_at) = :date;
+            AND {TIME_RANGE_FILTER}
+            AND {BRANCH_FILTER}
+        ORDER BY created_at_ts;
     """
 
     stmt = text(sql)
-    stmt = stmt.bindparams(author_id=author_id, date=date)
+    stmt = stmt.bindparams(author_id=author_id, branch=branch, since=since, until=until)
 
     with engine.begin() as conn:
         result = conn.execute(stmt)
@@ -372,25 +1095,33 @@ def query_commits_by_day_and_author(engine, author_id, date):
     for record in result:
         records.append(record)
 
-    df = pd.DataFrame(records)
+    df = pd.DataFrame(records, columns=list(result.keys()))
 
     return df
 
 
 
-def query_all_commit_count_by_day_and_author(engine, author_id):
-    # Obtém os commits do banco de dados
-    sql = """
+@read_query
+def query_all_commit_count_by_day_and_author(
+    engine, author_id, branch=None, since=None, until=None, tz="UTC"
+):
+    # Days are counted in the tz time zone
+    sql = f"""
         SELECT 
-            DATE(created_at) as date,
+            DATE(created_at_ts AT TIME ZONE :tz) as date,
             COUNT(*) as commit_count
         FROM bb_commits
         WHERE (author_id = :author_id OR author = :author_id)
-        GROUP BY date;
+            AND {TIME_RANGE_FILTER}
+            AND {BRANCH_FILTER}
+        GROUP BY date
+        ORDER BY date;
     """
 
     stmt = text(sql)
-    stmt = stmt.bindparams(author_id=author_id)
+    stmt = stmt.bindparams(
+        author_id=author_id, branch=branch, since=since, until=until, tz=tz
+    )
 
     with engine.begin() as conn:
         result = conn.execute(stmt)
@@ -403,9 +1134,10 @@ def query_all_commit_count_by_day_and_author(engine, author_id):
 
     return df
 
+@read_query
 def query_all_pullrequests(engine):
     sql = """
-        SELECT * 
+        SELECT id, title, description, state, author, author_id, repo, created_at, updated_at, branch
         FROM bb_pullrequests;
     """
 
@@ -423,9 +1155,10 @@ def query_all_pullrequests(engine):
     return df
 
 
+@read_query
 def query_last_author_pullrequest(engine, author_id):
     sql = """
-        SELECT * 
+        SELECT id, title, description, state, author, author_id, repo, created_at, updated_at, branch
         FROM bb_pullrequests
         WHERE (author_id = :author_id OR author = :author_id);
     """
@@ -443,9 +1176,10 @@ def query_last_author_pullrequest(engine, author_id):
 
     return df
 
+@read_query
 def query_last_pullrequest(engine):
     sql = """
-        SELECT * 
+        SELECT id, title, description, state, author, author_id, repo, created_at, updated_at, branch
         FROM bb_pullrequests;
     """
 
@@ -463,25 +1197,144 @@ def query_last_pullrequest(engine):
     return df
 
 def append_mtr_records(engine, df, chunk_size, table_name):
+    # created_at_ts is the partition key of bb_mtr once partitioned
+    df["created_at_ts"] = pd.to_datetime(df["created_at"], utc=True, format="ISO8601")
+    ensure_month_partitions(engine, table_name, df["created_at_ts"])
+
     df.set_index('commit_id', inplace=True)
     if 'id' not in df.columns:
         # Se não estiver presente, você pode adicionar uma coluna 'id' com valores únicos
         df['id'] = range(1, len(df) + 1)
 
-    df.to_sql(
+    # Returns the number of rows actually inserted
+    return df.to_sql(
         con=engine,
         name=table_name,
-        if_exists="replace",
+        if_exists="append",
         index=True,
         index_label='commit_id',
         chunksize=chunk_size,
+        method=handle_mtr_conflict,
     )
 
 def append_mtr(engine, df, chunk_size):
     table_name = "bb_mtr"
-    append_mtr_records(engine, df, chunk_size, table_name)
+    return append_mtr_records(engine, df, chunk_size, table_name)
+
+
+def handle_mtr_conflict(table, conn, keys, data_iter):
+    insert_stmt = insert(table.table).values(list(data_iter))
+    index_elements = ["commit_id", "created_at_ts"] if is_partitioned(conn, "bb_mtr") else ["commit_id"]
+    do_nothing_stmt = insert_stmt.on_conflict_do_nothing(
+        index_elements=index_elements
+    ).returning(
+        table.table.c.author,
+        table.table.c.commit_message,
+        table.table.c.created_at,
+    )
+    result = conn.execute(do_nothing_stmt)
+    records = result.fetchall()
+
+    # Only commits that were not in bb_mtr yet are added to the rollup
+    update_mtr_rollup(conn, records)
+
+    return len(records)
+
+
+def update_mtr_rollup(conn, records):
+    sql = """
+        INSERT INTO bb_mtr_rollup(
+            author, task, first_commit_at, last_commit_at,
+            commit_count, repair_hours, malformed_count
+        )
+        VALUES(
+            :author, :task, :first_commit_at, :last_commit_at,
+            :commit_count, :repair_hours, :malformed_count
+        )
+        ON CONFLICT (author, task) DO
+        UPDATE SET
+            first_commit_at = LEAST(bb_mtr_rollup.first_commit_at, EXCLUDED.first_commit_at),
+            last_commit_at = GREATEST(bb_mtr_rollup.last_commit_at, EXCLUDED.last_commit_at),
+            commit_count = bb_mtr_rollup.commit_count + EXCLUDED.commit_count,
+            repair_hours = EXTRACT(EPOCH FROM (
+                GREATEST(bb_mtr_rollup.last_commit_at, EXCLUDED.last_commit_at)
+                - LEAST(bb_mtr_rollup.first_commit_at, EXCLUDED.first_commit_at)
+            )) / 3600,
+            malformed_count = bb_mtr_rollup.malformed_count + EXCLUDED.malformed_count;
+    """
 
+    rollup = {}
+    for author, commit_message, created_at in records:
+        task = mtr_task_name(commit_message)
+        created_at = datetime.fromisoformat(created_at)
+
+        key = (author, task or "")
+        entry = rollup.get(key)
+        if entry is None:
+            entry = {
+                "author": author,
+                "task": key[1],
+                "first_commit_at": created_at,
+                "last_commit_at": created_at,
+                "commit_count": 0,
+                "malformed_count": 0,
+            }
+            rollup[key] = entry
+
+        entry["first_commit_at"] = min(entry["first_commit_at"], created_at)
+        entry["last_commit_at"] = max(entry["last_commit_at"], created_at)
+        entry["commit_count"] += 1
+        if task is None:
+            entry["malformed_count"] += 1
+
+    if len(rollup) == 0:
+        return
+
+    for entry in rollup.values():
+        elapsed = entry["last_commit_at"] - entry["first_commit_at"]
+        entry["repair_hours"] = elapsed.total_seconds() / 3600
+
+    conn.execute(text(sql), list(rollup.values()))
+
+
+def rebuild_mtr_rollup(engine):
+    # Recompute the whole rollup from bb_mtr (used to backfill existing data)
+    sql = """
+        INSERT INTO bb_mtr_rollup(
+            author, task, first_commit_at, last_commit_at,
+            commit_count, repair_hours, malformed_count
+        )
+        SELECT
+            author,
+            task,
+            MIN(created_at) AS first_commit_at,
+            MAX(created_at) AS last_commit_at,
+            COUNT(*) AS commit_count,
+            EXTRACT(EPOCH FROM (MAX(created_at) - MIN(created_at))) / 3600 AS repair_hours,
+            COUNT(*) FILTER (WHERE task = '') AS malformed_count
+        FROM (
+            SELECT
+                author,
+                CASE
+                    WHEN STRPOS(commit_message, '/') > 0
+                    THEN SPLIT_PART(commit_message, '/', 1)
+                    ELSE ''
+                END AS task,
+                CAST(created_at AS TIMESTAMPTZ) AS created_at
+            FROM bb_mtr
+        ) AS t
+        GROUP BY author, task;
+    """
 
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM bb_mtr_rollup;"))
+        result = conn.execute(text(sql))
+
+    print(f"Rebuilt MTR rollup: {result.rowcount} rows")
+    return result.rowcount
+
+
+@read_query
 def query_author_mtr(engine, author):
     sql = """
         SELECT * 
@@ -500,4 +1353,519 @@ def query_author_mtr(engine, author):
 
     df = pd.DataFrame(records)
 
-    return df
\ No newline at end of file
+    return df
+
+
+@read_query
+def query_author_mtr_rollup(engine, author):
+    sql = """
+        SELECT
+            task,
+            first_commit_at,
+            last_commit_at,
+            commit_count,
+            repair_hours,
+            malformed_count
+        FROM bb_mtr_rollup
+        WHERE author = :author
+        ORDER BY last_commit_at DESC;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(author=author)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+@read_query
+def query_team_mtr_rollup(engine):
+    sql = """
+        SELECT
+            author,
+            COUNT(*) FILTER (WHERE task <> '' AND commit_count > 1) AS repaired_tasks,
+            COALESCE(SUM(repair_hours) FILTER (WHERE task <> '' AND commit_count > 1), 0) AS repair_hours,
+            SUM(malformed_count) AS wrong_commit_message_qty
+        FROM bb_mtr_rollup
+        GROUP BY author
+        ORDER BY author;
+    """
+
+    stmt = text(sql)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+@read_query
+def query_churn_by_author(engine, since=None, until=None):
+    sql = """
+        SELECT
+            author,
+            author_id,
+            COUNT(DISTINCT commit_id) AS commits,
+            COUNT(*) AS files,
+            SUM(lines_added) AS lines_added,
+            SUM(lines_removed) AS lines_removed
+        FROM bb_commit_churn
+        WHERE (CAST(:since AS TIMESTAMPTZ) IS NULL OR created_at >= :since)
+            AND (CAST(:until AS TIMESTAMPTZ) IS NULL OR created_at < :until)
+        GROUP BY author, author_id
+        ORDER BY SUM(lines_added) + SUM(lines_removed) DESC;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(since=since, until=until)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+@read_query
+def query_churn_by_repo(engine, since=None, until=None):
+    sql = """
+        SELECT
+            repo,
+            COUNT(DISTINCT commit_id) AS commits,
+            COUNT(*) AS files,
+            SUM(lines_added) AS lines_added,
+            SUM(lines_removed) AS lines_removed
+        FROM bb_commit_churn
+        WHERE (CAST(:since AS TIMESTAMPTZ) IS NULL OR created_at >= :since)
+            AND (CAST(:until AS TIMESTAMPTZ) IS NULL OR created_at < :until)
+        GROUP BY repo
+        ORDER BY SUM(lines_added) + SUM(lines_removed) DESC;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(since=since, until=until)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+@read_query
+def query_churn_by_file(engine, repo, limit=100):
+    sql = """
+        SELECT
+            path,
+            COUNT(*) AS commits,
+            SUM(lines_added) AS lines_added,
+            SUM(lines_removed) AS lines_removed,
+            BOOL_OR(is_binary) AS is_binary
+        FROM bb_commit_churn
+        WHERE repo = :repo
+        GROUP BY path
+        ORDER BY SUM(lines_added) + SUM(lines_removed) DESC
+        LIMIT :limit;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(repo=repo, limit=limit)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+@read_query
+def query_churn_over_time(engine, interval, author_id=None, repo=None, since=None, until=None):
+    sql = """
+        SELECT
+            DATE(DATE_TRUNC(:interval, created_at)) AS date,
+            COUNT(DISTINCT commit_id) AS commits,
+            SUM(lines_added) AS lines_added,
+            SUM(lines_removed) AS lines_removed
+        FROM bb_commit_churn
+        WHERE (CAST(:author_id AS VARCHAR) IS NULL OR author_id = :author_id OR author = :author_id)
+            AND (CAST(:repo AS VARCHAR) IS NULL OR repo = :repo)
+            AND (CAST(:since AS TIMESTAMPTZ) IS NULL OR created_at >= :since)
+            AND (CAST(:until AS TIMESTAMPTZ) IS NULL OR created_at < :until)
+        GROUP BY 1
+        ORDER BY 1;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(interval=interval, author_id=author_id, repo=repo, since=since, until=until)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+def insert_job(engine, kind, params):
+    sql = """
+        INSERT INTO bb_jobs(kind, params)
+        VALUES(:kind, CAST(:params AS JSONB))
+        RETURNING id;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(kind=kind, params=json.dumps(params))
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+        job_id = result.scalar()
+
+    print(f"Enqueued {kind} job: {job_id}")
+    return job_id
+
+
+def claim_next_job(engine, stale_after_seconds):
+    # Take the oldest queued job (or one whose worker stopped reporting) without blocking other workers
+    sql = """
+        UPDATE bb_jobs
+        SET status = 'running', started_at = NOW(), updated_at = NOW()
+        WHERE id = (
+            SELECT id
+            FROM bb_jobs
+            WHERE status = 'queued'
+                OR (status = 'running' AND updated_at < NOW() - MAKE_INTERVAL(secs => :stale_after_seconds))
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, kind, params;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(stale_after_seconds=stale_after_seconds)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+        record = result.fetchone()
+
+    return record
+
+
+def update_job_progress(engine, job_id, pages_fetched, records_written, errors):
+    sql = """
+        UPDATE bb_jobs
+        SET
+            pages_fetched = :pages_fetched,
+            records_written = :records_written,
+            errors = CAST(:errors AS JSONB),
+            updated_at = NOW()
+        WHERE id = :job_id;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(
+        job_id=job_id,
+        pages_fetched=pages_fetched,
+        records_written=records_written,
+        errors=json.dumps(errors),
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt)
+
+
+def finish_job(engine, job_id, status, result=None):
+    sql = """
+        UPDATE bb_jobs
+        SET
+            status = :status,
+            result = CAST(:result AS JSONB),
+            finished_at = NOW(),
+            updated_at = NOW()
+        WHERE id = :job_id;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(job_id=job_id, status=status, result=json.dumps(result))
+    with engine.begin() as conn:
+        conn.execute(stmt)
+
+
+def query_job(engine, job_id):
+    sql = """
+        SELECT
+            id,
+            kind,
+            params,
+            status,
+            pages_fetched,
+            records_written,
+            errors,
+            result,
+            TO_CHAR(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"') AS created_at,
+            TO_CHAR(started_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"') AS started_at,
+            TO_CHAR(finished_at AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS"Z"') AS finished_at,
+            CAST(COALESCE(
+                EXTRACT(EPOCH FROM (COALESCE(finished_at, NOW()) - started_at)), 0
+            ) AS DOUBLE PRECISION) AS elapsed_seconds
+        FROM bb_jobs
+        WHERE id = :job_id;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(job_id=job_id)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+@read_query
+def query_pullrequest_cycle_time(engine, group_by, since=None, until=None):
+    # Hours from creation to merge (and to merge or decline), per author or per repository
+    group_columns = {"author": "author", "repo": "repo"}
+    if group_by not in group_columns:
+        raise ValueError(f"Cannot group pull requests by {group_by}")
+
+    sql = f"""
+        WITH pullrequests AS (
+            SELECT
+                repo,
+                pullrequest_id,
+                MIN(author) AS author,
+                MIN(pr_created_at) AS created_at,
+                MIN(changed_at) FILTER (WHERE state = 'MERGED') AS merged_at,
+                MIN(changed_at) FILTER (WHERE state <> 'OPEN') AS closed_at,
+                BOOL_OR(state = 'DECLINED') AS declined,
+                COUNT(*) FILTER (WHERE state = 'OPEN') AS opened
+            FROM bb_pullrequest_states
+            WHERE (CAST(:since AS TIMESTAMPTZ) IS NULL OR pr_created_at >= :since)
+                AND (CAST(:until AS TIMESTAMPTZ) IS NULL OR pr_created_at < :until)
+            GROUP BY repo, pullrequest_id
+        )
+        SELECT
+            {group_columns[group_by]} AS {group_by},
+            COUNT(*) AS pullrequests,
+            COUNT(merged_at) AS merged,
+            COUNT(*) FILTER (WHERE declined) AS declined,
+            COUNT(*) FILTER (WHERE opened > 1) AS reopened,
+            PERCENTILE_CONT(0.5) WITHIN GROUP (
+                ORDER BY EXTRACT(EPOCH FROM (merged_at - created_at)) / 3600
+            ) AS merge_hours_p50,
+            PERCENTILE_CONT(0.9) WITHIN GROUP (
+                ORDER BY EXTRACT(EPOCH FROM (merged_at - created_at)) / 3600
+            ) AS merge_hours_p90,
+            CAST(AVG(EXTRACT(EPOCH FROM (merged_at - created_at)) / 3600) AS DOUBLE PRECISION) AS merge_hours_avg,
+            PERCENTILE_CONT(0.5) WITHIN GROUP (
+                ORDER BY EXTRACT(EPOCH FROM (closed_at - created_at)) / 3600
+            ) AS open_hours_p50
+        FROM pullrequests
+        GROUP BY 1
+        ORDER BY 1;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(since=since, until=until)
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records)
+
+    return df
+
+
+# Search results are ordered by relevance or by date, most relevant/recent first
+SEARCH_SORTS = ("rank", "recent")
+
+
+def search_keyset_filter(sort):
+    # Rows after the (:after_value, :after_id) cursor of the previous page, or all when it is NULL
+    value_type = "DOUBLE PRECISION" if sort == "rank" else "TIMESTAMPTZ"
+    return f"""(CAST(:after_value AS {value_type}) IS NULL
+                OR sort_value < :after_value
+                OR (sort_value = :after_value AND id > :after_id))"""
+
+
+@read_query
+def query_commit_search(
+    engine, q, author=None, repo=None, since=None, until=None, sort="rank", after=None, limit=50
+):
+    # Commits whose message matches q (websearch syntax: "a phrase", or, -word)
+    if sort not in SEARCH_SORTS:
+        raise ValueError(f"Cannot sort search results by {sort}")
+    sort_column = "rank" if sort == "rank" else "created_at_ts"
+    after_value, after_id = after or (None, None)
+
+    # The rank is compared across pages, so it is kept in double precision end to end
+    sql = f"""
+        WITH matches AS (
+            SELECT
+                id,
+                author,
+                author_id,
+                repo,
+                created_at,
+                created_at_ts,
+                msg,
+                CAST(ts_rank_cd(msg_tsv, query) AS DOUBLE PRECISION) AS rank
+            FROM bb_commits, websearch_to_tsquery('simple', :q) AS query
+            WHERE msg_tsv @@ query
+                AND (CAST(:author AS TEXT) IS NULL OR author_id = :author OR author = :author)
+                AND (CAST(:repo AS TEXT) IS NULL OR repo = :repo)
+                AND {TIME_RANGE_FILTER}
+        ),
+        page AS (
+            SELECT *, {sort_column} AS sort_value
+            FROM matches
+        )
+        SELECT
+            id,
+            author,
+            author_id,
+            repo,
+            created_at,
+            msg,
+            rank,
+            ts_headline('simple', msg, websearch_to_tsquery('simple', :q)) AS headline,
+            sort_value
+        FROM page
+        WHERE {search_keyset_filter(sort)}
+        ORDER BY sort_value DESC, id
+        LIMIT :limit;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(
+        q=q,
+        author=author,
+        repo=repo,
+        since=since,
+        until=until,
+        after_value=after_value,
+        after_id=after_id,
+        limit=limit,
+    )
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records, columns=list(result.keys()))
+
+    return df
+
+
+@read_query
+def query_pullrequest_search(
+    engine, q, author=None, repo=None, since=None, until=None, sort="rank", after=None, limit=50
+):
+    # Pull requests whose title or description matches q, title matches rank higher
+    if sort not in SEARCH_SORTS:
+        raise ValueError(f"Cannot sort search results by {sort}")
+    sort_column = "rank" if sort == "rank" else "created_at_ts"
+    after_value, after_id = after or (None, None)
+
+    sql = f"""
+        WITH matches AS (
+            SELECT
+                id,
+                title,
+                description,
+                state,
+                author,
+                author_id,
+                repo,
+                created_at,
+                updated_at,
+                CAST(created_at AS TIMESTAMPTZ) AS created_at_ts,
+                CAST(ts_rank_cd(search_tsv, query) AS DOUBLE PRECISION) AS rank
+            FROM bb_pullrequests, websearch_to_tsquery('simple', :q) AS query
+            WHERE search_tsv @@ query
+                AND (CAST(:author AS TEXT) IS NULL OR author_id = :author OR author = :author)
+                AND (CAST(:repo AS TEXT) IS NULL OR repo = :repo)
+        ),
+        page AS (
+            SELECT *, {sort_column} AS sort_value
+            FROM matches
+            WHERE {TIME_RANGE_FILTER}
+        )
+        SELECT
+            id,
+            title,
+            description,
+            state,
+            author,
+            author_id,
+            repo,
+            created_at,
+            updated_at,
+            rank,
+            ts_headline(
+                'simple',
+                COALESCE(title, '') || ' ' || COALESCE(description, ''),
+                websearch_to_tsquery('simple', :q)
+            ) AS headline,
+            sort_value
+        FROM page
+        WHERE {search_keyset_filter(sort)}
+        ORDER BY sort_value DESC, id
+        LIMIT :limit;
+    """
+
+    stmt = text(sql)
+    stmt = stmt.bindparams(
+        q=q,
+        author=author,
+        repo=repo,
+        since=since,
+        until=until,
+        after_value=after_value,
+        after_id=after_id,
+        limit=limit,
+    )
+    with engine.begin() as conn:
+        result = conn.execute(stmt)
+
+    records = []
+    for record in result:
+        records.append(record)
+
+    df = pd.DataFrame(records, columns=list(result.keys()))
+
+    return df
@@ -0,0 +1,267 @@
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import re
+import threading
+
+HUNK_HEADER_PATTERN = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+DEV_NULL = "/dev/null"
+
+
+def iter_lines(text):
+    """Yield the lines of a text one by one, without splitting it into a list up front."""
+    start = 0
+    length = len(text)
+    while start < length:
+        end = text.find("\n", start)
+        if end == -1:
+            end = length
+        line = text[start:end]
+        if line.endswith("\r"):
+            line = line[:-1]
+        yield line
+        start = end + 1
+
+
+def _strip_prefix(path):
+    # "a/src/main.py" -> "src/main.py"
+    if path.startswith(("a/", "b/")):
+        return path[2:]
+    return path
+
+
+def _parse_git_header(line):
+    # "diff --git a/old/path b/new/path"
+    paths = line[len("diff --git ") :]
+    index = paths.rfind(" b/")
+    if index == -1:
+        old_path, _, new_path = paths.partition(" ")
+    else:
+        old_path, new_path = paths[:index], paths[index + 1 :]
+    return _strip_prefix(old_path.strip('"')), _strip_prefix(new_path.strip('"'))
+
+
+def _new_file(old_path, new_path, include_content):
+    diff_file = {
+        "file_name": new_path or old_path,
+        "old_path": old_path,
+        "new_path": new_path,
+        "status": "modified",
+        "binary": False,
+        "added": 0,
+        "removed": 0,
+    }
+    if include_content:
+        diff_file["hunks"] = []
+    return diff_file
+
+
+def _finish_file(diff_file):
+    if diff_file["old_path"] == DEV_NULL:
+        diff_file["old_path"] = None
+        diff_file["status"] = "added"
+    elif diff_file["new_path"] == DEV_NULL:
+        diff_file["new_path"] = None
+        diff_file["status"] = "deleted"
+    elif diff_file["status"] == "modified" and diff_file["old_path"] != diff_file["new_path"]:
+        diff_file["status"] = "renamed"
+    diff_file["file_name"] = diff_file["new_path"] or diff_file["old_path"]
+    return diff_file
+
+
+def _finish_hunk(hunk):
+    return {
+        "section_line": hunk["section_line"],
+        "added_content": "\n".join(hunk["added_lines"]),
+        "removed_content": "\n".join(hunk["removed_lines"]),
+    }
+
+
+def iter_diff_files(diff_content, include_content=True):
+    """Parse a (multi-file) git diff lazily, yielding one dict per file.
+
+    Each dict holds the file paths, its status (added, deleted, renamed or
+    modified), whether it is binary and the number of lines added and
+    removed. With include_content, each file also carries its hunks, with
+    the hunk header and the added and removed lines.
+    """
+    diff_file = None
+    hunk = None
+    old_remaining = 0
+    new_remaining = 0
+
+    for line in iter_lines(diff_content or ""):
+        # Inside a hunk, the line counts in the header tell where it ends, so
+        # content lines such as "--- foo" are never mistaken for headers
+        if old_remaining > 0 or new_remaining > 0:
+            marker = line[:1]
+            if marker == "+":
+                diff_file["added"] += 1
+                new_remaining -= 1
+                if hunk is not None:
+                    hunk["added_lines"].append(line[1:])
+                continue
+            if marker == "-":
+                diff_file["removed"] += 1
+                old_remaining -= 1
+                if hunk is not None:
+                    hunk["removed_lines"].append(line[1:])
+                continue
+            if marker == " " or line == "":
+                old_remaining -= 1
+                new_remaining -= 1
+                continue
+            if marker == "\\":
+                # "\ No newline at end of file"
+                continue
+            # Truncated hunk, fall through and treat the line as a header
+            old_remaining = new_remaining = 0
+
+        if line.startswith("diff --git "):
+            if diff_file is not None:
+                if hunk is not None:
+                    diff_file["hunks"].append(_finish_hunk(hunk))
+                    hunk = None
+                yield _finish_file(diff_file)
+            old_path, new_path = _parse_git_header(line)
+            diff_file = _new_file(old_path, new_path, include_content)
+            continue
+
+        if line.startswith("--- ") and (diff_file is None or diff_file["added"] or diff_file["removed"]):
+            # Plain unified diff without a "diff --git" header
+            if diff_file is not None:
+                if hunk is not None:
+                    diff_file["hunks"].append(_finish_hunk(hunk))
+                    hunk = None
+                yield _finish_file(diff_file)
+            diff_file = _new_file(None, None, include_content)
+
+        if diff_file is None:
+            continue
+
+        if line.startswith("@@"):
+            match = HUNK_HEADER_PATTERN.match(line)
+            if match is None:
+                continue
+            old_remaining = int(match.group(2)) if match.group(2) is not None else 1
+            new_remaining = int(match.group(4)) if match.group(4) is not None else 1
+            if include_content:
+                if hunk is not None:
+                    diff_file["hunks"].append(_finish_hunk(hunk))
+                hunk = {"section_line": line, "added_lines": [], "removed_lines": []}
+        elif line.startswith("--- "):
+            diff_file["old_path"] = _strip_prefix(line[4:].split("\t")[0].strip('"'))
+        elif line.startswith("+++ "):
+            diff_file["new_path"] = _strip_prefix(line[4:].split("\t")[0].strip('"'))
+        elif line.startswith("new file mode"):
+            diff_file["status"] = "added"
+        elif line.startswith("deleted file mode"):
+            diff_file["status"] = "deleted"
+        elif line.startswith("rename from "):
+            diff_file["old_path"] = line[len("rename from ") :]
+            diff_file["status"] = "renamed"
+        elif line.startswith("rename to "):
+            diff_file["new_path"] = line[len("rename to ") :]
+            diff_file["status"] = "renamed"
+        elif line.startswith("Binary files ") or line == "GIT binary patch":
+            diff_file["binary"] = True
+
+    if diff_file is not None:
+        if hunk is not None:
+            diff_file["hunks"].append(_finish_hunk(hunk))
+        yield _finish_file(diff_file)
+
+
+def parse_git_diff(diff_content):
+    """Parse a git diff into a list of per-file dicts, see iter_diff_files."""
+    return list(iter_diff_files(diff_content))
+
+
+# Below this many bytes of diff text, parsing inline beats shipping work to other processes
+PARALLEL_MIN_BYTES = 1 << 20
+CHUNK_BYTES = 4 << 20
+
+_executor = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    # Shared by the threads of a gthread or gevent worker
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # Forking a multithreaded (or monkey patched) web worker can copy held locks
+            # into the children, they are started from a clean server process instead
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context(start_method)
+            )
+            _executor_workers = workers
+        return _executor
+
+
+def _discard_executor(executor):
+    # A pool whose child died (e.g. killed for memory) rejects all work, the next call builds a new one
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def _chunk_by_size(diffs, chunk_bytes):
+    # Group (key, diff) pairs into work units of roughly chunk_bytes of diff text
+    chunk = []
+    size = 0
+    for key, diff in diffs:
+        chunk.append((key, diff))
+        size += len(diff or "")
+        if size >= chunk_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+
+def _parse_chunk(chunk, include_content):
+    return [(key, list(iter_diff_files(diff, include_content))) for key, diff in chunk]
+
+
+def parse_diffs(diffs, workers=None, include_content=True, chunk_bytes=CHUNK_BYTES):
+    """Parse many diffs, spreading the work over a process pool when it is worth it.
+
+    diffs is a list of (key, diff_content) pairs, the result is a list of
+    (key, files) pairs in the same order, files being what iter_diff_files
+    yields for that diff.
+    """
+    total_bytes = sum(len(diff or "") for key, diff in diffs)
+    if not workers or workers <= 1 or total_bytes < PARALLEL_MIN_BYTES:
+        return _parse_chunk(diffs, include_content)
+
+    # Keep several work units per worker so one huge diff does not serialize the rest
+    chunk_bytes = max(min(chunk_bytes, total_bytes // (workers * 4)), 1)
+
+    chunks = list(_chunk_by_size(diffs, chunk_bytes))
+    try:
+        return _parse_chunks(_get_executor(workers), chunks, include_content)
+    except BrokenProcessPool:
+        # Retry once on a new pool, a pool broken again is dropped too
+        print("Diff parser pool broke, retrying on a new one")
+        return _parse_chunks(_get_executor(workers), chunks, include_content)
+
+
+def _parse_chunks(executor, chunks, include_content):
+    try:
+        futures = [executor.submit(_parse_chunk, chunk, include_content) for chunk in chunks]
+
+        parsed = []
+        for future in futures:
+            parsed.extend(future.result())
+        return parsed
+    except BrokenProcessPool:
+        _discard_executor(executor)
+        raise
@@ -1,10 +1,107 @@
-from datetime import datetime, timezone
+import base64
+import importlib
+import json
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 
 def date_to_iso_seconds(dt: datetime):
     """Convert a datetime to an ISO 8601 string with seconds precision, e.g. 2020-12-25T10:45:26Z"""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
     return (
         dt.replace(tzinfo=timezone.utc)
         .isoformat(timespec="seconds")
         .replace("+00:00", "Z")
     )
+
+
+def mtr_task_name(message: str):
+    """Return the task prefix of a commit message (the text before the first '/'), or None if the message is malformed
+
+    A message starting with '/' has no task, it is malformed too, like in rebuild_mtr_rollup.
+    """
+    index = message.find("/")
+    if index <= 0:
+        return None
+    return message[:index]
+
+
+def format_hours(hours: float):
+    """Format a number of hours as H:MM:SS (or 'N days, H:MM:SS'), dropping fractions of a second"""
+    return str(timedelta(seconds=int(hours * 3600)))
+
+
+def parse_timezone(tz: str):
+    """Return the ZoneInfo of an IANA time zone name such as Europe/Lisbon, raising ValueError if unknown"""
+    try:
+        return ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown time zone: {tz}")
+
+
+def parse_time_range(since: str, until: str, tz: str = "UTC"):
+    """Parse ISO 8601 since/until bounds (dates or datetimes) into aware datetimes.
+
+    Values without an offset are read in the tz time zone. Either bound may be
+    None. Raises ValueError on malformed values or an unknown time zone.
+    """
+    zone = parse_timezone(tz)
+    bounds = []
+    for value in (since, until):
+        if not value:
+            bounds.append(None)
+            continue
+        try:
+            dt = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Invalid date: {value}")
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=zone)
+        bounds.append(dt)
+    return bounds[0], bounds[1]
+
+
+def utc_date(dt: datetime):
+    """Return the date of an aware datetime if it is exactly a UTC midnight, otherwise None"""
+    if dt.utcoffset() != timedelta(0) or dt.timetz().replace(tzinfo=None) != datetime.min.time():
+        return None
+    return dt.date()
+
+
+def encode_cursor(sort_value, row_id):
+    """Encode the sort value (a number or a datetime) and id of the last row of a page as an opaque cursor"""
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    data = json.dumps([sort_value, row_id]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor: str, sort: str):
+    """Decode a cursor made by encode_cursor into (sort_value, id), raising ValueError if malformed"""
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort == "recent":
+            sort_value = datetime.fromisoformat(sort_value)
+        else:
+            sort_value = float(sort_value)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    return sort_value, str(row_id)
+
+
+class LazyModule:
+    """A module imported on first attribute access, e.g. pd = LazyModule("pandas").
+
+    Keeps heavy imports (pandas, and numpy with it) off the startup path of
+    the modules that only need them in some functions.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
@@ -0,0 +1,29 @@
+import psycopg2
+from psycopg2 import extensions
+
+
+def gevent_wait_callback(conn, timeout=None):
+    # Yield to the gevent hub instead of blocking the worker while psycopg2 waits
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+
+
+def patch_psycopg():
+    """Make psycopg2 cooperative, for gevent workers.
+
+    psycopg2 is a C extension that gevent's monkey patching cannot reach, so
+    without this every query blocks all the greenlets of the worker. COPY is
+    not supported in this mode.
+    """
+    if extensions.get_wait_callback() is None:
+        extensions.set_wait_callback(gevent_wait_callback)
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+
+# Workers write their metric samples to this directory and /metrics aggregates
+# them. prometheus_client picks its storage when imported, so this is set before
+# it is imported here or by the workers. One directory per gunicorn master.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), f"xtvt-metrics-{os.getpid()}")
+)
+
+from prometheus_client import multiprocess  # noqa: E402
+
+# Serving mode, "sync" by default. I/O-bound routes (/repos, /sync/*, slow
+# queries) hold a sync worker for their whole duration; "gthread" serves
+# GUNICORN_THREADS requests per worker, "gevent" up to GUNICORN_WORKER_CONNECTIONS.
+# Keep DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW in line with the concurrency of a worker.
+# The worker count comes from WEB_CONCURRENCY, as gunicorn reads it by default.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+threads = int(os.environ.get("GUNICORN_THREADS", 1 if worker_class == "sync" else 8))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 100))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+
+
+def on_starting(server):
+    # Start from an empty metrics directory so samples of earlier runs are not aggregated
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+
+def on_exit(server):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+
+
+def post_worker_init(worker):
+    # The gevent worker has monkey patched the standard library by now, psycopg2 needs its own hook
+    if worker.cfg.worker_class_str == "gevent":
+        from green import patch_psycopg
+
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    # Drop the live gauges of dead workers, their counters and histograms are kept
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,137 @@
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from db_utils import (
+    insert_job,
+    claim_next_job,
+    update_job_progress,
+    finish_job,
+    rebuild_mtr_rollup,
+    rebuild_commit_daily,
+)
+from sync import (
+    SyncProgress,
+    sync_commits,
+    sync_pullrequests,
+    sync_diffs,
+    sync_mtr,
+)
+
+# Minimum delay between two progress writes of the same job
+PROGRESS_FLUSH_SECONDS = 2
+
+
+def run_commits_job(engine, config, params, progress):
+    repos = params.get("repos") or config["BITBUCKET_REPOS"]
+    result = sync_commits(engine, config, repos, params.get("page_size", 20), progress)
+
+    # Recompute the daily rollup from scratch, e.g. for data synced before it existed
+    if params.get("rebuild"):
+        rebuild_commit_daily(engine)
+
+    return result
+
+
+def run_pullrequests_job(engine, config, params, progress):
+    repos = params.get("repos") or config["BITBUCKET_REPOS"]
+    return sync_pullrequests(engine, config, repos, params.get("page_size", 10), progress)
+
+
+def run_diffs_job(engine, config, params, progress):
+    repos = params.get("repos") or [None]
+    count = 0
+    for repo in repos:
+        count += sync_diffs(engine, config, repo=repo, progress=progress, mode=params.get("mode"))
+    return {"count": count}
+
+
+def run_mtr_job(engine, config, params, progress):
+    repos = params.get("repos") or config["BITBUCKET_REPOS"]
+    count = sync_mtr(
+        engine,
+        config,
+        repos,
+        page=params.get("page", 1),
+        page_size=params.get("page_size", 100),
+        progress=progress,
+    )
+
+    # Recompute the rollup from scratch, e.g. for data synced before it existed
+    if params.get("rebuild"):
+        rebuild_mtr_rollup(engine)
+
+    return {"count": count or 0}
+
+
+JOB_HANDLERS = {
+    "commits": run_commits_job,
+    "pullrequests": run_pullrequests_job,
+    "diffs": run_diffs_job,
+    "mtr": run_mtr_job,
+}
+
+
+def enqueue_job(engine, kind, params=None):
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    return insert_job(engine, kind, params or {})
+
+
+def run_job(engine, config, job_id, kind, params):
+    print(f"Running {kind} job: {job_id}")
+    last_flush = 0
+
+    def on_update(progress):
+        nonlocal last_flush
+        now = time.monotonic()
+        if now - last_flush >= PROGRESS_FLUSH_SECONDS:
+            last_flush = now
+            update_job_progress(
+                engine, job_id, progress.pages_fetched, progress.records_written, progress.errors
+            )
+
+    progress = SyncProgress(on_update)
+
+    try:
+        result = JOB_HANDLERS[kind](engine, config, params, progress)
+        status = "succeeded"
+    except Exception as e:
+        traceback.print_exc()
+        progress.errors.append(f"{type(e).__name__}: {e}")
+        result = None
+        status = "failed"
+
+    update_job_progress(
+        engine, job_id, progress.pages_fetched, progress.records_written, progress.errors
+    )
+    finish_job(engine, job_id, status, result)
+    print(f"Finished {kind} job {job_id}: {status}")
+
+    # Jobs that need the writes of this one, e.g. the diffs of the commits it
+    # fetched. Queued even if it failed, for whatever it did write.
+    for follow_up in params.get("then") or []:
+        enqueue_job(engine, follow_up["kind"], follow_up.get("params"))
+
+
+def worker_loop(engine, config):
+    while True:
+        try:
+            job = claim_next_job(engine, config["JOB_STALE_AFTER"])
+        except Exception:
+            traceback.print_exc()
+            job = None
+
+        if job is None:
+            time.sleep(config["JOB_POLL_INTERVAL"])
+            continue
+
+        run_job(engine, config, job.id, job.kind, job.params)
+
+
+def run_workers(engine, config, workers):
+    """Run job workers until the process is stopped."""
+    print(f"Starting {workers} job workers...")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(worker_loop, engine, config) for _ in range(workers)]
+        for future in futures:
+            future.result()
@@ -1,24 +1,23 @@
-from flask import Flask, jsonify, request, render_template
-from collections import Counter, defaultdict
-from bitbucket import Bitbucket
-from datetime import datetime, timedelta
+from flask import Flask, Response, g, jsonify, request, render_template
+from collections import Counter
+from datetime import datetime, timezone
+import click
 import logging
-import pandas as pd
 from flask_cors import cross_origin
 from db_utils import (
     connect_db,
-    append_commits,
-    append_pullrequests,
+    attach_read_engine,
+    set_read_from_primary,
+    reset_read_from_primary,
     query_authors,
     query_author_repos,
     query_repos,
     query_author_commits,
     query_author_pullrequests,
-    query_unprocessed_commits,
-    update_commit_diff,
     query_commit,
-    query_sync_history,
-    insert_sync_history,
+    query_commit_branches,
+    update_commit_diff,
+    append_commit_churn,
     query_diffs_by_author,
     query_all_commits,
     query_all_repo_commits,
@@ -27,13 +26,46 @@ from db_utils import (
     query_all_pullrequests,
     query_last_author_pullrequest,
     query_last_pullrequest,
-    append_mtr,
-    query_author_mtr,
+    query_author_mtr_rollup,
+    query_team_mtr_rollup,
+    query_churn_by_author,
+    query_churn_by_repo,
+    query_churn_by_file,
+    query_churn_over_time,
+    append_churn,
+    query_commit_diffs_after,
+    query_job,
+    query_pullrequest_cycle_time,
+    query_commit_daily,
+    query_commit_search,
+    query_pullrequest_search,
+    create_upcoming_partitions,
+)
+from jobs import enqueue_job, run_workers
+from sync import DIFF_SYNC_MODES, init_bitbucket
+from scheduler import run_scheduler
+from webhooks import WebhookPayloadError, verify_signature, ingest_push, ingest_pullrequest
+from generic_utils import (
+    LazyModule,
+    date_to_iso_seconds,
+    format_hours,
+    parse_time_range,
+    utc_date,
+    encode_cursor,
+    decode_cursor,
 )
-import requests
+from diff_parser import iter_diff_files, parse_diffs
+from bitbucket import http_session
 import concurrent.futures
-import difflib
 import json
+import os
+import threading
+import time
+import metrics
+import query_profiler
+import request_profiler
+
+pd = LazyModule("pandas")
 
 app = Flask(__name__)
 
@@ -41,6 +73,89 @@ app = Flask(__name__)
 # Load the app configuration
 app.config.from_pyfile("settings.py")
 
+# Time every request
+metrics.init_app(app)
+
+
+# Profile the requests that ask for it
+request_profiler.init_app(app)
+
+# Until when (epoch seconds) the client reads from the primary. GET /jobs/<id>
+# returns it for a sync job that just finished, and the client sends it back
+# as this header (or query parameter) with its next reads. A header works
+# across origins, unlike a cookie of this cross-origin API.
+READ_PRIMARY_HEADER = "X-Read-Primary-Until"
+READ_PRIMARY_PARAM = "read_primary_until"
+
+
+@app.before_request
+def route_reads():
+    # Right after a sync the replica may not have its writes yet
+    value = request.headers.get(READ_PRIMARY_HEADER) or request.args.get(READ_PRIMARY_PARAM)
+    try:
+        read_primary_until = float(value or 0)
+    except ValueError:
+        read_primary_until = 0
+
+    # Only within the window a finished job can hand out
+    now = time.time()
+    window = app.config["DB_READ_YOUR_WRITES_SECONDS"]
+    g.read_primary_token = set_read_from_primary(now < read_primary_until <= now + window)
+
+
+@app.teardown_request
+def reset_reads(exception=None):
+    token = g.pop("read_primary_token", None)
+    if token is not None:
+        reset_read_from_primary(token)
+
+
+# Log slow SQL statements
+query_profiler.configure(
+    app.config["SLOW_QUERY_THRESHOLD_MS"],
+    app.config["SLOW_QUERY_EXPLAIN"],
+    app.config["SLOW_QUERY_EXPLAIN_INTERVAL"],
+    app.config["SLOW_QUERY_LOG_SIZE"],
+)
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    data, content_type = metrics.render_metrics()
+    return Response(data, content_type=content_type)
+
+
+@app.route("/debug/profiles/<profile_id>", methods=["GET"])
+def get_profile(profile_id):
+    if not app.config["DEBUG_ENDPOINTS"]:
+        return jsonify({"statusCode": 404, "error": "Not found"}), 404
+
+    sort = request.args.get("sort", default="cumulative")
+    try:
+        report = request_profiler.summarize(app.config["PROFILER_DIR"], profile_id, sort)
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+    if report is None:
+        return jsonify({"statusCode": 404, "error": "Profile not found"}), 404
+
+    return Response(report, content_type="text/plain")
+
+
+@app.route("/debug/slow_queries", methods=["GET", "DELETE"])
+def get_slow_queries():
+    if not app.config["DEBUG_ENDPOINTS"]:
+        return jsonify({"statusCode": 404, "error": "Not found"}), 404
+
+    # Statistics are kept per worker process
+    if request.method == "DELETE":
+        query_profiler.reset()
+
+    result = {
+        "statusCode": 200,
+        "data": query_profiler.report(request.args.get("limit", default=50, type=int)),
+    }
+    return jsonify(result)
+
 
 @app.route("/authors", methods=["GET"])
 @cross_origin()
@@ -72,7 +187,9 @@ def get_repos():
     
     # check on bitbucket if this repo exists
     for r in df.to_dict(orient="records"):
-        response = requests.get(f'{bitbucket_api_url}/{r["repo"]}')
+        started_at = time.perf_counter()
+        response = http_session().get(f'{bitbucket_api_url}/{r["repo"]}')
+        metrics.observe_bitbucket_call("repository", response, time.perf_counter() - started_at)
         response=response.json()
         if response["type"] != 'error':
             data.append(r)
@@ -114,8 +231,15 @@ def get_author_commits(author_id):
     # Connect to database
     engine = init_db_engine()
 
+    # Optionally only the commits on one branch, and in [since, until)
+    branch = request.args.get("branch")
+    try:
+        since, until, _ = time_range_args()
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+
     # Return a list of commits
-    df = query_author_commits(engine, author_id)
+    df = query_author_commits(engine, author_id, branch, since, until)
 
     df['created_at'] = pd.to_datetime(df['created_at'])
 
@@ -153,9 +277,44 @@ def get_commit_diff(commit_id):
     # Return a list of commits
     df = query_commit(engine, commit_id)
 
+    data = {}
+    if len(df) > 0:
+        record = df.to_dict(orient="records")[0]
+        diff = record["diff"]
+
+        # Diffs are not stored by diffstat syncs, fetch it on first open and keep it.
+        # A stored diff marks the commit as processed, so its churn is written with it,
+        # as sync_diffs does, in case no sync recorded it yet.
+        if diff is None:
+            bitbucket = init_bitbucket(app.config, record["repo"])
+            diff = bitbucket.get_diff_for_commit(commit_id)
+            if diff is not None:
+                with engine.begin() as conn:
+                    update_commit_diff(conn, commit_id, diff)
+                    append_commit_churn(conn, commit_id, iter_diff_files(diff, include_content=False))
+
+        data = {"diff": diff}
+
+    result = {
+        "statusCode": 200,
+        "data": data,
+    }
+
+    return jsonify(result)
+
+
+@app.route("/commits/<commit_id>/branches", methods=["GET"])
+@cross_origin()
+def get_commit_branches(commit_id):
+    # Connect to database
+    engine = init_db_engine()
+
+    # Branches the commit was seen on by the MTR sync and push webhooks
+    df = query_commit_branches(engine, commit_id)
+
     result = {
         "statusCode": 200,
-        "data": df.to_dict(orient="records")[0] if len(df) > 0 else {},
+        "data": df.to_dict(orient="records"),
     }
 
     return jsonify(result)
@@ -165,249 +324,402 @@ def get_commit_diff(commit_id):
 @cross_origin()
 def sync_commits():
     # Retrieve query parameters
-    page_size = request.args.get("page_size", default=20, type=int)
+    params = {
+        "page_size": request.args.get("page_size", default=20, type=int),
+        # Recompute the daily rollup from scratch, e.g. for data synced before it existed
+        "rebuild": bool(request.args.get("rebuild", default=0, type=int)),
+    }
 
-    # Retrieve repositories
-    repos = app.config["BITBUCKET_REPOS"]
+    return enqueue_sync_job("commits", params)
 
-    # Connect to database
-    engine = init_db_engine()
 
-    total_count = 0
+@app.route("/sync/pullrequests", methods=["POST"])
+@cross_origin()
+def sync_pullrequests():
+    # Retrieve query parameters
+    page_size = request.args.get("page_size", default=10, type=int)
 
-    for repo in repos:
-        workspace, repo_slug = repo.split("/")
+    return enqueue_sync_job("pullrequests", {"page_size": page_size})
 
-        # Get the sync history for the repo
-        table_name = "bb_commits"
-        df_s = query_sync_history(engine, table_name, repo)
-        last_synced_at = None
-        if len(df_s) > 0:
-            updated_at = df_s.iloc[0]["updated_at"]
-            last_synced_at = datetime.fromisoformat(updated_at)
-            print(f"Last synced at: {last_synced_at}")
 
-        # Initialize Bitbucket client
-        bitbucket = Bitbucket(
-            app.config["BITBUCKET_USERNAME"],
-            app.config["BITBUCKET_APP_PASSWORD"],
-            workspace,
-            repo_slug,
-        )
+@app.route("/sync/diffs", methods=["POST"])
+@cross_origin()
+def sync_diffs():
+    # "diffstat" records the churn without downloading the diffs, see DIFF_SYNC_MODE
+    mode = request.args.get("mode", default=app.config["DIFF_SYNC_MODE"])
+    if mode not in DIFF_SYNC_MODES:
+        error = f"mode must be one of {', '.join(DIFF_SYNC_MODES)}"
+        return jsonify({"statusCode": 400, "error": error}), 400
 
-        page = 1
-        count = 0
+    return enqueue_sync_job("diffs", {"mode": mode})
 
-        while True:
-            # Return a list of commits
-            records = bitbucket.list_commits(page=page, page_size=page_size)
 
-            if len(records) == 0:
-                break
+def enqueue_sync_job(kind, params):
+    # Only restrict the repositories when asked to, e.g. ?repo=workspace/slug
+    repos = request.args.getlist("repo")
+    unknown = [repo for repo in repos if repo not in app.config["BITBUCKET_REPOS"]]
+    if unknown:
+        return jsonify({"statusCode": 400, "error": f"Unknown repo: {', '.join(unknown)}"}), 400
+    if repos:
+        params["repos"] = repos
 
-            df = pd.DataFrame(records)
+    # Connect to database
+    engine = init_db_engine()
 
-            append_commits(engine, df, app.config["DB_CHUNK_SIZE"])
+    job_id = enqueue_job(engine, kind, params)
 
-            page += 1
-            count += len(records)
+    result = {
+        "statusCode": 202,
+        "data": {
+            "job_id": job_id,
+        },
+    }
+    return jsonify(result), 202
 
-            look_more = True
-            for index, row in df.iterrows():
-                created_at = datetime.fromisoformat(row["created_at"])
-                if last_synced_at is not None and created_at < last_synced_at:
-                    print(
-                        f"Reached last synced record: {created_at} | {last_synced_at}"
-                    )
-                    look_more = False
-                    break
 
-            if not look_more:
-                break
+@app.route("/webhooks/bitbucket", methods=["POST"])
+@cross_origin()
+def bitbucket_webhook():
+    # Payloads write to the database and queue jobs, only signed ones are accepted
+    secret = app.config["BITBUCKET_WEBHOOK_SECRET"]
+    if not secret:
+        return jsonify({"statusCode": 403, "error": "Webhooks are disabled, no secret is configured"}), 403
+    if not verify_signature(secret, request.get_data(), request.headers.get("X-Hub-Signature")):
+        return jsonify({"statusCode": 401, "error": "Invalid signature"}), 401
+
+    event = request.headers.get("X-Event-Key", "")
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return jsonify({"statusCode": 400, "error": "Invalid payload"}), 400
 
-        # Update the sync history for the repo
-        insert_sync_history(engine, table_name, repo)
+    # Connect to database
+    engine = init_db_engine()
 
-        total_count += count
+    try:
+        if event == "repo:push":
+            data = ingest_push(engine, app.config, payload)
+        elif event.startswith("pullrequest:"):
+            data = ingest_pullrequest(engine, app.config, payload)
+        else:
+            print(f"Ignoring webhook event: {event}")
+            data = None
+    except WebhookPayloadError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
 
     result = {
         "statusCode": 200,
-        "count": total_count,
+        "event": event,
+        "data": data,
     }
     return jsonify(result)
 
 
-@app.route("/sync/pullrequests", methods=["POST"])
+@app.route("/jobs/<int:job_id>", methods=["GET"])
 @cross_origin()
-def sync_pullrequests():
-    # Retrieve query parameters
-    page_size = request.args.get("page_size", default=10, type=int)
+def get_job(job_id):
+    # Connect to database
+    engine = init_db_engine()
 
-    # Retrieve repositories
-    repos = app.config["BITBUCKET_REPOS"]
+    # Return the job status and progress
+    df = query_job(engine, job_id)
 
-    # Connect to database
+    if len(df) == 0:
+        return jsonify({"statusCode": 404, "error": "Job not found"}), 404
+
+    job = df.to_dict(orient="records")[0]
+
+    # The client that waited for its sync reads from the primary for a while,
+    # until the read replica has caught up with the writes of the job: it sends
+    # read_primary_until back with its reads, see route_reads
+    job["read_primary_until"] = None
+    window = app.config["DB_READ_YOUR_WRITES_SECONDS"]
+    if window > 0 and app.config["DB_READ_HOST"] and job["finished_at"]:
+        finished_at = datetime.fromisoformat(job["finished_at"].replace("Z", "+00:00"))
+        read_primary_until = int(finished_at.timestamp()) + window
+        if read_primary_until > time.time():
+            job["read_primary_until"] = read_primary_until
+
+    result = {
+        "statusCode": 200,
+        "data": job,
+    }
+
+    return jsonify(result)
+
+
+@app.cli.command("jobs-worker")
+@click.option("--workers", default=None, type=int, help="Jobs run concurrently.")
+@click.option("--metrics-port", default=None, type=int, help="Port of the metrics exporter, 0 disables it.")
+def jobs_worker(workers, metrics_port):
+    """Run queued /sync/* jobs."""
+    start_metrics_exporter(metrics_port)
     engine = init_db_engine()
+    run_workers(engine, app.config, workers or app.config["JOB_WORKERS"])
 
-    total_count = 0
 
-    for repo in repos:
-        workspace, repo_slug = repo.split("/")
+@app.cli.command("sync-scheduler")
+@click.option("--metrics-port", default=None, type=int, help="Port of the metrics exporter, 0 disables it.")
+def sync_scheduler(metrics_port):
+    """Periodically sync every configured repo."""
+    start_metrics_exporter(metrics_port)
+    engine = init_db_engine()
+    run_scheduler(engine, app.config)
 
-        # Initialize Bitbucket client
-        bitbucket = Bitbucket(
-            app.config["BITBUCKET_USERNAME"],
-            app.config["BITBUCKET_APP_PASSWORD"],
-            workspace,
-            repo_slug,
-        )
 
-        page = 1
-        count = 0
+@app.cli.command("create-partitions")
+@click.option("--months", default=None, type=int, help="Months ahead of the current one.")
+def create_partitions(months):
+    """Create the coming months' partitions of bb_commits and bb_mtr."""
+    engine = init_db_engine()
+    months = app.config["PARTITION_MONTHS_AHEAD"] if months is None else months
+    count = create_upcoming_partitions(engine, months)
+    print(f"Done: {count} partitions created")
 
-        while True:
-            # Return a list of pull requests
-            records = bitbucket.list_pullrequests(page=page, page_size=page_size)
 
-            if len(records) == 0:
-                break
+def start_metrics_exporter(port):
+    # Syncs run in these processes, /metrics of the web process never sees them
+    port = app.config["METRICS_PORT"] if port is None else port
+    if port > 0:
+        metrics.start_exporter(port)
 
-            df = pd.DataFrame(records)
 
-            append_pullrequests(engine, df, app.config["DB_CHUNK_SIZE"])
+@app.route("/churn/authors", methods=["GET"])
+@cross_origin()
+def get_churn_by_author():
+    # Retrieve query parameters
+    try:
+        since, until, _ = time_range_args()
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
 
-            page += 1
-            count += len(records)
+    # Connect to database
+    engine = init_db_engine()
 
-        total_count += count
+    # Return lines added/removed per author
+    df = query_churn_by_author(engine, since, until)
 
     result = {
         "statusCode": 200,
-        "count": total_count,
+        "data": df.to_dict(orient="records"),
     }
+
     return jsonify(result)
 
 
-@app.route("/sync/diffs", methods=["POST"])
+@app.route("/churn/repos", methods=["GET"])
 @cross_origin()
-def sync_diffs():
+def get_churn_by_repo():
+    # Retrieve query parameters
+    try:
+        since, until, _ = time_range_args()
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+
     # Connect to database
     engine = init_db_engine()
 
-    # Return a list of unprocessed commits
-    df = query_unprocessed_commits(engine)
+    # Return lines added/removed per repository
+    df = query_churn_by_repo(engine, since, until)
 
-    count = 0
+    result = {
+        "statusCode": 200,
+        "data": df.to_dict(orient="records"),
+    }
 
-    for index, row in df.iterrows():
-        commit_id = row["id"]
-        repo = row["repo"]
-        workspace, repo_slug = repo.split("/")
+    return jsonify(result)
 
-        print(f"Processing commit: {commit_id}")
 
-        # Initialize Bitbucket client
-        bitbucket = Bitbucket(
-            app.config["BITBUCKET_USERNAME"],
-            app.config["BITBUCKET_APP_PASSWORD"],
-            workspace,
-            repo_slug,
-        )
+@app.route("/churn/files", methods=["GET"])
+@cross_origin()
+def get_churn_by_file():
+    # Retrieve query parameters
+    repo = request.args.get("repo", default=None)
+    limit = request.args.get("limit", default=100, type=int)
 
-        # Return a commit diff
-        diff = bitbucket.get_diff_for_commit(commit_id)
+    if repo is None:
+        return jsonify({"statusCode": 400, "error": "Missing repo parameter"}), 400
+    if limit < 1:
+        return jsonify({"statusCode": 400, "error": "limit must be positive"}), 400
 
-        # Update the commit diff
-        update_commit_diff(engine, commit_id, diff)
+    # Connect to database
+    engine = init_db_engine()
 
-        count += 1
+    # Return the most changed files of the repository
+    df = query_churn_by_file(engine, repo, limit)
 
     result = {
         "statusCode": 200,
-        "data": {
-            "count": count,
-        },
+        "data": df.to_dict(orient="records"),
     }
+
     return jsonify(result)
 
 
-def init_db_engine():
-    engine = connect_db(
-        app.config["DB_HOST"],
-        app.config["DB_PORT"],
-        app.config["DB_USER"],
-        app.config["DB_PSWD"],
-        app.config["DB_NAME"],
-    )
-    return engine
+@app.route("/churn/timeline", methods=["GET"])
+@cross_origin()
+def get_churn_over_time():
+    # Retrieve query parameters
+    interval = request.args.get("interval", default="week")
+    author_id = request.args.get("author", default=None)
+    repo = request.args.get("repo", default=None)
+
+    if interval not in ("day", "week", "month"):
+        return jsonify({"statusCode": 400, "error": "Invalid interval"}), 400
+    try:
+        since, until, _ = time_range_args()
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+
+    # Connect to database
+    engine = init_db_engine()
+
+    # Return lines added/removed per day, week or month
+    df = query_churn_over_time(engine, interval, author_id, repo, since, until)
+
+    if "date" in df.columns:
+        df["date"] = df["date"].astype(str)
+
+    result = {
+        "statusCode": 200,
+        "data": df.to_dict(orient="records"),
+    }
+
+    return jsonify(result)
+
+
+def time_range_args():
+    """Return the since, until and tz query parameters, raising ValueError if malformed.
+
+    since and until are ISO 8601 dates or datetimes, read in tz (UTC by
+    default) when they have no offset.
+    """
+    tz = request.args.get("tz", default="UTC")
+    since, until = parse_time_range(request.args.get("since"), request.args.get("until"), tz)
+    return since, until, tz
 
 
+_engine = None
+_read_engine = None
+_engine_lock = threading.Lock()
+
+
+def init_db_engine():
+    # One engine, and so one connection pool, per process, shared by its threads or greenlets
+    global _engine, _read_engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = connect_db(
+                app.config["DB_HOST"],
+                app.config["DB_PORT"],
+                app.config["DB_USER"],
+                app.config["DB_PSWD"],
+                app.config["DB_NAME"],
+                app.config["DB_SSLMODE"],
+                app.config["DB_POOL_SIZE"],
+                app.config["DB_POOL_MAX_OVERFLOW"],
+                app.config["DB_POOL_TIMEOUT"],
+            )
+            # The query_* functions called with _engine read from the replica
+            if app.config["DB_READ_HOST"]:
+                _read_engine = connect_db(
+                    app.config["DB_READ_HOST"],
+                    app.config["DB_READ_PORT"],
+                    app.config["DB_READ_USER"],
+                    app.config["DB_READ_PSWD"],
+                    app.config["DB_NAME"],
+                    app.config["DB_SSLMODE"],
+                    app.config["DB_POOL_SIZE"],
+                    app.config["DB_POOL_MAX_OVERFLOW"],
+                    app.config["DB_POOL_TIMEOUT"],
+                )
+                attach_read_engine(_engine, _read_engine)
+    return _engine
+
+
+def _reset_db_engine():
+    # A forked child must not reuse the connections of its parent
+    global _engine, _read_engine, _engine_lock
+    for engine in (_engine, _read_engine):
+        if engine is not None:
+            engine.dispose(close=False)
+    _engine = None
+    _read_engine = None
+    _engine_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_db_engine)
+
+
+
+
+# Largest page of /<author>/diff, every diff of a page is parsed by the request
+MAX_DIFF_PAGE_SIZE = 500
 
 
 @app.route("/<author>/diff", methods=["GET"])
 @cross_origin()
 def get_author_diff(author):
+    # Retrieve query parameters
+    page = request.args.get("page", default=1, type=int)
+    page_size = request.args.get("page_size", default=100, type=int)
+
+    if page < 1 or page_size < 1:
+        return jsonify({"statusCode": 400, "error": "page and page_size must be positive"}), 400
+    page_size = min(page_size, MAX_DIFF_PAGE_SIZE)
+
     # Connect to database
     engine = init_db_engine()
 
-    # Get the diffs from the database
-    df = query_diffs_by_author(engine, author)
+    # Get a page of synced diffs from the database, most recent first
+    df = query_diffs_by_author(
+        engine, author, limit=page_size, offset=(page - 1) * page_size
+    )
+    diffs = list(zip(df["id"], df["diff"])) if len(df) > 0 else []
 
-    # Format the diffs as requested
-    formatted_diffs = []
-    for index, row in df.iterrows():
-        diff_content = row['diff']
-        formatted_diff = parse_git_diff(diff_content)
-        formatted_diffs.append(formatted_diff)
+    # Format the diffs as requested, one entry per commit with its changed files
+    parsed = parse_diffs(diffs, workers=app.config["DIFF_PARSE_WORKERS"])
+    formatted_diffs = [{"commit_id": commit_id, "files": files} for commit_id, files in parsed]
 
     result = {
         "statusCode": 200,
+        "page": page,
+        "page_size": page_size,
         "data": formatted_diffs,
     }
 
     return jsonify(result)
 
-def parse_git_diff(diff_content):
-    diff_lines = diff_content.splitlines()
-
-    # Verifica se o diff tem o formato esperado
-    if not diff_lines or not diff_lines[0].startswith('diff --git'):
-        raise ValueError("O conteúdo do diff não está no formato esperado.")
-
-    # Extrai o nome do arquivo
-    file_name_line = diff_lines[0][13:]  # Remove "diff --git a/" para obter o nome do arquivo
-    file_name = file_name_line.split(" ")[0]
-
-    # Inicializa listas para armazenar linhas adicionadas, removidas e informações de seção modificada
-    added_lines = []
-    removed_lines = []
-    section_line = None
-
-    # Inicializa o objeto Differ
-    differ = difflib.Differ()
-
-    # Itera sobre as linhas do diff
-    for line in diff_lines:
-        if line.startswith('@@'):
-            section_line = line
-        elif line.startswith('+'):
-            added_lines.append(line[3:] if line.startswith('+++') else line[1:])
-        elif line.startswith('-'):
-            removed_lines.append(line[3:] if line.startswith('---') else line[1:])
-
-    # Remove o primeiro valor de cada lista
-    added_lines = added_lines[1:]
-    removed_lines = removed_lines[1:]
-
-    # Retorna um dicionário com as informações extraídas
-    diff_info = {
-        'file_name': file_name,
-        'section_line': section_line,
-        'added_content': '\n'.join(added_lines),
-        'removed_content': '\n'.join(removed_lines),
-    }
 
-    return diff_info
+@app.cli.command("backfill-churn")
+@click.option("--batch-size", default=500, help="Commits fetched per batch.")
+@click.option("--workers", default=None, type=int, help="Diff parsing processes, one per CPU by default.")
+@click.option("--all", "reparse_all", is_flag=True, help="Re-parse commits that already have churn.")
+def backfill_churn(batch_size, workers, reparse_all):
+    """Parse stored diffs into bb_commit_churn."""
+    engine = init_db_engine()
+    # Unlike a web worker, the backfill has the machine to itself
+    workers = workers or os.cpu_count() or 1
+
+    after_id = ""
+    commits = 0
+    files = 0
+
+    while True:
+        df = query_commit_diffs_after(
+            engine, after_id, batch_size, missing_churn=not reparse_all
+        )
+        if len(df) == 0:
+            break
+
+        diffs = list(zip(df["id"], df["diff"]))
+        parsed = parse_diffs(diffs, workers=workers, include_content=False)
+        files += append_churn(engine, parsed)
+
+        commits += len(df)
+        after_id = df.iloc[-1]["id"]
+        print(f"Processed {commits} commits, {files} files (last: {after_id})")
+
+    print(f"Done: {commits} commits, {files} files")
 
 
 @app.route("/all_commits", methods=["GET"])
@@ -416,8 +728,13 @@ def get_all_commits():
     # Connect to database
     engine = init_db_engine()
 
+    try:
+        since, until, _ = time_range_args()
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+
     # Return a list of all commits
-    df = query_all_commits(engine)
+    df = query_all_commits(engine, since, until)
 
     df['created_at'] = pd.to_datetime(df['created_at'])
 
@@ -430,14 +747,19 @@ def get_all_commits():
     return jsonify(result)
 
 
-@app.route("/<repo_name>/all_commits", methods=["GET"])
+@app.route("/<path:repo_name>/all_commits", methods=["GET"])
 @cross_origin()
 def get_repo_commits(repo_name):
     # Connect to database
     engine = init_db_engine()
 
-    # Return a list of all commits
-    df = query_all_commits(engine)
+    try:
+        since, until, _ = time_range_args()
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+
+    # Return the commits of the repository
+    df = query_all_repo_commits(engine, repo_name, since, until)
 
     result = {
         "statusCode": 200,
@@ -453,14 +775,16 @@ def get_author_commits_by_date(author_id, date):
     # Connect to database
     engine = init_db_engine()
 
-    # Retorna um DataFrame com os commits do autor
-    df = query_commits_by_day_and_author(engine, author_id, date)
+    # Optionally only the commits on one branch, the day is in the tz time zone
+    branch = request.args.get("branch")
+    try:
+        _, _, tz = time_range_args()
+        df_filtered = query_commits_by_day_and_author(engine, author_id, date, branch, tz)
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
 
     # Converta a coluna 'created_at' para datetime, se ainda não for
-    df['created_at'] = pd.to_datetime(df['created_at'])
-
-    # Filtre os dados com base na data
-    df_filtered = df[df['created_at'].dt.strftime('%Y-%m-%d') == pd.to_datetime(date).strftime('%Y-%m-%d')]
+    df_filtered['created_at'] = pd.to_datetime(df_filtered['created_at'])
 
     result = {
         "statusCode": 200,
@@ -479,8 +803,25 @@ def get_author_all_commit_count_by_date(author_id):
     # Connect to database
     engine = init_db_engine()
 
-    # Retorna um DataFrame com os commits do autor, agrupados por dia
-    df = query_all_commit_count_by_day_and_author(engine, author_id)
+    # Optionally only the commits on one branch, and in [since, until)
+    branch = request.args.get("branch")
+    try:
+        since, until, tz = time_range_args()
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+
+    # The daily rollup holds whole UTC days of all branches, anything finer reads the commits
+    bounds = (since, until)
+    days = [utc_date(bound) if bound else None for bound in bounds]
+    whole_days = all(bound is None or day is not None for bound, day in zip(bounds, days))
+    use_rollup = branch is None and tz == "UTC" and whole_days
+
+    if use_rollup:
+        df = query_commit_daily(engine, "day", author_id=author_id, since=days[0], until=days[1])
+        df = df[["day", "commit_count"]].rename(columns={"day": "date"})
+    else:
+        # Retorna um DataFrame com os commits do autor, agrupados por dia (no fuso tz)
+        df = query_all_commit_count_by_day_and_author(engine, author_id, branch, since, until, tz)
 
     result = {
         "statusCode": 200,
@@ -491,6 +832,88 @@ def get_author_all_commit_count_by_date(author_id):
 
     return jsonify(result)
 
+@app.route("/heatmap", methods=["GET"])
+@cross_origin()
+def get_heatmap():
+    # Retrieve query parameters; days are UTC
+    group_by = request.args.get("group_by", default="day")
+    author_id = request.args.get("author_id", default=None)
+    repo = request.args.get("repo", default=None)
+
+    if group_by not in ("day", "author", "repo"):
+        return jsonify({"statusCode": 400, "error": "Invalid group_by"}), 400
+
+    try:
+        since, until = parse_time_range(request.args.get("since"), request.args.get("until"))
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+
+    since = since.astimezone(timezone.utc).date() if since else None
+    until = until.astimezone(timezone.utc).date() if until else None
+
+    # Connect to database
+    engine = init_db_engine()
+
+    # Commits and changed lines per day, from the daily rollup
+    df = query_commit_daily(engine, group_by, author_id, repo, since, until)
+    df["day"] = df["day"].map(lambda day: day.isoformat())
+
+    result = {
+        "statusCode": 200,
+        "data": df.to_dict(orient="records"),
+    }
+
+    return jsonify(result)
+
+
+@app.route("/search", methods=["GET"])
+@cross_origin()
+def search():
+    # Retrieve query parameters
+    q = request.args.get("q", default="").strip()
+    search_type = request.args.get("type", default="commits")
+    author = request.args.get("author", default=None)
+    repo = request.args.get("repo", default=None)
+    sort = request.args.get("sort", default="rank")
+    limit = max(1, min(request.args.get("limit", default=50, type=int), 200))
+    cursor = request.args.get("cursor", default=None)
+
+    if not q:
+        return jsonify({"statusCode": 400, "error": "Missing q"}), 400
+    if search_type not in ("commits", "pullrequests"):
+        return jsonify({"statusCode": 400, "error": "Invalid type"}), 400
+    if sort not in ("rank", "recent"):
+        return jsonify({"statusCode": 400, "error": "Invalid sort"}), 400
+
+    try:
+        since, until, _ = time_range_args()
+        after = decode_cursor(cursor, sort) if cursor else None
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+
+    # Connect to database
+    engine = init_db_engine()
+
+    # Matches from the full-text indexes, a page at a time
+    query = query_commit_search if search_type == "commits" else query_pullrequest_search
+    df = query(engine, q, author, repo, since, until, sort, after, limit)
+
+    # The next page starts after the last row of this one
+    next_cursor = None
+    if len(df) == limit:
+        last = df.iloc[-1]
+        next_cursor = encode_cursor(last["sort_value"], last["id"])
+    df = df.drop(columns=["sort_value"])
+
+    result = {
+        "statusCode": 200,
+        "data": df.to_dict(orient="records"),
+        "next_cursor": next_cursor,
+    }
+
+    return jsonify(result)
+
+
 @app.route("/pullrequests", methods=["GET"])
 @cross_origin()
 def get_all_pullrequests():
@@ -510,6 +933,36 @@ def get_all_pullrequests():
     return jsonify(result)
     #return data
 
+@app.route("/pullrequests/cycle_time", methods=["GET"])
+@cross_origin()
+def get_pullrequest_cycle_time():
+    # Retrieve query parameters
+    group_by = request.args.get("group_by", default="author")
+
+    if group_by not in ("author", "repo"):
+        return jsonify({"statusCode": 400, "error": "Invalid group_by"}), 400
+    try:
+        since, until, _ = time_range_args()
+    except ValueError as e:
+        return jsonify({"statusCode": 400, "error": str(e)}), 400
+
+    # Connect to database
+    engine = init_db_engine()
+
+    # Return merge time percentiles and reopen/decline counts
+    df = query_pullrequest_cycle_time(engine, group_by, since, until)
+
+    # Groups without merged pull requests have no percentiles
+    df = df.astype(object).where(pd.notna(df), None)
+
+    result = {
+        "statusCode": 200,
+        "data": df.to_dict(orient="records"),
+    }
+
+    return jsonify(result)
+
+
 @app.route("/count_pullrequests", methods=["GET"])
 @cross_origin()
 def count_pullrequests():
@@ -595,33 +1048,16 @@ def get_last_pullrequest():
 
 @app.route("/sync_mtr", methods=["POST"])
 @cross_origin()
-def sync_mtr(page=1, page_size=100):
-
-    repos = app.config["BITBUCKET_REPOS"]
-
-    engine = init_db_engine()
-
-    # total_count = 0
-
-    for repo in repos:
-        workspace, repo_slug = repo.split("/")
-        
-
-    # Initialize Bitbucket client
-    bitbucket = Bitbucket(
-        app.config["BITBUCKET_USERNAME"],
-        app.config["BITBUCKET_APP_PASSWORD"],
-        workspace,
-        repo_slug,
-    )
-
-    result = bitbucket.sync_mtr(page=page, page_size=page_size)
-
-    df = pd.DataFrame(result)
-
-    append_mtr(engine, df, app.config["DB_CHUNK_SIZE"])
+def sync_mtr():
+    # Retrieve query parameters
+    params = {
+        "page": request.args.get("page", default=1, type=int),
+        "page_size": request.args.get("page_size", default=100, type=int),
+        # Recompute the rollup from scratch, e.g. for data synced before it existed
+        "rebuild": bool(request.args.get("rebuild", default=0, type=int)),
+    }
 
-    return result
+    return enqueue_sync_job("mtr", params)
 
 @app.route("/<author>/mtr", methods=["GET"])
 @cross_origin()
@@ -629,146 +1065,102 @@ def get_author_mtr(author):
     # Connect to database
     engine = init_db_engine()
 
-    # Get the diffs from the database
-    df = query_author_mtr(engine, author)
-
-    commit_messages_by_author = df.groupby('author')[['commit_message', 'created_at']].agg(list).to_dict()
-
-    result = {
-        "author": author,
-        "tasks": {}
-    }
-
-    commit_messages = commit_messages_by_author['commit_message']
-    commit_dates = commit_messages_by_author['created_at']
+    # Get the precomputed task rollup for the author
+    df = query_author_mtr_rollup(engine, author)
 
+    task_entries = []
+    error_qty = 0
+    mtr_times = []
 
-    result = {
-        "author": author,
-        "tasks": []
-    }
+    for record in df.to_dict(orient="records"):
+        error_qty += record["malformed_count"]
 
+        # Commits without a task prefix are accumulated in the '' task
+        if record["task"] == "":
+            continue
 
-    for author, messages in commit_messages.items():
-        mean_time_to_repair = commit_dates.get(author, [])
-        task_map = defaultdict(list)
-
-        for message, date in zip(messages, mean_time_to_repair):
-            
-            task_name_index = message.find('/') 
-            task_name = message[:task_name_index] if task_name_index != -1 else message
-
-            task_map[task_name].append({
-                "dates": date,
-                "task": message
-            })
-            ############################
-            # task_map[message].append({
-            #     "dates": date,
-            #     "task": message
-            # })
-
-        task_entries = []
-
-        # for task_name, entries in task_map.items():
-        #     task_entry = {
-        #         "mean_time_to_repair": [
-        #             {"dates": entry["dates"], "task": entry["task"]} for entry in entries
-        #         ]
-        #     }
-        #     task_entries.append(task_entry)
-
-        error_qty = []
-        ##########################################
-        for entries in task_map.values():
-            #print(task_map.values())
-            entries.sort(key=lambda x: x["dates"], reverse=True)
-
-
-            task_value = entries[0]["task"]
-            #print(entries)
-            task_name_index = task_value.find('/')  # Obter a parte antes do '/'
-            if task_name_index == -1:
-                error_qty.append(task_value)
-            else:
-                task_name = task_value[:task_name_index]
-                task_entry = {"mean_time_to_repair": [{"task": task_name, "dates": entry["dates"]} for entry in entries]}
-                task_entries.append(task_entry)
-                #print(task_name)
-        ###############################################       
-
-        task = {
-            "author": author,
-            "wrong_commit_message_qty": len(error_qty),
-            "tasks": task_entries,
+        # Same shape as before the rollup: the commits of the task, most recent
+        # first, the first entry carrying the hours between the first and the
+        # last. The rollup only keeps those two commits of a task.
+        last_commit = {
+            "task": record["task"],
+            "dates": date_to_iso_seconds(record["last_commit_at"]),
         }
+        mean_time_to_repair = [last_commit]
 
-        result["tasks"].append(task)
-
-    
-
-
-
-    for author_entry in result["tasks"]:
-        for task_entry in author_entry["tasks"]:
-            mean_time_to_repair = task_entry["mean_time_to_repair"]
-
-            if len(mean_time_to_repair) > 1:
-                dates = [datetime.fromisoformat(entry['dates']) for entry in mean_time_to_repair]
+        if record["commit_count"] > 1:
+            last_commit["total_difference"] = record["repair_hours"]
+            mean_time_to_repair.append(
+                {
+                    "task": record["task"],
+                    "dates": date_to_iso_seconds(record["first_commit_at"]),
+                }
+            )
+            mtr_times.append(record["repair_hours"])
 
-                # Calcula a diferença total de tempo em segundos
-                total_time_diff = sum((dates[j - 1] - dates[j]).total_seconds() for j in range(1, len(dates)))
+        task_entries.append({"mean_time_to_repair": mean_time_to_repair})
 
-                # Converte a diferença total para horas
-                total_hours = total_time_diff / 3600
-
-                mean_time_to_repair[0]["total_difference"] = total_hours
-
-
-    mtr_times = []
-    
+    result = {
+        "author": author,
+        "tasks": [
+            {
+                "author": author,
+                "wrong_commit_message_qty": error_qty,
+                "tasks": task_entries,
+            }
+        ],
+    }
 
+    if mtr_times:
+        result["mtr_all"] = format_hours(sum(mtr_times) / len(mtr_times))
+    else:
+        result["mtr_all"] = "No MTR Times found."
 
-    def parse_mtr_time(time_str):
-        try:
-            # Tenta analisar no formato atual
-            return datetime.strptime(time_str, "%H:%M:%S.%f") - datetime(1900, 1, 1)
-        except ValueError:
-            # Se falhar, tenta analisar no formato alternativo
-            days, time_part = time_str.split(", ")
-            time_obj = datetime.strptime(time_part, "%H:%M:%S")
-            return timedelta(days=int(days.split()[0]), hours=time_obj.hour, minutes=time_obj.minute, seconds=time_obj.second)
+    return result
 
-    def format_timedelta(td):
-        seconds = td.total_seconds()
-        hours, remainder = divmod(seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        return "{:02}:{:02}:{:02}".format(int(hours), int(minutes), int(seconds))
 
-    for author_entry in result["tasks"]:
-        for task_entry in author_entry["tasks"]:
-            #print(task_entry["mean_time_to_repair"])
-            for i in (task_entry["mean_time_to_repair"]):
-                if len(i) > 2:
-                    mtr_times.append(i['total_difference'])
-                    print(i['total_difference'])
+@app.route("/mtr", methods=["GET"])
+@cross_origin()
+def get_team_mtr():
+    # Connect to database
+    engine = init_db_engine()
 
+    # Get the rollup aggregated per author
+    df = query_team_mtr_rollup(engine)
+
+    authors = []
+    total_hours = 0
+    total_tasks = 0
+
+    for record in df.to_dict(orient="records"):
+        repaired_tasks = record["repaired_tasks"]
+        repair_hours = record["repair_hours"]
+
+        authors.append(
+            {
+                "author": record["author"],
+                "wrong_commit_message_qty": record["wrong_commit_message_qty"],
+                "repaired_tasks": repaired_tasks,
+                "mtr": format_hours(repair_hours / repaired_tasks)
+                if repaired_tasks > 0
+                else None,
+            }
+        )
 
-    if mtr_times:
-        average_time_diff = sum(mtr_times) / len(mtr_times)
-        #result['mtr_all'] = format_timedelta(timedelta(seconds=average_time_diff))
-        formatted = str(timedelta(hours=average_time_diff))
-        if len(formatted) == 22:
-            formatted_result = formatted[:-7]
-            result['mtr_all'] = formatted_result
-        if len(formatted) == 23:
-            formatted_result = formatted[:-8]
-            result['mtr_all'] = formatted_result
-    else:
-        result['mtr_all'] = "No MTR Times found."
+        total_hours += repair_hours
+        total_tasks += repaired_tasks
 
+    result = {
+        "statusCode": 200,
+        "data": {
+            "authors": authors,
+            "mtr_all": format_hours(total_hours / total_tasks)
+            if total_tasks > 0
+            else "No MTR Times found.",
+        },
+    }
 
-    return result
+    return jsonify(result)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+import os
+import time
+from flask import g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from sqlalchemy import event
+
+# Under gunicorn, PROMETHEUS_MULTIPROC_DIR (which gunicorn.conf.py sets) makes
+# every worker write its samples to files in that directory, and /metrics
+# aggregates them.
+# The jobs-worker and sync-scheduler processes, where syncs run, serve their
+# own samples with start_exporter instead.
+
+REQUEST_LATENCY = Histogram(
+    "xtvt_http_request_duration_seconds",
+    "Latency of HTTP requests, per route",
+    ["method", "route", "status"],
+)
+DB_QUERIES = Counter(
+    "xtvt_db_queries_total",
+    "SQL statements executed, per route",
+    ["route"],
+)
+DB_QUERY_SECONDS = Counter(
+    "xtvt_db_query_seconds_total",
+    "Time spent executing SQL statements, per route",
+    ["route"],
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "xtvt_db_queries_per_request",
+    "SQL statements executed by one HTTP request",
+    ["route"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500),
+)
+DB_SECONDS_PER_REQUEST = Histogram(
+    "xtvt_db_seconds_per_request",
+    "Time one HTTP request spent executing SQL statements",
+    ["route"],
+)
+BITBUCKET_REQUESTS = Counter(
+    "xtvt_bitbucket_requests_total",
+    "Bitbucket API calls, per endpoint type and status code",
+    ["endpoint", "status"],
+)
+BITBUCKET_BYTES = Counter(
+    "xtvt_bitbucket_response_bytes_total",
+    "Bytes received from the Bitbucket API, per endpoint type",
+    ["endpoint"],
+)
+BITBUCKET_LATENCY = Histogram(
+    "xtvt_bitbucket_request_duration_seconds",
+    "Latency of Bitbucket API calls, per endpoint type",
+    ["endpoint"],
+)
+SYNC_PAGES = Counter(
+    "xtvt_sync_pages_fetched_total",
+    "Pages (or single items) fetched by syncs, per table",
+    ["table"],
+)
+SYNC_RECORDS = Counter(
+    "xtvt_sync_records_written_total",
+    "Records written by syncs, per table",
+    ["table"],
+)
+
+
+def current_route():
+    # Queries made outside of a request come from jobs, the scheduler or CLI commands
+    if not has_request_context():
+        return "background"
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+def before_request():
+    g.metrics_started_at = time.perf_counter()
+    g.metrics_db_queries = 0
+    g.metrics_db_seconds = 0.0
+
+
+def after_request(response):
+    started_at = g.get("metrics_started_at")
+    if started_at is None:
+        return response
+
+    route = current_route()
+    REQUEST_LATENCY.labels(request.method, route, response.status_code).observe(
+        time.perf_counter() - started_at
+    )
+    DB_QUERIES_PER_REQUEST.labels(route).observe(g.metrics_db_queries)
+    DB_SECONDS_PER_REQUEST.labels(route).observe(g.metrics_db_seconds)
+    return response
+
+
+def init_app(app):
+    """Time every request of a Flask app."""
+    app.before_request(before_request)
+    app.after_request(after_request)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started_at", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_started_at"].pop()
+
+    route = current_route()
+    DB_QUERIES.labels(route).inc()
+    DB_QUERY_SECONDS.labels(route).inc(elapsed)
+
+    if has_request_context() and "metrics_db_queries" in g:
+        g.metrics_db_queries += 1
+        g.metrics_db_seconds += elapsed
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute, drop its start time
+    conn = context.connection
+    if conn is not None and context.execution_context is not None and conn.info.get("metrics_started_at"):
+        conn.info["metrics_started_at"].pop()
+
+
+def instrument_engine(engine):
+    """Count and time every statement executed through a SQLAlchemy engine."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def observe_bitbucket_call(endpoint, response, elapsed):
+    BITBUCKET_REQUESTS.labels(endpoint, response.status_code).inc()
+    BITBUCKET_BYTES.labels(endpoint).inc(len(response.content))
+    BITBUCKET_LATENCY.labels(endpoint).observe(elapsed)
+
+
+def observe_sync_page(table_name, records_written):
+    SYNC_PAGES.labels(table_name).inc()
+    SYNC_RECORDS.labels(table_name).inc(records_written)
+
+
+def render_metrics():
+    """Return the Prometheus text exposition of all metrics, and its content type."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_exporter(port):
+    """Serve the metrics of this process over HTTP on port, in a background thread.
+
+    For processes without the web routes, e.g. the jobs worker and the sync
+    scheduler: their samples are not visible from the web process' /metrics.
+    """
+    try:
+        start_http_server(port)
+    except OSError as e:
+        # Syncs keep running without their metrics
+        print(f"Could not serve metrics on port {port}: {e}")
+        return False
+
+    print(f"Serving metrics on port {port}")
+    return True
@@ -10,7 +10,7 @@ CREATE TABLE IF NOT EXISTS bb_commits (
 );
 
 CREATE TABLE IF NOT EXISTS bb_pullrequests (
-    id VARCHAR(50) PRIMARY KEY,
+    id VARCHAR(50),
     title TEXT,
     description TEXT,
     state TEXT,
@@ -19,9 +19,24 @@ CREATE TABLE IF NOT EXISTS bb_pullrequests (
     repo VARCHAR(255),
     created_at VARCHAR(50),
     updated_at VARCHAR(50), 
-    branch TEXT
+    branch TEXT,
+    PRIMARY KEY (repo, id)
 );
 
+-- Bitbucket numbers pull requests per repository, older deployments keyed them on id alone
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1
+        FROM pg_constraint
+        WHERE conrelid = 'bb_pullrequests'::regclass AND contype = 'p' AND cardinality(conkey) = 2
+    ) THEN
+        ALTER TABLE bb_pullrequests DROP CONSTRAINT IF EXISTS bb_pullrequests_pkey;
+        ALTER TABLE bb_pullrequests ADD PRIMARY KEY (repo, id);
+    END IF;
+END;
+$$;
+
 CREATE TABLE IF NOT EXISTS bb_sync_history (
     tbl VARCHAR(50),
     repo VARCHAR(255),
@@ -36,4 +51,233 @@ CREATE TABLE IF NOT EXISTS bb_mtr (
     commit_message VARCHAR(255),
     created_at VARCHAR(50),
     commit_id VARCHAR(255) PRIMARY KEY
-);
\ No newline at end of file
+);
+
+-- Older deployments created bb_mtr through pandas without a primary key
+CREATE UNIQUE INDEX IF NOT EXISTS bb_mtr_commit_id_idx ON bb_mtr (commit_id);
+
+-- Per author x task rollup of bb_mtr, maintained incrementally by append_mtr.
+-- Messages without a task prefix are accumulated in the task = '' row.
+CREATE TABLE IF NOT EXISTS bb_mtr_rollup (
+    author VARCHAR(255),
+    task VARCHAR(255),
+    first_commit_at TIMESTAMPTZ,
+    last_commit_at TIMESTAMPTZ,
+    commit_count INTEGER NOT NULL DEFAULT 0,
+    repair_hours DOUBLE PRECISION NOT NULL DEFAULT 0,
+    malformed_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (author, task)
+);
+
+-- Seed the rollup with the commits synced so far (same query as rebuild_mtr_rollup)
+INSERT INTO bb_mtr_rollup(
+    author, task, first_commit_at, last_commit_at,
+    commit_count, repair_hours, malformed_count
+)
+SELECT
+    author,
+    task,
+    MIN(created_at),
+    MAX(created_at),
+    COUNT(*),
+    EXTRACT(EPOCH FROM (MAX(created_at) - MIN(created_at))) / 3600,
+    COUNT(*) FILTER (WHERE task = '')
+FROM (
+    SELECT
+        author,
+        CASE
+            WHEN STRPOS(commit_message, '/') > 0
+            THEN SPLIT_PART(commit_message, '/', 1)
+            ELSE ''
+        END AS task,
+        CAST(created_at AS TIMESTAMPTZ) AS created_at
+    FROM bb_mtr
+) AS t
+GROUP BY author, task
+ON CONFLICT (author, task) DO UPDATE SET
+    first_commit_at = EXCLUDED.first_commit_at,
+    last_commit_at = EXCLUDED.last_commit_at,
+    commit_count = EXCLUDED.commit_count,
+    repair_hours = EXCLUDED.repair_hours,
+    malformed_count = EXCLUDED.malformed_count;
+
+-- Per commit, per file change volume, filled by /sync/diffs as diffs are ingested
+CREATE TABLE IF NOT EXISTS bb_commit_churn (
+    commit_id VARCHAR(50) REFERENCES bb_commits (id) ON DELETE CASCADE,
+    path TEXT,
+    repo VARCHAR(255),
+    author VARCHAR(255),
+    author_id VARCHAR(50),
+    created_at TIMESTAMPTZ,
+    lines_added INTEGER NOT NULL DEFAULT 0,
+    lines_removed INTEGER NOT NULL DEFAULT 0,
+    is_binary BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (commit_id, path)
+);
+
+CREATE INDEX IF NOT EXISTS bb_commit_churn_author_idx ON bb_commit_churn (author_id, created_at);
+CREATE INDEX IF NOT EXISTS bb_commit_churn_author_name_idx ON bb_commit_churn (author, created_at);
+CREATE INDEX IF NOT EXISTS bb_commit_churn_repo_idx ON bb_commit_churn (repo, created_at);
+CREATE INDEX IF NOT EXISTS bb_commit_churn_path_idx ON bb_commit_churn (repo, path);
+
+-- Background sync jobs, see jobs.py
+CREATE TABLE IF NOT EXISTS bb_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    params JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    pages_fetched INTEGER NOT NULL DEFAULT 0,
+    records_written INTEGER NOT NULL DEFAULT 0,
+    errors JSONB NOT NULL DEFAULT '[]',
+    result JSONB,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS bb_jobs_queued_idx ON bb_jobs (id) WHERE status IN ('queued', 'running');
+
+-- Append-only pull request state transitions, one row each time a PR is seen in a new state
+CREATE TABLE IF NOT EXISTS bb_pullrequest_states (
+    repo VARCHAR(255),
+    pullrequest_id VARCHAR(50),
+    state TEXT,
+    changed_at TIMESTAMPTZ,
+    author VARCHAR(255),
+    author_id VARCHAR(50),
+    pr_created_at TIMESTAMPTZ,
+    recorded_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (repo, pullrequest_id, changed_at, state)
+);
+
+-- query_pullrequest_cycle_time filters on pr_created_at alone, then groups by author or repo
+DROP INDEX IF EXISTS bb_pullrequest_states_author_idx;
+CREATE INDEX IF NOT EXISTS bb_pullrequest_states_created_at_idx ON bb_pullrequest_states (pr_created_at);
+CREATE INDEX IF NOT EXISTS bb_pullrequest_states_repo_idx ON bb_pullrequest_states (repo, pr_created_at);
+
+-- Seed the history with the current state of the pull requests synced so far
+INSERT INTO bb_pullrequest_states(repo, pullrequest_id, state, changed_at, author, author_id, pr_created_at)
+SELECT repo, id, state, CAST(updated_at AS TIMESTAMPTZ), author, author_id, CAST(created_at AS TIMESTAMPTZ)
+FROM bb_pullrequests
+ON CONFLICT DO NOTHING;
+
+-- Branches containing each commit, filled as branches are walked by the MTR sync
+-- and by push webhooks. A commit usually belongs to several branches.
+CREATE TABLE IF NOT EXISTS bb_commit_branches (
+    repo VARCHAR(255),
+    branch TEXT,
+    commit_id VARCHAR(50),
+    first_seen_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (repo, branch, commit_id)
+);
+
+CREATE INDEX IF NOT EXISTS bb_commit_branches_commit_idx ON bb_commit_branches (commit_id);
+
+-- created_at is stored as the ISO string Bitbucket returns. created_at_ts holds
+-- it as a timestamp, kept in sync by a trigger, so date ranges can use an index.
+ALTER TABLE bb_commits ADD COLUMN IF NOT EXISTS created_at_ts TIMESTAMPTZ;
+
+CREATE OR REPLACE FUNCTION bb_commits_set_created_at_ts() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.created_at_ts := CAST(NEW.created_at AS TIMESTAMPTZ);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS bb_commits_created_at_ts ON bb_commits;
+CREATE TRIGGER bb_commits_created_at_ts
+    BEFORE INSERT OR UPDATE OF created_at ON bb_commits
+    FOR EACH ROW EXECUTE FUNCTION bb_commits_set_created_at_ts();
+
+UPDATE bb_commits
+SET created_at_ts = CAST(created_at AS TIMESTAMPTZ)
+WHERE created_at_ts IS NULL AND created_at IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS bb_commits_author_id_created_at_idx ON bb_commits (author_id, created_at_ts);
+CREATE INDEX IF NOT EXISTS bb_commits_author_created_at_idx ON bb_commits (author, created_at_ts);
+CREATE INDEX IF NOT EXISTS bb_commits_created_at_idx ON bb_commits (created_at_ts);
+
+-- Commits per UTC day x author x repo, maintained incrementally by append_commits
+-- (lines by append_churn) and rebuilt in bulk by rebuild_commit_daily
+CREATE TABLE IF NOT EXISTS bb_commit_daily (
+    author_id VARCHAR(50),
+    day DATE,
+    repo VARCHAR(255),
+    author VARCHAR(255),
+    commit_count INTEGER NOT NULL DEFAULT 0,
+    lines_added INTEGER NOT NULL DEFAULT 0,
+    lines_removed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (author_id, day, repo)
+);
+
+CREATE INDEX IF NOT EXISTS bb_commit_daily_author_idx ON bb_commit_daily (author, day);
+CREATE INDEX IF NOT EXISTS bb_commit_daily_repo_idx ON bb_commit_daily (repo, day);
+CREATE INDEX IF NOT EXISTS bb_commit_daily_day_idx ON bb_commit_daily (day);
+
+-- Seed the rollup with the commits synced so far (same query as rebuild_commit_daily).
+-- Counts are recomputed from bb_commits, so running this again corrects them.
+INSERT INTO bb_commit_daily(author_id, day, repo, author, commit_count, lines_added, lines_removed)
+SELECT
+    COALESCE(commits.author_id, commits.author),
+    CAST(commits.created_at_ts AT TIME ZONE 'UTC' AS DATE),
+    commits.repo,
+    MAX(commits.author),
+    COUNT(*),
+    COALESCE(SUM(churn.lines_added), 0),
+    COALESCE(SUM(churn.lines_removed), 0)
+FROM bb_commits AS commits
+LEFT JOIN (
+    SELECT commit_id, SUM(lines_added) AS lines_added, SUM(lines_removed) AS lines_removed
+    FROM bb_commit_churn
+    GROUP BY commit_id
+) AS churn ON churn.commit_id = commits.id
+WHERE commits.created_at_ts IS NOT NULL
+GROUP BY 1, 2, 3
+ON CONFLICT (author_id, day, repo) DO UPDATE SET
+    author = EXCLUDED.author,
+    commit_count = EXCLUDED.commit_count,
+    lines_added = EXCLUDED.lines_added,
+    lines_removed = EXCLUDED.lines_removed;
+
+-- Full-text search. The 'simple' configuration does no stemming, so codes such
+-- as TASK-123 are indexed as written; PR titles rank above their descriptions.
+-- Adding the generated columns rewrites the tables once.
+ALTER TABLE bb_commits ADD COLUMN IF NOT EXISTS msg_tsv TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('simple', COALESCE(msg, ''))) STORED;
+
+ALTER TABLE bb_pullrequests ADD COLUMN IF NOT EXISTS search_tsv TSVECTOR
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', COALESCE(title, '')), 'A')
+        || setweight(to_tsvector('simple', COALESCE(description, '')), 'B')
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS bb_commits_msg_tsv_idx ON bb_commits USING GIN (msg_tsv);
+CREATE INDEX IF NOT EXISTS bb_pullrequests_search_tsv_idx ON bb_pullrequests USING GIN (search_tsv);
+
+-- Diffstat sync mode: churn comes from the diffstat endpoint and the diff text is
+-- only fetched when a commit is opened, so processed commits are marked instead
+ALTER TABLE bb_commits ADD COLUMN IF NOT EXISTS diffstat_synced_at TIMESTAMPTZ;
+
+-- Progress of the sync running for a table/repo (and branch, for MTR), written
+-- in the same transaction as each batch so an interrupted sync resumes from it.
+-- Rows are deleted once the sync completes and bb_sync_history moves forward.
+-- next_page is the Bitbucket url of the page to fetch next.
+CREATE TABLE IF NOT EXISTS bb_sync_checkpoints (
+    tbl VARCHAR(50),
+    repo VARCHAR(255),
+    branch VARCHAR(255) NOT NULL DEFAULT '',
+    next_page TEXT,
+    last_id VARCHAR(255),
+    watermark VARCHAR(50),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (tbl, repo, branch)
+);
+
+-- bb_mtr.created_at as a timestamp, set by append_mtr. It is the partition key
+-- once postgresql-db_v1.4.sql is applied.
+ALTER TABLE bb_mtr ADD COLUMN IF NOT EXISTS created_at_ts TIMESTAMPTZ;
+
+UPDATE bb_mtr
+SET created_at_ts = CAST(created_at AS TIMESTAMPTZ)
+WHERE created_at_ts IS NULL AND created_at IS NOT NULL;
@@ -0,0 +1,133 @@
+-- Range-partitions bb_commits and bb_mtr by commit month (UTC) on created_at_ts.
+-- Apply once, after postgresql-db_v1.3.sql, then restart the app: db_utils looks
+-- up which tables are partitioned once per process. The rows are copied in a
+-- single transaction that locks both tables, run it in a maintenance window.
+-- Creating a partition locks its parent table, so partitions of the coming months
+-- are created ahead of time by the sync scheduler or `flask --app main
+-- create-partitions`; ingest only creates them as a fallback, see
+-- ensure_month_partitions.
+-- Rows without a commit date cannot be routed to a partition, they are deleted.
+
+BEGIN;
+
+-- Creates the partition of parent holding the month of the given day,
+-- named like bb_commits_y2024m01, unless it exists already
+CREATE OR REPLACE FUNCTION bb_create_month_partition(parent TEXT, month DATE) RETURNS VOID AS $$
+DECLARE
+    first_day DATE := make_date(CAST(EXTRACT(YEAR FROM month) AS INT), CAST(EXTRACT(MONTH FROM month) AS INT), 1);
+    partition_name TEXT := parent || '_y' || to_char(first_day, 'YYYY"m"MM');
+BEGIN
+    -- Existing partitions return before CREATE TABLE locks the parent
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    -- Concurrent ingests of the first commits of a month wait for each other
+    PERFORM pg_advisory_xact_lock(hashtext(partition_name));
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name,
+        parent,
+        CAST(first_day AS TIMESTAMP) AT TIME ZONE 'UTC',
+        CAST(first_day + INTERVAL '1 month' AS TIMESTAMP) AT TIME ZONE 'UTC'
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+-- The partition key is part of the primary key, so it cannot be NULL. Fill it
+-- where v1.3 did not, then drop the rows without a date (and, through the
+-- foreign key below, their churn).
+UPDATE bb_commits
+SET created_at_ts = CAST(created_at AS TIMESTAMPTZ)
+WHERE created_at_ts IS NULL AND created_at IS NOT NULL;
+DELETE FROM bb_commits WHERE created_at_ts IS NULL;
+
+UPDATE bb_mtr
+SET created_at_ts = CAST(created_at AS TIMESTAMPTZ)
+WHERE created_at_ts IS NULL AND created_at IS NOT NULL;
+DELETE FROM bb_mtr WHERE created_at_ts IS NULL;
+
+-- A partitioned table can only be referenced through its whole primary key.
+-- append_churn only inserts the churn of commits found in bb_commits.
+ALTER TABLE bb_commit_churn DROP CONSTRAINT IF EXISTS bb_commit_churn_commit_id_fkey;
+
+-- bb_commits
+
+ALTER TABLE bb_commits RENAME TO bb_commits_unpartitioned;
+ALTER INDEX bb_commits_pkey RENAME TO bb_commits_unpartitioned_pkey;
+
+-- The partition key must be part of the primary key, commit dates never change
+CREATE TABLE bb_commits (
+    id VARCHAR(50),
+    author VARCHAR(255),
+    author_id VARCHAR(50),
+    msg TEXT,
+    created_at VARCHAR(255),
+    repo VARCHAR(255),
+    diff TEXT,
+    branch TEXT,
+    created_at_ts TIMESTAMPTZ,
+    msg_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', COALESCE(msg, ''))) STORED,
+    diffstat_synced_at TIMESTAMPTZ,
+    PRIMARY KEY (id, created_at_ts)
+) PARTITION BY RANGE (created_at_ts);
+
+SELECT bb_create_month_partition('bb_commits', CAST(month AS DATE))
+FROM generate_series(
+    (SELECT date_trunc('month', MIN(created_at_ts) AT TIME ZONE 'UTC') FROM bb_commits_unpartitioned),
+    (SELECT date_trunc('month', MAX(created_at_ts) AT TIME ZONE 'UTC') FROM bb_commits_unpartitioned),
+    INTERVAL '1 month'
+) AS month;
+
+INSERT INTO bb_commits (id, author, author_id, msg, created_at, repo, diff, branch, created_at_ts, diffstat_synced_at)
+SELECT id, author, author_id, msg, created_at, repo, diff, branch, created_at_ts, diffstat_synced_at
+FROM bb_commits_unpartitioned;
+
+DROP TABLE bb_commits_unpartitioned;
+
+-- Rows are routed to their partition before BEFORE triggers run, so writers
+-- set created_at_ts themselves; the trigger only keeps it equal to created_at
+CREATE TRIGGER bb_commits_created_at_ts
+    BEFORE INSERT OR UPDATE OF created_at ON bb_commits
+    FOR EACH ROW EXECUTE FUNCTION bb_commits_set_created_at_ts();
+
+CREATE INDEX bb_commits_author_id_created_at_idx ON bb_commits (author_id, created_at_ts);
+CREATE INDEX bb_commits_author_created_at_idx ON bb_commits (author, created_at_ts);
+CREATE INDEX bb_commits_created_at_idx ON bb_commits (created_at_ts);
+CREATE INDEX bb_commits_msg_tsv_idx ON bb_commits USING GIN (msg_tsv);
+
+-- bb_mtr
+
+ALTER TABLE bb_mtr RENAME TO bb_mtr_unpartitioned;
+ALTER INDEX IF EXISTS bb_mtr_pkey RENAME TO bb_mtr_unpartitioned_pkey;
+ALTER INDEX IF EXISTS bb_mtr_commit_id_idx RENAME TO bb_mtr_unpartitioned_commit_id_idx;
+
+-- Named like the unique index of postgresql-db_v1.3.sql, so re-applying that
+-- file skips it instead of failing on a unique index without the partition key
+CREATE TABLE bb_mtr (
+    id VARCHAR(50),
+    repository VARCHAR(255),
+    author VARCHAR(255),
+    commit_message VARCHAR(255),
+    created_at VARCHAR(50),
+    commit_id VARCHAR(255),
+    created_at_ts TIMESTAMPTZ,
+    CONSTRAINT bb_mtr_commit_id_idx PRIMARY KEY (commit_id, created_at_ts)
+) PARTITION BY RANGE (created_at_ts);
+
+SELECT bb_create_month_partition('bb_mtr', CAST(month AS DATE))
+FROM generate_series(
+    (SELECT date_trunc('month', MIN(created_at_ts) AT TIME ZONE 'UTC') FROM bb_mtr_unpartitioned),
+    (SELECT date_trunc('month', MAX(created_at_ts) AT TIME ZONE 'UTC') FROM bb_mtr_unpartitioned),
+    INTERVAL '1 month'
+) AS month;
+
+INSERT INTO bb_mtr (id, repository, author, commit_message, created_at, commit_id, created_at_ts)
+SELECT id, repository, author, commit_message, created_at, commit_id, created_at_ts
+FROM bb_mtr_unpartitioned;
+
+DROP TABLE bb_mtr_unpartitioned;
+
+COMMIT;
+
+ANALYZE bb_commits;
+ANALYZE bb_mtr;
@@ -0,0 +1,167 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Statements whose plan can be captured. Plain EXPLAIN only plans them: re-running
+# them under ANALYZE would repeat side effects, e.g. take an advisory lock twice.
+EXPLAINABLE_PATTERN = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+_settings = {
+    "threshold_ms": 500,
+    "explain": False,
+    "explain_interval": 300,
+    "log_size": 100,
+}
+_lock = threading.Lock()
+_stats = {}
+_slow_queries = deque(maxlen=_settings["log_size"])
+_explained_at = {}
+
+
+def configure(threshold_ms, explain, explain_interval, log_size):
+    """Set the slow query threshold and whether their plans are captured."""
+    global _slow_queries
+    _settings["threshold_ms"] = threshold_ms
+    _settings["explain"] = explain
+    _settings["explain_interval"] = explain_interval
+    _settings["log_size"] = log_size
+    with _lock:
+        _slow_queries = deque(_slow_queries, maxlen=log_size)
+
+
+def normalize(statement):
+    return WHITESPACE_PATTERN.sub(" ", statement).strip()
+
+
+def redact(parameters, executemany):
+    # Keep the parameter names, never their values
+    if executemany:
+        return {"executemany": len(parameters)}
+    if isinstance(parameters, dict):
+        return {key: "?" for key in parameters}
+    if parameters:
+        return ["?"] * len(parameters)
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profiler_started_at", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["profiler_started_at"].pop()) * 1000
+    key = normalize(statement)
+
+    with _lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = {"statement": key, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "slow": 0}
+            _stats[key] = stats
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+    if elapsed_ms < _settings["threshold_ms"]:
+        return
+
+    entry = {
+        "statement": key,
+        "parameters": redact(parameters, executemany),
+        "duration_ms": round(elapsed_ms, 2),
+        "at": time.time(),
+        "plan": None,
+    }
+    logger.warning(
+        "Slow query (%.0f ms): %s parameters=%s", elapsed_ms, key, entry["parameters"]
+    )
+
+    if _settings["explain"] and not executemany and _should_explain(key):
+        entry["plan"] = _explain(cursor, statement, parameters)
+
+    with _lock:
+        stats["slow"] += 1
+        _slow_queries.append(entry)
+
+
+def _should_explain(key):
+    if not EXPLAINABLE_PATTERN.match(key):
+        return False
+
+    # At most one plan per statement per interval
+    now = time.monotonic()
+    with _lock:
+        explained_at = _explained_at.get(key)
+        if explained_at is not None and now - explained_at < _settings["explain_interval"]:
+            return False
+        _explained_at[key] = now
+    return True
+
+
+def _explain(cursor, statement, parameters):
+    # psycopg2 cursors have fetched their rows already, so a second cursor
+    # on the same connection can run the EXPLAIN. A savepoint keeps a failing
+    # EXPLAIN from aborting the caller's transaction.
+    dbapi_connection = cursor.connection
+    in_transaction = not dbapi_connection.autocommit
+    explain_cursor = dbapi_connection.cursor()
+    try:
+        if in_transaction:
+            explain_cursor.execute("SAVEPOINT query_profiler_explain")
+        explain_cursor.execute(
+            "EXPLAIN (FORMAT JSON) " + statement, parameters
+        )
+        plan = explain_cursor.fetchone()[0]
+        if in_transaction:
+            explain_cursor.execute("RELEASE SAVEPOINT query_profiler_explain")
+        return json.loads(plan) if isinstance(plan, str) else plan
+    except Exception as e:
+        logger.warning("Could not capture query plan: %s", e)
+        if in_transaction:
+            explain_cursor.execute("ROLLBACK TO SAVEPOINT query_profiler_explain")
+        return None
+    finally:
+        explain_cursor.close()
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute, drop its start time
+    conn = context.connection
+    if conn is not None and context.execution_context is not None and conn.info.get("profiler_started_at"):
+        conn.info["profiler_started_at"].pop()
+
+
+def profile_engine(engine):
+    """Time every statement executed through a SQLAlchemy engine and log the slow ones."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def report(limit=50):
+    """Return the slowest statements of this process and its recent slow queries."""
+    with _lock:
+        stats = sorted(_stats.values(), key=lambda s: s["total_ms"], reverse=True)
+        statements = [
+            dict(s, mean_ms=round(s["total_ms"] / s["count"], 2)) for s in stats[:limit]
+        ]
+        slow_queries = list(reversed(_slow_queries))
+
+    return {
+        "threshold_ms": _settings["threshold_ms"],
+        "statements": statements,
+        "slow_queries": slow_queries,
+    }
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _slow_queries.clear()
+        _explained_at.clear()
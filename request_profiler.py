@@ -0,0 +1,99 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+import uuid
+from flask import g, request
+
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+SORT_KEYS = tuple(key.value for key in pstats.SortKey)
+
+
+def wants_profile():
+    # Opt in per request with "X-Profile: 1" or "?profile=1"
+    return request.headers.get("X-Profile") == "1" or request.args.get("profile") == "1"
+
+
+def before_request():
+    if not wants_profile():
+        return
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+def make_after_request(directory, max_files):
+    def after_request(response):
+        profiler = g.pop("profiler", None)
+        if profiler is None:
+            return response
+        profiler.disable()
+
+        # The .pstats file opens in snakeviz, or converts to a flamegraph with flameprof
+        profile_id = uuid.uuid4().hex
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(profile_path(directory, profile_id))
+        prune(directory, max_files)
+
+        print(f"Profiled {request.method} {request.path}: {profile_id}")
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    return after_request
+
+
+def init_app(app):
+    """Profile the requests that ask for it, when PROFILER_ENABLED is set.
+
+    Nothing is registered otherwise, so disabled profiling costs nothing.
+    """
+    if not app.config["PROFILER_ENABLED"]:
+        return
+    app.before_request(before_request)
+    app.after_request(make_after_request(app.config["PROFILER_DIR"], app.config["PROFILER_MAX_FILES"]))
+
+
+def profile_path(directory, profile_id):
+    return os.path.join(directory, f"{profile_id}.pstats")
+
+
+def prune(directory, max_files):
+    """Delete the oldest profiles of directory, keeping the max_files most recent."""
+    paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".pstats")]
+    if len(paths) <= max_files:
+        return
+
+    def modified_at(path):
+        try:
+            return os.path.getmtime(path)
+        except FileNotFoundError:
+            return 0
+
+    paths.sort(key=modified_at)
+    for path in paths[: len(paths) - max_files]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Pruned by another worker already
+            pass
+
+
+def summarize(directory, profile_id, sort="cumulative", limit=50):
+    """Return the text report of a stored profile, or None if it does not exist.
+
+    Raises ValueError if sort is not one of SORT_KEYS.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Invalid sort, expected one of: {', '.join(SORT_KEYS)}")
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    path = profile_path(directory, profile_id)
+    if not os.path.exists(path):
+        return None
+
+    output = io.StringIO()
+    stats = pstats.Stats(path, stream=output)
+    stats.sort_stats(sort).print_stats(limit)
+    created_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(os.path.getmtime(path)))
+    return f"Profile {profile_id} ({created_at})\n{output.getvalue()}"
@@ -0,0 +1,112 @@
+import random
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from db_utils import create_upcoming_partitions
+from sync import (
+    SyncProgress,
+    sync_commits,
+    sync_pullrequests,
+    sync_diffs,
+    sync_mtr,
+)
+
+
+class RepoSchedule:
+    """When a repository is synced next, and how often."""
+
+    def __init__(self, repo, interval, next_run_at):
+        self.repo = repo
+        self.interval = interval
+        self.next_run_at = next_run_at
+
+    def reschedule(self, records_written, config):
+        # Busy repositories are polled more often, quiet ones back off
+        if records_written > 0:
+            self.interval = max(config["SYNC_MIN_INTERVAL"], self.interval / 2)
+        else:
+            self.interval = min(config["SYNC_MAX_INTERVAL"], self.interval * 2)
+
+        # Spread the runs so repositories with the same interval do not fire together
+        jitter = config["SYNC_JITTER"]
+        delay = self.interval * random.uniform(1 - jitter, 1 + jitter)
+        self.next_run_at = time.monotonic() + delay
+
+
+def sync_repo(engine, config, repo):
+    """Run commits -> pull requests -> diffs -> MTR for one repository."""
+    progress = SyncProgress()
+
+    sync_commits(engine, config, [repo], progress=progress)
+    sync_pullrequests(engine, config, [repo], progress=progress)
+    sync_diffs(engine, config, repo=repo, progress=progress)
+    sync_mtr(engine, config, [repo], progress=progress)
+
+    return progress
+
+
+# Seconds between two checks that the partitions of the coming months exist
+PARTITIONS_INTERVAL = 6 * 3600
+
+
+def create_partitions(engine, config):
+    """Create the coming months' partitions, so ingest does not lock the tables to do it."""
+    try:
+        create_upcoming_partitions(engine, config["PARTITION_MONTHS_AHEAD"])
+    except Exception:
+        traceback.print_exc()
+    return time.monotonic() + PARTITIONS_INTERVAL
+
+
+def run_scheduler(engine, config):
+    """Sync every configured repository periodically, until the process is stopped."""
+    parallelism = config["SYNC_PARALLELISM"]
+    min_interval = config["SYNC_MIN_INTERVAL"]
+
+    # Stagger the first runs over one minimum interval
+    now = time.monotonic()
+    schedules = [
+        RepoSchedule(repo, min_interval, now + random.uniform(0, min_interval))
+        for repo in config["BITBUCKET_REPOS"]
+    ]
+    print(f"Scheduling {len(schedules)} repos, {parallelism} at a time...")
+    if len(schedules) == 0:
+        return
+
+    partitions_at = create_partitions(engine, config)
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        while True:
+            now = time.monotonic()
+            if now >= partitions_at:
+                partitions_at = create_partitions(engine, config)
+
+            due = sorted(
+                (s for s in schedules if s.repo not in running.values() and s.next_run_at <= now),
+                key=lambda s: s.next_run_at,
+            )
+            for schedule in due[: parallelism - len(running)]:
+                print(f"Syncing {schedule.repo} (interval: {schedule.interval:.0f}s)")
+                future = pool.submit(sync_repo, engine, config, schedule.repo)
+                running[future] = schedule.repo
+
+            # Sleep until a sync finishes, the next repository is due or partitions are checked
+            pending = [s.next_run_at for s in schedules if s.repo not in running.values()]
+            timeout = max(min(pending + [partitions_at]) - time.monotonic(), 1)
+            if len(running) == 0:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                repo = running.pop(future)
+                schedule = next(s for s in schedules if s.repo == repo)
+                try:
+                    progress = future.result()
+                    records_written = progress.records_written
+                    print(f"Synced {repo}: {records_written} records, {len(progress.errors)} errors")
+                except Exception:
+                    traceback.print_exc()
+                    records_written = 0
+                schedule.reschedule(records_written, config)
@@ -4,16 +4,152 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+
+class ConfigError(Exception):
+    pass
+
+
+# Every problem is collected, then reported at once at the end of the file
+_errors = []
+
+
+def _str(name, default=None, required=False, choices=None):
+    value = environ.get(name) or default
+    if required and not value:
+        _errors.append(f"{name} is required")
+    elif choices and value not in choices:
+        _errors.append(f"{name} must be one of {', '.join(choices)}, got {value!r}")
+    return value
+
+
+def _number(name, default, convert, minimum=None, maximum=None):
+    value = environ.get(name)
+    if not value:
+        return default
+    try:
+        number = convert(value)
+    except ValueError:
+        kind = "an integer" if convert is int else "a number"
+        _errors.append(f"{name} must be {kind}, got {value!r}")
+        return default
+    if minimum is not None and number < minimum:
+        _errors.append(f"{name} must be at least {minimum}, got {number}")
+    if maximum is not None and number > maximum:
+        _errors.append(f"{name} must be at most {maximum}, got {number}")
+    return number
+
+
+def _int(name, default, minimum=None, maximum=None):
+    return _number(name, default, int, minimum, maximum)
+
+
+def _float(name, default, minimum=None, maximum=None):
+    return _number(name, default, float, minimum, maximum)
+
+
+def _bool(name, default=False):
+    value = environ.get(name)
+    if not value:
+        return default
+    if value.lower() in ("true", "1", "yes"):
+        return True
+    if value.lower() in ("false", "0", "no"):
+        return False
+    _errors.append(f"{name} must be true or false, got {value!r}")
+    return default
+
+
+def _repos(name):
+    repos = [repo.strip() for repo in environ.get(name, "").split(",") if repo.strip()]
+    for repo in repos:
+        if len(repo.split("/")) != 2 or not all(repo.split("/")):
+            _errors.append(f"{name} entries must be \"workspace/repo\", got {repo!r}")
+    return repos
+
+
 # Bitbucket settings
-BITBUCKET_REPOS = environ.get("BITBUCKET_REPOS").split(",")
-BITBUCKET_USERNAME = environ.get("BITBUCKET_USERNAME")
-BITBUCKET_APP_PASSWORD = environ.get("BITBUCKET_APP_PASSWORD")
-BITBUCKET_API_BASE_URL = environ.get("BITBUCKET_API_BASE_URL")
+BITBUCKET_REPOS = _repos("BITBUCKET_REPOS")
+BITBUCKET_USERNAME = _str("BITBUCKET_USERNAME")
+BITBUCKET_APP_PASSWORD = _str("BITBUCKET_APP_PASSWORD")
+BITBUCKET_API_BASE_URL = _str("BITBUCKET_API_BASE_URL")
+# /webhooks/bitbucket only accepts payloads signed with it, and is disabled without it
+BITBUCKET_WEBHOOK_SECRET = _str("BITBUCKET_WEBHOOK_SECRET")
 
 # Database settings
-DB_HOST = environ.get("DB_HOST")
-DB_PORT = environ.get("DB_PORT")
-DB_USER = environ.get("DB_USER")
-DB_PSWD = environ.get("DB_PSWD")
-DB_NAME = environ.get("DB_NAME")
-DB_CHUNK_SIZE = int(environ.get("DB_CHUNK_SIZE"))
+DB_HOST = _str("DB_HOST", required=True)
+DB_PORT = _int("DB_PORT", None, minimum=1, maximum=65535)
+DB_USER = _str("DB_USER", required=True)
+DB_PSWD = _str("DB_PSWD")
+DB_NAME = _str("DB_NAME", required=True)
+DB_CHUNK_SIZE = _int("DB_CHUNK_SIZE", 1000, minimum=1)
+DB_SSLMODE = _str(
+    "DB_SSLMODE",
+    "require",
+    choices=("disable", "allow", "prefer", "require", "verify-ca", "verify-full"),
+)
+
+# Optional read replica: the query_* functions read from it, writes and sync
+# bookkeeping stay on DB_HOST. Port and credentials default to the primary's.
+DB_READ_HOST = _str("DB_READ_HOST")
+DB_READ_PORT = _int("DB_READ_PORT", DB_PORT, minimum=1, maximum=65535)
+DB_READ_USER = _str("DB_READ_USER", DB_USER)
+DB_READ_PSWD = _str("DB_READ_PSWD", DB_PSWD)
+# For this many seconds after a sync job finished, the client that polled it
+# can read from the primary (read-your-writes), 0 disables it
+DB_READ_YOUR_WRITES_SECONDS = _int("DB_READ_YOUR_WRITES_SECONDS", 60, minimum=0)
+
+# Connection pool of each web worker: at most DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW
+# connections, requests wait up to DB_POOL_TIMEOUT seconds for one
+DB_POOL_SIZE = _int("DB_POOL_SIZE", 5, minimum=1)
+DB_POOL_MAX_OVERFLOW = _int("DB_POOL_MAX_OVERFLOW", 10, minimum=0)
+DB_POOL_TIMEOUT = _float("DB_POOL_TIMEOUT", 30, minimum=0)
+
+# Diff parsing processes of each web worker, started on the first large page of
+# /<author>/diff. Kept small, every gunicorn worker gets its own pool.
+DIFF_PARSE_WORKERS = _int("DIFF_PARSE_WORKERS", 2, minimum=1)
+
+# Default mode of diff syncs: "diff" stores every raw diff, "diffstat" only
+# records the per-file line counts and fetches a diff when its commit is opened
+DIFF_SYNC_MODE = _str("DIFF_SYNC_MODE", "diff", choices=("diff", "diffstat"))
+
+# Background job settings
+JOB_WORKERS = _int("JOB_WORKERS", 2, minimum=1)
+JOB_POLL_INTERVAL = _float("JOB_POLL_INTERVAL", 5, minimum=0.1)
+JOB_STALE_AFTER = _int("JOB_STALE_AFTER", 900, minimum=1)
+
+# Repositories synced concurrently by one /sync/commits or /sync/pullrequests job
+SYNC_REPO_WORKERS = _int("SYNC_REPO_WORKERS", 4, minimum=1)
+
+# Periodic sync scheduler settings (intervals in seconds)
+SYNC_PARALLELISM = _int("SYNC_PARALLELISM", 4, minimum=1)
+SYNC_MIN_INTERVAL = _int("SYNC_MIN_INTERVAL", 300, minimum=1)
+SYNC_MAX_INTERVAL = _int("SYNC_MAX_INTERVAL", 21600, minimum=SYNC_MIN_INTERVAL)
+SYNC_JITTER = _float("SYNC_JITTER", 0.2, minimum=0, maximum=1)
+
+# Port on which the jobs-worker and sync-scheduler processes serve their
+# metrics (sync throughput, Bitbucket calls), 0 disables it. The web process
+# serves them on /metrics.
+METRICS_PORT = _int("METRICS_PORT", 9100, minimum=0, maximum=65535)
+
+# Months after the current one whose bb_commits/bb_mtr partitions the
+# scheduler creates ahead of ingest, once postgresql-db_v1.4.sql is applied
+PARTITION_MONTHS_AHEAD = _int("PARTITION_MONTHS_AHEAD", 2, minimum=0)
+
+# Slow query log: statements slower than the threshold are logged, and with
+# SLOW_QUERY_EXPLAIN their EXPLAIN plan (estimates, the query is not run again) is captured
+SLOW_QUERY_THRESHOLD_MS = _float("SLOW_QUERY_THRESHOLD_MS", 500, minimum=0)
+SLOW_QUERY_EXPLAIN = _bool("SLOW_QUERY_EXPLAIN")
+SLOW_QUERY_EXPLAIN_INTERVAL = _int("SLOW_QUERY_EXPLAIN_INTERVAL", 300, minimum=0)
+SLOW_QUERY_LOG_SIZE = _int("SLOW_QUERY_LOG_SIZE", 100, minimum=1)
+
+# Per-request profiler, triggered by the "X-Profile: 1" header or "?profile=1"
+PROFILER_ENABLED = _bool("PROFILER_ENABLED")
+PROFILER_DIR = _str("PROFILER_DIR", "profiles")
+# Only the most recent profiles are kept, older files are deleted
+PROFILER_MAX_FILES = _int("PROFILER_MAX_FILES", 100, minimum=1)
+
+# Enables the /debug/* routes
+DEBUG_ENDPOINTS = _bool("DEBUG_ENDPOINTS")
+
+if _errors:
+    raise ConfigError("Invalid configuration:\n  " + "\n  ".join(_errors))
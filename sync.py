@@ -0,0 +1,504 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+import traceback
+from sqlalchemy import text
+from bitbucket import Bitbucket
+from db_utils import (
+    append_commits,
+    upsert_pullrequests,
+    append_pullrequest_states,
+    append_mtr,
+    append_commit_branches,
+    append_commit_churn,
+    query_sync_history,
+    insert_sync_history,
+    query_sync_checkpoints,
+    save_sync_checkpoint,
+    delete_sync_checkpoints,
+    query_unprocessed_commits,
+    update_commit_diff,
+    update_commit_diffstat,
+)
+from diff_parser import iter_diff_files
+from generic_utils import LazyModule, date_to_iso_seconds
+from metrics import observe_sync_page
+
+pd = LazyModule("pandas")
+
+PULLREQUEST_STATES = ("OPEN", "MERGED", "DECLINED", "SUPERSEDED")
+
+
+class SyncError(Exception):
+    pass
+
+
+class SyncProgress:
+    """Counters reported by the sync functions, optionally forwarded to a callback.
+
+    Safe to share between the threads syncing several repositories.
+    """
+
+    def __init__(self, on_update=None):
+        self.pages_fetched = 0
+        self.records_written = 0
+        self.errors = []
+        self.on_update = on_update
+        self._lock = threading.Lock()
+
+    def add_page(self, records_written, table_name):
+        observe_sync_page(table_name, records_written)
+        with self._lock:
+            self.pages_fetched += 1
+            self.records_written += records_written
+            self._update()
+
+    def add_error(self, message):
+        print(message)
+        with self._lock:
+            self.errors.append(message)
+            self._update()
+
+    def _update(self):
+        if self.on_update is not None:
+            self.on_update(self)
+
+
+@contextmanager
+def sync_lock(engine, table_name, repo):
+    """Hold a Postgres advisory lock for a table/repo sync.
+
+    Yields False, without waiting, when another process already holds it.
+    """
+    key = f"{table_name}:{repo}"
+    with engine.connect() as conn:
+        # Autocommit so the connection does not sit idle in a transaction
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        acquired = conn.execute(
+            text("SELECT pg_try_advisory_lock(hashtext(:key))"), {"key": key}
+        ).scalar()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                conn.execute(text("SELECT pg_advisory_unlock(hashtext(:key))"), {"key": key})
+
+
+def init_bitbucket(config, repo):
+    workspace, repo_slug = repo.split("/")
+    return Bitbucket(
+        config["BITBUCKET_USERNAME"],
+        config["BITBUCKET_APP_PASSWORD"],
+        workspace,
+        repo_slug,
+        config.get("BITBUCKET_API_BASE_URL"),
+    )
+
+
+def sync_repos(engine, config, repos, table_name, sync_repo_table, page_size, progress):
+    """Run sync_repo_table for several repositories in parallel.
+
+    A failing repository does not stop the others. Returns the total count
+    and a summary per repository.
+    """
+
+    def sync_one(repo):
+        with sync_lock(engine, table_name, repo) as acquired:
+            if not acquired:
+                message = f"{table_name} sync for {repo} is already running"
+                progress.add_error(message)
+                return {"status": "skipped", "count": 0, "error": message}
+
+            try:
+                count = sync_repo_table(engine, config, repo, page_size, progress)
+            except Exception as e:
+                traceback.print_exc()
+                message = f"{table_name} sync for {repo} failed: {e}"
+                progress.add_error(message)
+                return {"status": "failed", "count": 0, "error": str(e)}
+
+            return {"status": "ok", "count": count}
+
+    workers = max(min(config["SYNC_REPO_WORKERS"], len(repos)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = dict(zip(repos, pool.map(sync_one, repos)))
+
+    return {
+        "count": sum(result["count"] for result in results.values()),
+        "repos": results,
+    }
+
+
+def resumable_checkpoint(engine, table_name, repo):
+    """Return the checkpoint an interrupted sync of the repo left, or None.
+
+    Its next_page is the url of the page to fetch next, None when the last
+    page was written but the history was not. Checkpoints holding a bare page
+    number were counted with a page size that is not known any more, so the
+    sync starts over rather than skip or repeat rows.
+    """
+    df_c = query_sync_checkpoints(engine, table_name, repo)
+    if len(df_c) == 0:
+        return None
+
+    checkpoint = df_c.iloc[0].to_dict()
+    if checkpoint["next_page"] is not None and checkpoint["next_page"].isdigit():
+        print(f"Ignoring {table_name} checkpoint of {repo} at page {checkpoint['next_page']}")
+        return None
+
+    return checkpoint
+
+
+def sync_commits(engine, config, repos, page_size=20, progress=None):
+    progress = progress or SyncProgress()
+    return sync_repos(
+        engine, config, repos, "bb_commits", sync_repo_commits, page_size, progress
+    )
+
+
+def sync_repo_commits(engine, config, repo, page_size, progress):
+    # Get the sync history for the repo
+    table_name = "bb_commits"
+    df_s = query_sync_history(engine, table_name, repo)
+    last_synced_at = None
+    if len(df_s) > 0:
+        updated_at = df_s.iloc[0]["updated_at"]
+        last_synced_at = datetime.fromisoformat(updated_at)
+        print(f"Last synced at: {last_synced_at}")
+
+    # Initialize Bitbucket client
+    bitbucket = init_bitbucket(config, repo)
+
+    # Resume an interrupted sync from the next page url stored after its last
+    # written page. It keeps the start time of that run, which becomes the
+    # history once done.
+    url = bitbucket.commits_url(page_size=page_size)
+    started_at = date_to_iso_seconds(datetime.now())
+    checkpoint = resumable_checkpoint(engine, table_name, repo)
+    if checkpoint is not None:
+        url = checkpoint["next_page"]
+        started_at = checkpoint["watermark"]
+        print(f"Resuming at {url}, after commit {checkpoint['last_id']}")
+
+    count = 0
+
+    while url is not None:
+        # Return a list of commits
+        records, next_url = bitbucket.list_commits_page(url)
+
+        if records is None:
+            raise SyncError(f"Failed to fetch commits of {repo}, {url}")
+
+        if len(records) == 0:
+            break
+
+        df = pd.DataFrame(records)
+
+        # The checkpoint is committed with the page it follows
+        with engine.begin() as conn:
+            inserted = append_commits(conn, df, config["DB_CHUNK_SIZE"])
+            save_sync_checkpoint(
+                conn, table_name, repo, next_page=next_url, last_id=records[-1]["id"], watermark=started_at
+            )
+
+        url = next_url
+        count += len(records)
+        progress.add_page(inserted or 0, table_name)
+
+        look_more = True
+        for index, row in df.iterrows():
+            created_at = datetime.fromisoformat(row["created_at"])
+            if last_synced_at is not None and created_at < last_synced_at:
+                print(f"Reached last synced record: {created_at} | {last_synced_at}")
+                look_more = False
+                break
+
+        if not look_more:
+            break
+
+    # Update the sync history for the repo
+    with engine.begin() as conn:
+        insert_sync_history(conn, table_name, repo, started_at)
+        delete_sync_checkpoints(conn, table_name, repo)
+
+    return count
+
+
+def sync_pullrequests(engine, config, repos, page_size=10, progress=None):
+    progress = progress or SyncProgress()
+    return sync_repos(
+        engine, config, repos, "bb_pullrequests", sync_repo_pullrequests, page_size, progress
+    )
+
+
+def sync_repo_pullrequests(engine, config, repo, page_size, progress):
+    # Get the watermark: the most recent updated_at stored by the previous sync
+    table_name = "bb_pullrequests"
+    df_s = query_sync_history(engine, table_name, repo)
+    last_updated_at = None
+    if len(df_s) > 0:
+        last_updated_at = datetime.fromisoformat(df_s.iloc[0]["updated_at"])
+        print(f"Last updated at: {last_updated_at}")
+
+    # Initialize Bitbucket client
+    bitbucket = init_bitbucket(config, repo)
+
+    # Pull requests in every state, most recently updated first. An interrupted
+    # sync resumes from the next page url stored after its last written page.
+    url = bitbucket.pullrequests_url(page_size=page_size, states=PULLREQUEST_STATES, sort="-updated_on")
+    watermark = None
+    checkpoint = resumable_checkpoint(engine, table_name, repo)
+    if checkpoint is not None:
+        url = checkpoint["next_page"]
+        watermark = checkpoint["watermark"]
+        print(f"Resuming at {url}, after pull request {checkpoint['last_id']}")
+
+    count = 0
+
+    while url is not None:
+        records, next_url = bitbucket.list_pullrequests_page(url)
+
+        if records is None:
+            raise SyncError(f"Failed to fetch pull requests of {repo}, {url}")
+
+        if len(records) == 0:
+            break
+
+        if watermark is None:
+            watermark = records[0]["updated_at"]
+
+        df = pd.DataFrame(records)
+
+        # Insert new pull requests and overwrite the ones whose updated_at advanced,
+        # the checkpoint is committed with the page it follows
+        with engine.begin() as conn:
+            written = upsert_pullrequests(conn, df, config["DB_CHUNK_SIZE"])
+            append_pullrequest_states(conn, records)
+            save_sync_checkpoint(
+                conn, table_name, repo, next_page=next_url, last_id=str(records[-1]["id"]), watermark=watermark
+            )
+
+        url = next_url
+        count += len(records)
+        progress.add_page(written or 0, table_name)
+
+        oldest_updated_at = datetime.fromisoformat(records[-1]["updated_at"])
+        if last_updated_at is not None and oldest_updated_at <= last_updated_at:
+            print(f"Reached last synced record: {oldest_updated_at} | {last_updated_at}")
+            break
+
+    # Move the watermark forward for the next sync
+    with engine.begin() as conn:
+        if watermark is not None:
+            insert_sync_history(conn, table_name, repo, watermark)
+        delete_sync_checkpoints(conn, table_name, repo)
+
+    return count
+
+
+DIFF_SYNC_MODES = ("diff", "diffstat")
+
+
+def sync_diffs(engine, config, repo=None, progress=None, mode=None):
+    """Record the churn of the commits not processed yet, of one repo or all of them.
+
+    The "diff" mode downloads and stores the raw diff of every commit, the
+    "diffstat" mode only fetches the per-file line counts, leaving the diff
+    to be fetched when the commit is opened. Defaults to DIFF_SYNC_MODE.
+    """
+    progress = progress or SyncProgress()
+    mode = mode or config.get("DIFF_SYNC_MODE", "diff")
+
+    # Each repository is locked on its own, so a run over all of them never
+    # processes the same commits as the scheduler's run of one repository
+    if repo is None:
+        df = query_unprocessed_commits(engine, diffstat=mode == "diffstat")
+        repos = sorted(set(df["repo"])) if len(df) > 0 else []
+    else:
+        repos = [repo]
+
+    count = 0
+    for repo in repos:
+        count += sync_repo_diffs(engine, config, repo, progress, mode)
+
+    return count
+
+
+def sync_repo_diffs(engine, config, repo, progress, mode):
+    count = 0
+
+    with sync_lock(engine, "bb_commits.diff", repo) as acquired:
+        if not acquired:
+            progress.add_error(f"Diff sync for {repo} is already running")
+            return count
+
+        # Return a list of unprocessed commits, once the lock is held
+        df = query_unprocessed_commits(engine, repo, diffstat=mode == "diffstat")
+
+        # Initialize Bitbucket client
+        bitbucket = init_bitbucket(config, repo)
+
+        for index, row in df.iterrows():
+            commit_id = row["id"]
+
+            print(f"Processing commit: {commit_id}")
+
+            if mode == "diffstat":
+                files = bitbucket.list_diffstat(commit_id)
+                if files is None:
+                    progress.add_error(f"Diffstat of {commit_id} could not be fetched")
+                    continue
+
+                update_commit_diffstat(engine, commit_id, files)
+
+                count += 1
+                progress.add_page(1, "bb_commit_churn")
+                continue
+
+            # Return a commit diff
+            diff = bitbucket.get_diff_for_commit(commit_id)
+
+            # Update the commit diff with the per-file change volume of the commit,
+            # together: a stored diff marks the commit as processed
+            with engine.begin() as conn:
+                update_commit_diff(conn, commit_id, diff)
+                if diff is not None:
+                    append_commit_churn(
+                        conn, commit_id, iter_diff_files(diff, include_content=False)
+                    )
+
+            count += 1
+            progress.add_page(1, "bb_commits.diff")
+
+    return count
+
+
+def list_all_branches(bitbucket, page, page_size):
+    """Every branch of the repository from the given page on, following the next urls, or None."""
+    branches = []
+    url = bitbucket.branches_url(page, page_size)
+    while url is not None:
+        records, url = bitbucket.list_branches_page(url)
+        if records is None:
+            return None
+        branches.extend(records)
+    return branches
+
+
+def sync_mtr(engine, config, repos, page=1, page_size=100, progress=None):
+    """Fetch the commits of every branch of the repos into bb_mtr and bb_commit_branches.
+
+    Each branch is walked page by page, following the next urls, until its
+    first commit, or until a page older than the previous sync of the repo
+    only holds commits already mapped to the branch. Every page is written
+    with the checkpoint of its branch, so an interrupted sync resumes where it
+    stopped. A repo that is already being synced, or whose requests fail, is
+    recorded as an error and the others go on. Returns the number of MTR
+    records fetched.
+    """
+    progress = progress or SyncProgress()
+
+    count = 0
+    for repo in repos:
+        count += sync_repo_mtr(engine, config, repo, page, page_size, progress)
+
+    return count
+
+
+def sync_repo_mtr(engine, config, repo, page, page_size, progress):
+    count = 0
+
+    # Resuming relies on the checkpoints of the repo, written by one run at a time
+    with sync_lock(engine, "bb_mtr", repo) as acquired:
+        if not acquired:
+            progress.add_error(f"MTR sync for {repo} is already running")
+            return count
+
+        bitbucket = init_bitbucket(config, repo)
+
+        # Commits older than the previous complete sync were mapped by it
+        df_s = query_sync_history(engine, "bb_mtr", repo)
+        last_synced_at = None
+        if len(df_s) > 0:
+            last_synced_at = datetime.fromisoformat(df_s.iloc[0]["updated_at"])
+
+        # A checkpoint without next page is a branch that was walked to its end.
+        # A resumed sync keeps the start time of its run, as its watermark.
+        df_c = query_sync_checkpoints(engine, "bb_mtr", repo)
+        checkpoints = {record["branch"]: record for record in df_c.to_dict(orient="records")}
+        started_at = date_to_iso_seconds(datetime.now())
+        if checkpoints:
+            started_at = df_c.iloc[0]["watermark"] or started_at
+            print(f"Resuming {repo}, {len(checkpoints)} branches already started")
+
+        branches = list_all_branches(bitbucket, page, page_size)
+        if branches is None:
+            progress.add_error(f"Failed to fetch branches of {repo} for MTR")
+            return count
+
+        # A commit reachable from several branches gets a single MTR record
+        seen_commit_ids = set()
+        for branch in branches:
+            branch_name = branch["name"]
+            url = bitbucket.branch_commits_url(branch_name, page, page_size)
+            checkpoint = checkpoints.get(branch_name)
+            if checkpoint is not None:
+                url = checkpoint["next_page"]
+
+            while url is not None:
+                commits, next_url = bitbucket.list_branch_commits_page(url)
+                if commits is None:
+                    progress.add_error(f"Failed to fetch commits of {repo}, branch {branch_name} for MTR")
+                    return count
+
+                if len(commits) == 0:
+                    break
+
+                records = []
+                # Every commit seen on the branch, including the ones already seen on others
+                commit_branches = []
+                for commit in commits:
+                    commit_branches.append(
+                        {"commit_id": commit["hash"], "repo": repo, "branch": branch_name}
+                    )
+                    if commit["hash"] in seen_commit_ids:
+                        continue
+                    seen_commit_ids.add(commit["hash"])
+
+                    record = bitbucket.mtr_record(commit)
+                    if record is not None:
+                        records.append(record)
+
+                inserted = 0
+                with engine.begin() as conn:
+                    if records:
+                        inserted = append_mtr(conn, pd.DataFrame(records), config["DB_CHUNK_SIZE"])
+                    mapped = append_commit_branches(conn, commit_branches)
+
+                    # The rest of the branch was walked by a previous sync
+                    oldest_at = datetime.fromisoformat(commits[-1]["date"])
+                    if mapped == 0 and last_synced_at is not None and oldest_at < last_synced_at:
+                        print(f"Reached commits of {branch_name} already synced: {oldest_at} | {last_synced_at}")
+                        next_url = None
+
+                    save_sync_checkpoint(
+                        conn,
+                        "bb_mtr",
+                        repo,
+                        branch_name,
+                        next_page=next_url,
+                        last_id=commits[-1]["hash"],
+                        watermark=started_at,
+                    )
+
+                url = next_url
+                count += len(records)
+                progress.add_page(inserted or 0, "bb_mtr")
+
+        # Every branch was synced, the next run starts over from the new watermark
+        with engine.begin() as conn:
+            insert_sync_history(conn, "bb_mtr", repo, started_at)
+            delete_sync_checkpoints(conn, "bb_mtr", repo)
+
+    return count
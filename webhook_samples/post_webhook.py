@@ -0,0 +1,36 @@
+"""Post a recorded Bitbucket webhook payload to a local server.
+
+Usage: python webhook_samples/post_webhook.py repo:push webhook_samples/repo_push.json [--url http://localhost:8081/webhooks/bitbucket]
+
+The payload is signed with BITBUCKET_WEBHOOK_SECRET, set it to the server's:
+unsigned payloads are rejected.
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("event", help="X-Event-Key, e.g. repo:push or pullrequest:fulfilled")
+    parser.add_argument("payload", help="Path to the recorded JSON payload")
+    parser.add_argument("--url", default="http://localhost:8081/webhooks/bitbucket")
+    args = parser.parse_args()
+
+    with open(args.payload, "rb") as file:
+        body = file.read()
+
+    headers = {"Content-Type": "application/json", "X-Event-Key": args.event}
+    secret = os.environ.get("BITBUCKET_WEBHOOK_SECRET")
+    if secret:
+        signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        headers["X-Hub-Signature"] = f"sha256={signature}"
+
+    response = requests.post(args.url, data=body, headers=headers)
+    print(response.status_code, response.text)
+
+
+if __name__ == "__main__":
+    main()
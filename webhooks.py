@@ -0,0 +1,92 @@
+import hashlib
+import hmac
+from db_utils import (
+    append_commits,
+    append_commit_branches,
+    upsert_pullrequests,
+    append_pullrequest_states,
+)
+from generic_utils import LazyModule
+from jobs import enqueue_job
+from sync import init_bitbucket
+
+pd = LazyModule("pandas")
+
+
+class WebhookPayloadError(ValueError):
+    pass
+
+
+def verify_signature(secret, body, signature):
+    """Check the X-Hub-Signature header ("sha256=<hex>") Bitbucket sends when the webhook has a secret."""
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature[len("sha256=") :])
+
+
+def parse_push(config, payload):
+    """Return the repo, commit records, commit branches and truncated flag of a repo:push payload.
+
+    Raises WebhookPayloadError when the payload does not have the expected shape.
+    """
+    try:
+        repository = payload["repository"]
+        repo = repository["full_name"]
+        bitbucket = init_bitbucket(config, repo)
+
+        records = []
+        commit_branches = []
+        truncated = False
+        for change in payload["push"]["changes"]:
+            # Bitbucket only embeds the first few commits of large pushes
+            truncated = truncated or change.get("truncated", False)
+            # "new" is None when the branch was deleted, and may be a tag
+            new = change.get("new") or {}
+            branch = new.get("name") if new.get("type") == "branch" else None
+            for commit in change.get("commits") or []:
+                records.append(bitbucket.commit_record(commit, repository))
+                if branch:
+                    commit_branches.append({"commit_id": commit["hash"], "repo": repo, "branch": branch})
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        raise WebhookPayloadError(f"Invalid repo:push payload: {type(e).__name__}: {e}")
+
+    return repo, records, commit_branches, truncated
+
+
+def ingest_push(engine, config, payload):
+    """Store the commits of a repo:push event and queue their diffs."""
+    repo, records, commit_branches, truncated = parse_push(config, payload)
+
+    inserted = 0
+    if len(records) > 0:
+        df = pd.DataFrame(records).drop_duplicates(subset="id")
+        inserted = append_commits(engine, df, config["DB_CHUNK_SIZE"]) or 0
+    append_commit_branches(engine, commit_branches)
+
+    # The commits missing from a truncated push are fetched by a commits job,
+    # which queues the diffs once they are stored
+    jobs = []
+    diffs = {"kind": "diffs", "params": {"repos": [repo]}}
+    if truncated:
+        jobs.append(enqueue_job(engine, "commits", {"repos": [repo], "then": [diffs]}))
+    elif inserted > 0:
+        jobs.append(enqueue_job(engine, diffs["kind"], diffs["params"]))
+
+    return {"repo": repo, "commits": len(records), "inserted": inserted, "job_ids": jobs}
+
+
+def ingest_pullrequest(engine, config, payload):
+    """Store the new state of the pull request of a pullrequest:* event."""
+    try:
+        repo = payload["repository"]["full_name"]
+        bitbucket = init_bitbucket(config, repo)
+        record = bitbucket.pullrequest_record(payload["pullrequest"])
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        raise WebhookPayloadError(f"Invalid pull request payload: {type(e).__name__}: {e}")
+
+    df = pd.DataFrame([record])
+    written = upsert_pullrequests(engine, df, config["DB_CHUNK_SIZE"]) or 0
+    append_pullrequest_states(engine, [record])
+
+    return {"repo": repo, "id": record["id"], "state": record["state"], "written": written}